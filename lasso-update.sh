@@ -2,7 +2,6 @@
 set -u
 URL=https://www.spamhaus.org/drop/drop.lasso
 DROPLASSO=$(mktemp)
-ACLFILE=$(mktemp)
 POSTSCREEN_ACCESS_FILE=/etc/postfix/postscreen_access.cidr
 DATE=$(date +%Y%m%d)
 
@@ -12,18 +11,12 @@ then
   curl --silent -o "$DROPLASSO" $URL
 fi
 
-if [ -e "$DROPLASSO" ] ;
+# postscreen_stats.py reads the DROP networks and replaces the access file
+# atomically, it fails and keeps the file as it is on an empty download
+cp $POSTSCREEN_ACCESS_FILE{,.bkp"$DATE"}
+if python3 "$(dirname "$0")/postscreen_stats.py" --cidr="$DROPLASSO" \
+  --access=$POSTSCREEN_ACCESS_FILE ;
 then
-  # cut the source file on the semicolon
-  # and prepare the destination file
-  awk '{print $1}' "$DROPLASSO" |\
-    grep -E "^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\/[0-9]{1,2}$" |\
-    while IFS= read -r network
-  do
-    echo -e "$network\treject" >> "$ACLFILE"
-  done
+  postfix reload
 fi
-
-cp $POSTSCREEN_ACCESS_FILE{,.bkp"$DATE"}
-cp "$ACLFILE" $POSTSCREEN_ACCESS_FILE
-postfix reload
+rm -f "$DROPLASSO"
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""Benchmarks postscreen_stats.py on synthetic postscreen logs."""
+
+from getopt import getopt
+from itertools import zip_longest
+from json import dump as json_dump, load as json_load
+from os import devnull, makedirs, remove, rename, wait4
+from os.path import abspath, dirname, isfile, join
+from random import Random
+from subprocess import Popen, check_output
+from sys import argv, executable, exit
+from time import gmtime, strftime, time
+
+
+def usage():
+    """Prints the usage of the program."""
+    print("""
+postscreen_bench.py
+    times postscreen_stats.py on deterministic synthetic postscreen logs
+
+usage: postscreen_bench.py --sizes=1M,10M
+
+  --sizes=      comma separated log sizes in lines, with an optional K or M
+                suffix (default is 1M,10M, add 100M for the full benchmark)
+  --clients=    count of distinct client IPs in the logs (default 100000)
+  --noise=      share of the lines which are not postscreen lines
+                (default 0.5)
+  --formats=    comma separated time stamp formats {syslog|rfc3339}
+                (default is syslog)
+  --seed=       seed of the log generator (default 1)
+  --workdir=    directory of the generated logs, kept for the next runs
+                (default is ./bench)
+  --repeat=     runs of each phase, the fastest one is kept (default 1)
+  --args=       extra arguments of postscreen_stats.py, ex. '-j 4'
+  --geofile=    geolocation database, to time the map phase too
+
+  --save=       save the results to this JSON file
+  --baseline=   compare the results with this JSON file saved by --save
+  --threshold=  percentage of slowdown over the baseline reported as a
+                regression, the exit status is then 1 (default 10)
+
+  --generate=   only write a log of the first --sizes and --formats to
+                this file
+  --check=      comma separated -j worker counts: instead of timing, check
+                that the full report of each log parsed with them is the
+                one of the single process parse, the exit status is 1 if not
+""")
+
+
+# postscreen outcomes of a connection: (weight, lines after the CONNECT),
+# a first connection is graylisted or rejected more often
+NEW_CLIENT_SESSIONS = (
+    (30, ("PASS NEW [{ip}]:{port}",
+          "NOQUEUE: reject: RCPT from [{ip}]:{port}: 450 4.3.2 Service currently "
+          "unavailable; from=<spam@example.com>, to=<user@example.org>, "
+          "proto=ESMTP, helo=<[{ip}]>")),
+    (20, ("DNSBL rank {rank} for [{ip}]:{port}",
+          "HANGUP after 2.1 from [{ip}]:{port} in tests after SMTP handshake")),
+    (15, ("PREGREET 11 after 0.16 from [{ip}]:{port}: EHLO example.com\\r\\n",
+          "DNSBL rank {rank} for [{ip}]:{port}")),
+    (10, ("DNSBL rank {rank} for [{ip}]:{port}",)),
+    (5, ("HANGUP after 0.4 from [{ip}]:{port} in tests before SMTP handshake",)),
+    (4, ("COMMAND PIPELINING from [{ip}]:{port} after EHLO: QUIT\\r\\n",)),
+    (3, ("NON-SMTP COMMAND from [{ip}]:{port} after CONNECT: GET / HTTP/1.1",)),
+    (3, ("BARE NEWLINE from [{ip}]:{port} after DATA",)),
+    (2, ("COMMAND TIME LIMIT from [{ip}]:{port} after RCPT",)),
+    (2, ("COMMAND COUNT LIMIT from [{ip}]:{port} after RSET",)),
+    (1, ("COMMAND LENGTH LIMIT from [{ip}]:{port} after EHLO",)),
+    (2, ("BLACKLISTED [{ip}]:{port}",)),
+    (3, ("NOQUEUE: reject: CONNECT from [{ip}]:{port}: too many connections",)),
+)
+KNOWN_CLIENT_SESSIONS = (
+    (60, ("PASS OLD [{ip}]:{port}",)),
+    (10, ("WHITELISTED [{ip}]:{port}",)),
+    (2, ("WHITELIST VETO [{ip}]:{port}",)),
+    (10, ("DNSBL rank {rank} for [{ip}]:{port}",
+          "HANGUP after 5.0 from [{ip}]:{port} in tests after SMTP handshake")),
+    (2, ("NOQUEUE: reject: CONNECT from [{ip}]:{port}: all server ports busy",)),
+)
+# postscreen logs no DISCONNECT after these lines, it hands the connection
+# to smtpd or drops it
+HANDOFF_LINES = ("PASS OLD", "PASS NEW", "WHITELISTED", "BLACKLISTED",
+                 "NOQUEUE: reject: CONNECT")
+# lines of the other Postfix daemons interleaved with postscreen
+NOISE_LINES = (
+    "postfix/smtpd[{pid}]: connect from unknown[{ip}]",
+    "postfix/smtpd[{pid}]: disconnect from unknown[{ip}] ehlo=1 mail=1 rcpt=1 "
+    "data=1 quit=1 commands=5",
+    "postfix/smtpd[{pid}]: 4F2A1C0D{pid}: client=unknown[{ip}]",
+    "postfix/cleanup[{pid}]: 4F2A1C0D{pid}: message-id=<{pid}.{port}@example.com>",
+    "postfix/qmgr[{pid}]: 4F2A1C0D{pid}: from=<news@example.com>, size=4321, "
+    "nrcpt=1 (queue active)",
+    "postfix/smtp[{pid}]: 4F2A1C0D{pid}: to=<user@example.org>, relay=mx.example.org"
+    "[192.0.2.25]:25, delay=0.4, status=sent (250 2.0.0 Ok)",
+)
+# sessions of the previous log ending at the top of the generated logs,
+# like a rotated log starts, their CONNECT is not logged
+ROTATED_SESSIONS = 100
+# first day of the generated logs, and seconds per line on average
+START_TS = 1704067200
+SECONDS_PER_LINE = 0.05
+BENCH_YEAR = 2024
+
+
+def weighted(sessions):
+    """Return the cumulative weights and the lines of the sessions"""
+    total = 0
+    weights = []
+    for weight, _ in sessions:
+        total += weight
+        weights.append(total)
+    return weights, [lines for _, lines in sessions]
+
+
+def parse_size(size):
+    """Return the count of lines of a size like 10M"""
+    size = size.strip().upper()
+    for suffix, factor in (("K", 1000), ("M", 1000000), ("G", 1000000000)):
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * factor)
+    return int(size)
+
+
+def generate_log(log_file, lines, clients, noise, rfc3339, seed):
+    """Write a deterministic synthetic maillog of about lines lines
+
+    The clients are drawn with a skew, a few of them connect often and
+    most of them are seen a few times. Each connection is a CONNECT, the
+    lines of a postscreen outcome and a DISCONNECT unless postscreen hands
+    the connection to smtpd or drops it, and the other Postfix daemons add
+    noise lines. The first ROTATED_SESSIONS connections have
+    no CONNECT, it was logged before the rotation of the log.
+    """
+    rand = Random(seed)
+    ips = ["%d.%d.%d.%d" % (rand.randint(1, 223), rand.randint(0, 255),
+                            rand.randint(0, 255), rand.randint(1, 254))
+           for _ in range(clients)]
+    new_weights, new_sessions = weighted(NEW_CLIENT_SESSIONS)
+    known_weights, known_sessions = weighted(KNOWN_CLIENT_SESSIONS)
+    seen = set()
+    stamps = {}
+    written = 0
+    rotated = ROTATED_SESSIONS
+    with open(log_file, "w") as maillog:
+        while written < lines:
+            unix_ts = int(START_TS + written * SECONDS_PER_LINE)
+            # one time stamp per second, formatted once
+            stamp = stamps.get(unix_ts)
+            if stamp is None:
+                stamps.clear()
+                if rfc3339:
+                    stamp = strftime("%Y-%m-%dT%H:%M:%S+00:00", gmtime(unix_ts))
+                else:
+                    stamp = strftime("%b %d %H:%M:%S", gmtime(unix_ts))
+                stamp = stamps[unix_ts] = stamp + " mx1 "
+            ip = ips[int(clients * rand.random() ** 3)]
+            port = rand.randint(1024, 65535)
+            pid = rand.randint(1000, 9999)
+            batch = []
+            if rand.random() < noise:
+                batch.append(stamp + rand.choice(NOISE_LINES).format(pid=pid, ip=ip, port=port))
+            else:
+                if ip in seen:
+                    weights, sessions = known_weights, known_sessions
+                else:
+                    seen.add(ip)
+                    weights, sessions = new_weights, new_sessions
+                pick = rand.random() * weights[-1]
+                session = sessions[next(index for index, weight in enumerate(weights)
+                                        if pick < weight)]
+                prefix = stamp + "postfix/postscreen[%d]: " % pid
+                rank = rand.randint(1, 9)
+                if rotated:
+                    rotated -= 1
+                else:
+                    batch.append(prefix + "CONNECT from [%s]:%d to [192.0.2.1]:25" % (ip, port))
+                for line in session:
+                    batch.append(prefix + line.format(ip=ip, port=port, rank=rank))
+                if not session[-1].startswith(HANDOFF_LINES):
+                    batch.append(prefix + "DISCONNECT [%s]:%d" % (ip, port))
+            batch.append("")
+            maillog.write("\n".join(batch))
+            written += len(batch) - 1
+    return written
+
+
+def run_phase(command):
+    """Run command and return its (wall seconds, CPU seconds, peak RSS KiB)"""
+    with open(devnull, "w") as output:
+        start = time()
+        process = Popen(command, stdout=output)
+        _, status, usage_stats = wait4(process.pid, 0)
+        wall = time() - start
+    # the Popen object must not wait for the process reaped by wait4
+    process.returncode = status
+    if status != 0:
+        print("ERROR: Failed to run", " ".join(command))
+        exit(2)
+    return wall, usage_stats.ru_utime + usage_stats.ru_stime, usage_stats.ru_maxrss
+
+
+def bench_log(log_file, lines, rfc3339):
+    """Time the phases of postscreen_stats.py on log_file
+
+    The phases are timed as the difference of runs with more work:
+    - parse: start and parse the log (--report=none)
+    - aggregation: aggregate the clients, from the --stats-json record
+    - report: print the short report
+    - full: print the full report of every client
+    - map: geolocate and map the blocked clients, with --geofile
+    """
+    base = [executable, STATS_SCRIPT, "-f", log_file, "-y", str(BENCH_YEAR)] + EXTRA_ARGS
+    if rfc3339:
+        base.append("--rfc3339")
+    stats_file = join(WORKDIR, "bench_stats.json")
+    runs = [("parse", ["--report=none", "--stats-json=" + stats_file]), ("report", ["--report=short"]),
+            ("full", ["--report=full"])]
+    if GEOFILE:
+        runs.append(("map", ["--report=none", "--geofile=" + GEOFILE,
+                             "--mapdest=" + join(WORKDIR, "bench_map.html")]))
+    results = {}
+    for phase, options in runs:
+        results[phase] = min((run_phase(base + options) for _ in range(REPEAT)),
+                             key=lambda result: result[0])
+    parse_wall = results["parse"][0]
+    with open(stats_file) as stats:
+        aggregation = json_load(stats)["phases"]["aggregation"]
+    phases = {"parse": {"seconds": parse_wall - aggregation["wall"],
+                        "cpu": results["parse"][1] - aggregation["cpu"],
+                        "lines/s": lines / parse_wall if parse_wall else 0,
+                        "peak rss KiB": results["parse"][2]},
+              "aggregation": {"seconds": aggregation["wall"], "cpu": aggregation["cpu"],
+                              "peak rss KiB": results["parse"][2]}}
+    for phase in ("report", "full", "map"):
+        if phase in results:
+            phases[phase] = {"seconds": max(results[phase][0] - parse_wall, 0),
+                             "cpu": max(results[phase][1] - results["parse"][1], 0),
+                             "peak rss KiB": results[phase][2]}
+    return phases
+
+
+def compare(results, baseline, threshold):
+    """Print the slowdowns over the baseline, return True on a regression"""
+    regression = False
+    for key, phases in sorted(results.items()):
+        for phase, measures in sorted(phases.items()):
+            before = baseline.get(key, {}).get(phase)
+            if before is None or not before["seconds"]:
+                continue
+            change = (measures["seconds"] / before["seconds"] - 1) * 100
+            # phases under 10ms are too short to compare reliably
+            slower = change > threshold and measures["seconds"] - before["seconds"] > 0.01
+            regression = regression or slower
+            print("%-22s %-7s %8.3fs -> %8.3fs %+7.1f%%%s" % (
+                key, phase, before["seconds"], measures["seconds"], change,
+                "  REGRESSION" if slower else ""))
+    return regression
+
+
+def check_jobs(log_file, rfc3339, jobs_list):
+    """Compare the full reports of log_file with -j and without it
+
+    Each count of workers of jobs_list must give the full report of the
+    single process parse, the first line differing is printed. Return True
+    if all of them are identical.
+    """
+    base = [executable, STATS_SCRIPT, "-f", log_file, "-y", str(BENCH_YEAR),
+            "--report=full"] + EXTRA_ARGS
+    if rfc3339:
+        base.append("--rfc3339")
+    expected = check_output(base).decode("utf-8", "replace").splitlines()
+    identical = True
+    for jobs in jobs_list:
+        report = check_output(base + ["-j", str(jobs)]).decode("utf-8", "replace").splitlines()
+        for number, (line, other) in enumerate(zip_longest(expected, report), 1):
+            if line != other:
+                identical = False
+                print("-j %d: the full report differs from line %d:\n  %s\n  %s" % (
+                    jobs, number, line, other))
+                break
+        else:
+            print("-j %d: the full report of the %d lines is identical" % (jobs, len(report)))
+    return identical
+
+
+# VARIABLES
+STATS_SCRIPT = join(dirname(abspath(__file__)), "postscreen_stats.py")
+SIZES = "1M,10M"
+CLIENTS = 100000
+NOISE = 0.5
+FORMATS = "syslog"
+SEED = 1
+WORKDIR = "bench"
+REPEAT = 1
+EXTRA_ARGS = []
+GEOFILE = ""
+SAVE_FILE = ""
+BASELINE_FILE = ""
+THRESHOLD = 10.0
+GENERATE_FILE = ""
+CHECK_JOBS = []
+# generated logs of the previous versions of generate_log() are not reused
+GENERATOR_VERSION = 3
+
+ARGS_LIST, REMAINDER = getopt(argv[1:], 'h', [
+    'sizes=', 'clients=', 'noise=', 'formats=', 'seed=', 'workdir=',
+    'repeat=', 'args=', 'geofile=', 'save=', 'baseline=', 'threshold=',
+    'generate=', 'check=', 'help'])
+
+for argument, value in ARGS_LIST:
+    if argument in '--sizes':
+        SIZES = value
+    elif argument in '--clients':
+        CLIENTS = int(value)
+    elif argument in '--noise':
+        NOISE = float(value)
+    elif argument in '--formats':
+        FORMATS = value
+    elif argument in '--seed':
+        SEED = int(value)
+    elif argument in '--workdir':
+        WORKDIR = value
+    elif argument in '--repeat':
+        REPEAT = int(value)
+    elif argument in '--args':
+        EXTRA_ARGS = value.split()
+    elif argument in '--geofile':
+        GEOFILE = value
+    elif argument in '--save':
+        SAVE_FILE = value
+    elif argument in '--baseline':
+        BASELINE_FILE = value
+    elif argument in '--threshold':
+        THRESHOLD = float(value)
+    elif argument in '--generate':
+        GENERATE_FILE = value
+    elif argument in '--check':
+        CHECK_JOBS = [int(jobs) for jobs in value.split(",")]
+    elif argument in ('-h', '--help'):
+        usage()
+        exit()
+
+if GENERATE_FILE:
+    generate_log(GENERATE_FILE, parse_size(SIZES.split(",")[0]), CLIENTS, NOISE,
+                 FORMATS.split(",")[0] == "rfc3339", SEED)
+    exit()
+
+try:
+    makedirs(WORKDIR)
+except OSError:
+    pass
+
+RESULTS = {}
+CHECK_FAILED = False
+for format_name in FORMATS.split(","):
+    for size in SIZES.split(","):
+        LINES = parse_size(size)
+        LOG_FILE = join(WORKDIR, "bench-v%d-%s-%d-%d-%s-%d.log" % (
+            GENERATOR_VERSION, format_name, LINES, CLIENTS, NOISE, SEED))
+        if not isfile(LOG_FILE):
+            print("Generating", LOG_FILE)
+            try:
+                generate_log(LOG_FILE + ".tmp", LINES, CLIENTS, NOISE,
+                             format_name == "rfc3339", SEED)
+            except KeyboardInterrupt:
+                remove(LOG_FILE + ".tmp")
+                raise
+            # a complete log only, the next runs reuse it
+            rename(LOG_FILE + ".tmp", LOG_FILE)
+        KEY = "%s %s" % (format_name, size)
+        if CHECK_JOBS:
+            print("\n=== %s lines, %s time stamps ===" % (size, format_name))
+            if not check_jobs(LOG_FILE, format_name == "rfc3339", CHECK_JOBS):
+                CHECK_FAILED = True
+            continue
+        RESULTS[KEY] = bench_log(LOG_FILE, LINES, format_name == "rfc3339")
+        PARSE = RESULTS[KEY]["parse"]
+        print("\n=== %s lines, %s time stamps ===" % (size, format_name))
+        print("%-11s %10s %10s %12s %14s" % ("phase", "wall s", "cpu s", "lines/s", "peak RSS MiB"))
+        for PHASE in ("parse", "aggregation", "report", "full", "map"):
+            if PHASE in RESULTS[KEY]:
+                MEASURES = RESULTS[KEY][PHASE]
+                print("%-11s %10.3f %10.3f %12s %14.1f" % (
+                    PHASE, MEASURES["seconds"], MEASURES["cpu"],
+                    "%d" % MEASURES["lines/s"] if "lines/s" in MEASURES else "",
+                    MEASURES["peak rss KiB"] / 1024.0))
+
+if CHECK_FAILED:
+    print("\nERROR: The reports of the parallel parse differ")
+    exit(1)
+
+if SAVE_FILE:
+    with open(SAVE_FILE, "w") as saved:
+        json_dump({"time": strftime("%Y-%m-%d %H:%M:%S"), "args": argv[1:],
+                   "results": RESULTS}, saved, indent=1, sort_keys=True)
+    print("\nResults saved to", SAVE_FILE)
+
+if BASELINE_FILE:
+    with open(BASELINE_FILE) as saved:
+        BASELINE = json_load(saved)["results"]
+    print("\n=== comparison with", BASELINE_FILE, "===")
+    if compare(RESULTS, BASELINE, THRESHOLD):
+        print("\nERROR: Slower than the baseline by more than %s%%" % THRESHOLD)
+        exit(1)
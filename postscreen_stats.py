@@ -1,15 +1,47 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """Parses the postscreen logs and display stats."""
 # mjc - 20180514
 
-from __future__ import print_function
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
+from bz2 import BZ2File
+from calendar import timegm
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from csv import writer as csv_writer
 from datetime import datetime as dt
 from decimal import Decimal, getcontext
 from getopt import getopt
-from re import escape, match, search, split
-from sys import argv
-from time import mktime, strptime
+from glob import escape as escape_glob, glob
+from gzip import open as gzip_open
+from heapq import heappop, heappush, heapreplace, merge as heap_merge
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BufferedReader
+from itertools import chain
+from json import dumps as json_dumps, loads as json_loads
+from lzma import LZMAFile
+from math import ceil, log as math_log
+from mmap import ACCESS_READ, mmap
+from multiprocessing import get_context
+from operator import itemgetter
+from os import O_WRONLY, SEEK_END, devnull, dup2, fstat, open as os_open, remove, replace, \
+    stat as os_stat
+from os.path import getmtime, getsize, isfile
+from pickle import HIGHEST_PROTOCOL, UnpicklingError, dump as pickle_dump, load as pickle_load
+from re import compile as re_compile
+from socket import gethostname, inet_aton, inet_ntoa
+from sqlite3 import connect as sqlite_connect
+from struct import Struct
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from sys import argv, byteorder, stderr, stdout
+from threading import Thread
+from time import mktime, process_time, sleep, strptime, time
+from zlib import compress, decompress, error as zlib_error
+
+# NumPy is optional, it speeds up the aggregation of the reports
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
 
 
 def usage():
@@ -20,31 +52,111 @@ postscreen_stats.py
 
 usage: postscreen_stats.py -f maillog
 
-  -a|--action=   action filter with operators | and &
+  -a|--action=   action filter with operators | & ! and ( )
     ex. 'PREGREET&DNSBL|HANGUP' = ((PREGREET and DNSBL) or HANGUP)
     ex. 'HANGUP&DNSBL|PREGREET&DNSBL'
       = ((HANGUP and DNSBL) or (PREGREET and DNSBL)
+    ! negates an action and parentheses group them
+    ex. '(DNSBL|PREGREET)&!WHITELISTED'
+
+  --db=         history mode, add the clients of each day to this SQLite
+                database (from the last position in the log file, the
+                older -f logs are imported by the first run) and report
+                from the database
+  --query       report from the --db history without reading the log
+  --since=      first day YYYY-MM-DD of the --db reports
+  --until=      last day YYYY-MM-DD of the --db reports
+
+  --export=     export the table of the clients matching the action filter
+                to this file, in the format of its extension: .csv, .jsonl,
+                .sqlite or .parquet (with the pyarrow module)
+  --export-format=  csv|jsonl|sqlite|parquet, overrides the file extension
 
   -f|--file=    log file to parse (default is /var/log/maillog)
+                may be repeated or a glob, the rotated logs are parsed
+                oldest first and gzip, bzip2, xz or zstd compressed logs
+                are read on the fly (zstd requires the zstandard module)
 
-  --geofile=    path to a GeoLiteCity.dat MaxMind GeoLite City database file
-                Download "GeoLite City" Binary for free from MaxMind at:
-                http://dev.maxmind.com/geoip/legacy/geolite/
+  --geofile=    path to a MaxMind GeoLite2-City.mmdb database file (with
+                the maxminddb module) or legacy GeoLiteCity.dat file
+                Download "GeoLite2 City" for free from MaxMind at:
+                https://dev.maxmind.com/geoip/geolite2-free-geolocation-data
+  --geocache=   file caching the geolocation of the IPs between the runs,
+                it is reset when the --geofile database changes
 
   -i|--ip=      filters the results on a specific IP
 
+  -j|--jobs=    number of worker processes parsing the log file (default 1)
+
   --mapdest=    path to a destination HTML file to display maps result
                 *** Require geolocation with --geofile option ***
 
   --map-min-conn=   When creating a map, only show IPs which connected X times
+  --map-tiles=  URL template of the map tiles, a local tile server for an
+                offline map (default is the OpenStreetMap tiles)
+  --map-assets= URL or directory of local copies of the Leaflet files, for
+                an offline map (default is the unpkg.com CDN)
+  --map-heat    draw a heat map of the blocked IPs instead of markers
 
-  --report=     report mode {short|full|ip|none} (default is short)
+  -r|--report=  report mode {short|full|ip|none|days} (default is short)
+                days prints the daily totals of the --db history
 
   -y|--year=    select the year of the logs (default is current year)
 
+  --state=      incremental mode, keep the clients statistics and the position
+                in the log file in this state file: the next run only parses
+                the lines logged since then, and detects the log rotation
+
+  --follow      follow the log file like tail -F and print the statistics of
+                the last --windows every --interval
+  --windows=    comma separated sliding windows (default is 5m,1h,24h)
+  --interval=   delay between two --follow reports (default is 60s)
+  --client-ttl= --follow forgets the clients idle for this duration
+                (default is the largest window)
+  --max-clients=    --follow forgets the least recently seen clients above
+                this count (default is 1000000)
+
+  --prefix=     roll the clients up to their network of this prefix length,
+                ex. 24 for the /24 networks (default is 32, the IPs)
+  --top=        print the top networks of --prefix by --top-actions, counted
+                in bounded memory with no client kept (Space-Saving)
+  --top-actions=    comma separated actions counted by --top
+                (default is DNSBL,PREGREET,HANGUP)
+  --access=     write the --cidr networks and the --top networks they do not
+                cover to this postscreen_access.cidr file, written aside
+                and renamed (without --top, the log is not read)
+  --cidr=       postscreen_access.cidr table or Spamhaus DROP list, may be
+                repeated: the reports tell the networks matching clients
+                and the clients with --top-actions which are not covered
+
+  --exporter=   [host:]port, serve the statistics of the log as OpenMetrics
+                at http://host:port/metrics (host is 127.0.0.1 by default),
+                the log is parsed then followed like tail -F and the
+                scrapes get the snapshot of the last second, the action
+                filter does not apply
+
+  --summary=    write the clients to this compact summary file, to merge
+                with the summaries of the other relays
+  --merge=      report from these summary files instead of the logs, may
+                be repeated or a glob, the clients seen by several relays
+                are merged (with -r none and --summary, the summaries are
+                merged into a new one in a single streaming pass)
+
+  --latency     report the latency of the postscreen decisions, from the
+                CONNECT of each session to its actions, overall, by action
+                and by hour, and the delay of every reconnection
+
   --rfc3339     set the timestamp format to "2012-04-13T08:53:00+02:00"
                 instead of the regular syslog format "Oct 23 04:02:17"
 
+  --stats       print on stderr the wall and CPU time of each phase, the
+                lines read and parsed, the postscreen lines of each action,
+                the unknown or unparsed lines, the clients and the peak memory
+  --stats-json= write the --stats record to this JSON file
+  --profile=    profile the run with cProfile, dump the statistics to this
+                file and print the functions taking the most time on stderr
+                (the -j workers are not profiled)
+
 example command:
 $ postscreen_stats.py -f maillog --geofile=GeoLiteCity.dat --mapdest=report.html
 
@@ -55,555 +167,3600 @@ https://github.com/jvehent/Postscreen-Stats
 
 def gen_unix_ts(syslog_ts):
     """Convert the syslog time stamp into unix format and return it."""
-    full_ts = 0
-    unix_ts = 0
-    now_ts = dt.now()
-    unix_ts = int(now_ts)
+    # consecutive log lines mostly share the same second
+    if syslog_ts == LAST_TS[0]:
+        return LAST_TS[1]
+
     if RFC3339:
-        date = syslog_ts.split('+', 1)
         # example format: 2012-04-13T08:53:00+02:00
-        full_ts = strptime(date[0], '%Y-%m-%dT%H:%M:%S')
-        unix_ts = mktime(full_ts)
+        # optionally with a fraction of second and/or Z as UTC offset
+        minute = syslog_ts[:16]
+        seconds = syslog_ts[17:19]
+        offset = syslog_ts[19:].lstrip("0123456789.")
+        minute_key = minute + offset
     else:
-        # add the year
-        syslog_ts = str(YEAR) + " " + syslog_ts
-        # example format: 2011 Oct 23 04:02:17
-        full_ts = strptime(syslog_ts, '%Y %b %d %H:%M:%S')
-        unix_ts = mktime(full_ts)
+        # example format: Oct 23 04:02:17
+        minute_key = minute = syslog_ts[:-3]
+        seconds = syslog_ts[-2:]
+
+    # the conversion of the minute is cached, only the seconds are added
+    minute_ts = MINUTE_TS_CACHE.get(minute_key)
+    if minute_ts is None:
+        if RFC3339:
+            minute_ts = float(timegm(strptime(minute, '%Y-%m-%dT%H:%M')))
+            if offset not in ("", "Z", "z"):
+                minute_ts -= (int(offset[0] + "1") *
+                              (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60))
+            elif offset == "":
+                # no UTC offset, assume the local time like syslog
+                minute_ts = mktime(strptime(minute, '%Y-%m-%dT%H:%M'))
+        else:
+            # add the year, example format: 2011 Oct 23 04:02
+            minute_ts = mktime(strptime(str(YEAR) + " " + minute, '%Y %b %d %H:%M'))
+        MINUTE_TS_CACHE[minute_key] = minute_ts
+    unix_ts = minute_ts + int(seconds)
 
     # check if the unix_ts is in the future then bail
-    if unix_ts > mktime(now_ts.timetuple()):
+    if unix_ts > NOW_TS:
         print("ERROR: Calculated date from syslog time stamp is in the future!?")
         print("Are you really parsing mail logs from year " + str(YEAR) + " ?")
         exit()
-    else:
-        return unix_ts
+    LAST_TS[0] = syslog_ts
+    LAST_TS[1] = unix_ts
+    return unix_ts
+
+
+class ClientStat(object):
+    """Each client's statistics are stored in the class
 
+    The clients are kept by millions, so the class has slots and counts
+    the actions in an array indexed like ACTIONS. The bit of each action
+    logged at least once is set in mask, for the action filter. The DNSBL
+    ranks are a {rank: count} histogram, created with the first rank.
+    """
+    __slots__ = ("first_seen", "last_seen", "connect", "reco_delay",
+                 "actions", "mask", "dnsbl_ranks", "geoloc")
 
-class ClientStat(object):  # pylint: disable=too-few-public-methods
-    """Each client's statistics are stored in the class"""
     def __init__(self):
-        self.logs = defaultdict(int)     # connection logs
-        self.actions = defaultdict(int)  # postscreen action logs
-        self.dnsbl_ranks = []            # list of ranks triggered when blocked
-        self.geoloc = defaultdict(int)
-
-    def action_filter(self, ac_filter):
-        """Return true if the object matches the ACTION_FILTER"""
-        _pass_action_filter = 0
-        _and_action_filter = 0
-        # if the ACTION_FILTER is defined, iterate through the action
-        # and process only the clients with a matching action
-        if ac_filter is None:
-            _pass_action_filter = 1
-        else:
-            for or_action in ac_filter.split("|"):
-                if _pass_action_filter == 0:
-                    _and_action_filter = 0
-                    for and_action in or_action.split("&"):
-                        if self.actions[and_action] > 0 and _and_action_filter >= 0:
-                            _and_action_filter = 1
-                        else:
-                            _and_action_filter = -1
-                    if _and_action_filter > 0:
-                        _pass_action_filter = 1
-        if _pass_action_filter == 1:
+        self.first_seen = 0
+        self.last_seen = 0
+        self.connect = 0
+        self.reco_delay = None  # first reconnection delay (graylist)
+        self.actions = NO_ACTIONS[:]
+        self.mask = 0
+        self.dnsbl_ranks = None
+        self.geoloc = None
+
+    def logs(self):
+        """Return the (name, value) connection logs sorted by name"""
+        logs = [("CONNECT", self.connect), ("FIRST SEEN", self.first_seen),
+                ("LAST SEEN", self.last_seen)]
+        if self.reco_delay is not None:
+            logs.append(("RECO. DELAY (graylist)", self.reco_delay))
+        return logs
+
+    def add_ranks(self, dnsbl_ranks):
+        """Add a {rank: count} histogram to the DNSBL ranks"""
+        if self.dnsbl_ranks is None:
+            self.dnsbl_ranks = {}
+        for rank, count in dnsbl_ranks.items():
+            self.dnsbl_ranks[rank] = self.dnsbl_ranks.get(rank, 0) + count
+
+    def rank_list(self):
+        """Return the DNSBL ranks triggered when blocked"""
+        if self.dnsbl_ranks is None:
+            return []
+        return [str(rank) for rank, count in self.dnsbl_ranks.items()
+                for _ in range(count)]
+
+    def action_filter(self, filter_terms):
+        """Return true if the object matches the compiled ACTION_FILTER"""
+        if filter_terms is None:
             return True
+        mask = self.mask
+        for required, forbidden in filter_terms:
+            if mask & required == required and not mask & forbidden:
+                return True
         return False
 
-# VARIABLES
-IP_REGEXP = r"((?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}" \
-            "(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))"
-IP_FILTER = " "
-ACTION_FILTER = None
-NOW = dt.now()
-YEAR = NOW.year
-REPORT_MODE = "short"
-LOG_FILE = "/var/log/maillog"
-GEOFILE = ""
-MAPDEST = ""
-RFC3339 = False
-MAP_MIN_CONN = 0
+    def update_mask(self):
+        """Recompute the mask of the actions from their counts"""
+        self.mask = 0
+        for action, count in enumerate(self.actions):
+            if count:
+                self.mask |= 1 << action
+
+
+def ip_to_int(current_ip):
+    """Convert a dotted quad IP to the integer keys of the clients"""
+    return unpack_ip(inet_aton(current_ip))[0]
+
+
+def int_to_ip(ip_key):
+    """Convert an integer key of the clients to a dotted quad IP"""
+    return inet_ntoa(pack_ip(ip_key))
+
+
+def parse_lines(lines, ip_list, partial=False, on_event=None, counters=None):
+    """Parse the postscreen log lines and update the clients of ip_list
+
+    The clients are keyed on their IP as an integer, see ip_to_int(), or
+    on their network with --prefix. With partial, the lines are a chunk
+    of the log and the clients are stored as PartialClientStat to be
+    merged with merge_partial()
+
+    on_event is called with (syslog time stamp, ip, event, value) for each
+    CONNECT (value is True for a new client), action (value is the rank of
+    a DNSBL) and graylist reconnection delay (value is the delay).
+
+    counters, a defaultdict(int), adds up the postscreen lines, the lines
+    of each action and the lines skipped, see PARSE_COUNTERS.
+    """
+    client_class = PartialClientStat if partial else ClientStat
+    # bind the globals and methods used in the loop to locals, the loop
+    # runs once per log line and the lookups add up on big logs
+    cursor = LOG_CURSOR
+    rfc3339 = RFC3339
+    ip_filter = IP_FILTER
+    ip_search = IP_SEARCH
+    action_rules = ACTION_RULES
+    aton = inet_aton
+    unpack = unpack_ip
+    prefix_mask = PREFIX_MASK
+    # the counters are kept in locals, the postscreen lines are the sum of
+    # the lines of each action and of the lines skipped
+    unparsed = 0
+    other_tokens = {}
+    unknown_clients = 0
+    unmatched = 0
+    action_lines = [0] * (len(ACTIONS) + 1)
+    for line in lines:
+        # Get postscreen logs only and apply the user defined IP filter
+        if "/postscreen[" not in line or ip_filter not in line:
+            continue
+        line_fields = line.split(None, cursor + 1)
+        if len(line_fields) < cursor + 2:
+            unparsed += 1
+            continue
+        token = line_fields[cursor]
+        detail = line_fields[cursor + 1]
 
-# position of 'postscreen' inside the logs
-LOG_CURSOR = 5
+        # parse the ip
+        found = ip_search(detail)
+        if found is None:
+            unparsed += 1
+            continue
+        current_ip = unpack(aton(found.group(1)))[0] & prefix_mask
+
+        if token == "CONNECT" or on_event is not None:
+            if rfc3339:
+                syslog_date = line_fields[0]
+            else:
+                syslog_date = line_fields[0] + " " + line_fields[1] + \
+                    " " + line_fields[2]
+
+        if token == "CONNECT":
+
+            client = ip_list.get(current_ip)
+            # first time we see the client, initiate a class instance
+            # store in in the client_list dictionary
+            if client is None or not client.connect:
+                if client is None:
+                    client = ip_list[current_ip] = client_class()
+                elif partial:
+                    # list the clients in the order of their first CONNECT,
+                    # like the single process parse
+                    ip_list[current_ip] = ip_list.pop(current_ip)
+                if partial:
+                    client.first_connect()
+                client.first_seen = client.last_seen = gen_unix_ts(syslog_date)
+
+            # ip is already known, update the last_seen timestamp
+            else:
+                client.last_seen = gen_unix_ts(syslog_date)
+
+            client.connect += 1
+            action_lines[-1] += 1
+            if on_event is not None:
+                on_event(syslog_date, current_ip, "CONNECT", client.connect == 1)
+            continue
 
-# the list of clients ips and pointer to instance of class
-IP_LIST = {}
-
-# command line arguments
-ARGS_LIST, REMAINDER = getopt(argv[1:], 'a:i:f:y:h', [
-    'action=', 'geofile=', 'mapdest=', 'ip=', 'year=', 'report=',
-    'help', 'file=', 'rfc3339', 'map-min-conn='])
-
-for argument, value in ARGS_LIST:
-    if argument in ('-a', '--action'):
-        ACTION_FILTER = str(value)
-    elif argument in '--geofile':
-        GEOFILE = value
-    elif argument in ('-f', '--file'):
-        LOG_FILE = value
-    elif argument in ('-y', '--year'):
-        YEAR = value
-    elif argument in '--rfc3339':
-        RFC3339 = True
-        LOG_CURSOR = 3
-    elif argument in ('-i', '--ip'):
-        IP_FILTER = value
-        print("Filtering results on IP", IP_FILTER)
-    elif argument in '--report':
-        if value in ('short', 'full', 'ip', 'none'):
-            REPORT_MODE = value
+        # client must be initialized to continue, unless its CONNECT may
+        # be in a previous chunk of the log
+        client = ip_list.get(current_ip)
+        rules = action_rules.get(token)
+        if rules is None:
+            other_tokens[token] = other_tokens.get(token, 0) + 1
+            continue
+        if client is None:
+            if not partial:
+                unknown_clients += 1
+                continue
+            client = ip_list[current_ip] = client_class()
+        for detail_match, action in rules:
+            if detail_match is not None and not detail_match(detail):
+                continue
+            action_lines[action] += 1
+            client.actions[action] += 1
+            client.mask |= 1 << action
+            rank = None
+            if action == PASS_OLD:
+                if partial:
+                    client.probe_graylist()
+                # if the connection count is 2, and the IP has already
+                # been rejected with a code 450 calculate the
+                # reconnection delay
+                elif client.connect == 2 and client.actions[GRAYLIST] > 0:
+                    client.reco_delay = client.last_seen - client.first_seen
+                    if on_event is not None:
+                        on_event(syslog_date, current_ip, "RECO. DELAY (graylist)",
+                                 client.reco_delay)
+            elif action == DNSBL:
+                # store the rank
+                rank = detail.split(None)[1]
+                if client.dnsbl_ranks is None:
+                    client.dnsbl_ranks = {}
+                client.dnsbl_ranks[int(rank)] = client.dnsbl_ranks.get(int(rank), 0) + 1
+            if on_event is not None:
+                on_event(syslog_date, current_ip, ACTIONS[action], rank)
+            break
         else:
-            print("ERROR: Unknown report type")
-            usage()
-            exit()
-    elif argument in '--mapdest':
-        MAPDEST = value
-        print("HTML map file will be generated at ", MAPDEST)
-    elif argument in '--map-min-conn':
-        MAP_MIN_CONN = int(value)
-    elif argument in ('-h', '--help'):
-        usage()
-        exit()
+            unmatched += 1
+
+    if counters is not None:
+        counters["postscreen lines"] += unparsed + unknown_clients + unmatched + \
+            sum(other_tokens.values()) + sum(action_lines)
+        counters["unparsed lines"] += unparsed
+        counters["lines of other events"] += sum(other_tokens.values())
+        counters["actions without CONNECT"] += unknown_clients
+        counters["unmatched action details"] += unmatched
+        counters["CONNECT"] += action_lines[-1]
+        for action, count in zip(ACTIONS, action_lines):
+            counters[action] += count
+        for token, count in other_tokens.items():
+            counters["other event " + token] += count
+
+
+class PartialClientStat(ClientStat):
+    """Statistics of a client in a chunk of the log parsed by a worker
+
+    The actions logged before the first CONNECT of the client in the chunk
+    only count if the client connected in a previous chunk, they are kept
+    apart in pre_actions and pre_ranks until the chunks are merged.
+    """
+    __slots__ = ("pre_actions", "pre_ranks", "probes", "graylisted_probes",
+                 "pre_graylisted_probes")
 
-# Geo location file is in use
-if GEOFILE not in "":
-    from imp import find_module
-    try:
-        find_module("pygeoip")
-        print("Using pygeoip module to open Geolocation ")
-        import pygeoip
-        GI = pygeoip.GeoIP(GEOFILE, pygeoip.MEMORY_CACHE)
-    except ImportError:
+    def __init__(self):
+        super(PartialClientStat, self).__init__()
+        self.pre_actions = None
+        self.pre_ranks = None
+        # the graylist reconnection delay depends on the CONNECT count of
+        # the previous chunks: keep the LAST SEEN of the last PASS OLD for
+        # each CONNECT count of this chunk up to 2, for any PASS OLD and
+        # for the ones following a 450 rejection in this chunk, and for the
+        # ones following a 450 rejection logged before the first CONNECT
+        # of the chunk, which only counts if the client connected earlier
+        self.probes = {}
+        self.graylisted_probes = {}
+        self.pre_graylisted_probes = {}
+
+    def first_connect(self):
+        """Log the following actions apart from the previous ones"""
+        self.pre_actions = self.actions
+        self.pre_ranks = self.dnsbl_ranks
+        self.actions = NO_ACTIONS[:]
+        self.mask = 0
+        self.dnsbl_ranks = None
+
+    def probe_graylist(self):
+        """Record a PASS OLD for the graylist reconnection delay"""
+        connect = self.connect
+        if connect <= 2:
+            last_seen = self.last_seen if connect else None
+            self.probes[connect] = last_seen
+            # before the first CONNECT, the actions are the pre_actions
+            pre_actions = self.pre_actions if connect else self.actions
+            if connect and self.actions[GRAYLIST] > 0:
+                self.graylisted_probes[connect] = last_seen
+            elif pre_actions is not None and pre_actions[GRAYLIST] > 0:
+                self.pre_graylisted_probes[connect] = last_seen
+
+
+def merge_partial(ip_list, current_ip, part):
+    """Merge the PartialClientStat of the next chunk into ip_list"""
+    if part.connect:
+        pre_actions, pre_ranks = part.pre_actions, part.pre_ranks
+        actions, dnsbl_ranks = part.actions, part.dnsbl_ranks
+    else:
+        pre_actions, pre_ranks = part.actions, part.dnsbl_ranks
+        actions, dnsbl_ranks = None, None
+
+    client = ip_list.get(current_ip)
+    if client is None:
+        # actions of a client which never connected are ignored
+        if not part.connect:
+            return
+        client = ip_list[current_ip] = ClientStat()
+        client.first_seen = part.first_seen
+        pre_actions = None
+        pre_graylisted_probes = {}
+    else:
+        pre_graylisted_probes = part.pre_graylisted_probes
+
+    # replay the PASS OLD which happened while the client had 2 CONNECT,
+    # the 450 rejection may come from the previous chunks
+    slot = 2 - client.connect
+    if slot in part.probes:
+        if client.actions[GRAYLIST] > 0:
+            probes = part.probes
+        elif slot in part.graylisted_probes:
+            probes = part.graylisted_probes
+        else:
+            probes = pre_graylisted_probes
+        if slot in probes:
+            last_seen = probes[slot]
+            if last_seen is None:
+                last_seen = client.last_seen
+            client.reco_delay = last_seen - client.first_seen
+
+    if part.connect:
+        client.last_seen = part.last_seen
+        client.connect += part.connect
+    for chunk_actions, chunk_ranks in ((pre_actions, pre_ranks),
+                                       (actions, dnsbl_ranks)):
+        if chunk_actions is not None:
+            for action, count in enumerate(chunk_actions):
+                if count:
+                    client.actions[action] += count
+            if chunk_ranks is not None:
+                client.add_ranks(chunk_ranks)
+    client.update_mask()
+
+
+def set_log_format(rfc3339=False, year=None):
+    """Set the time stamp format of the log lines and the year of syslog
+
+    The parsers read the format from the module settings, like the
+    --rfc3339 and -y options set it. The time stamp caches are reset.
+    """
+    global RFC3339, LOG_CURSOR, YEAR  # pylint: disable=global-statement
+    RFC3339 = rfc3339
+    LOG_CURSOR = 3 if rfc3339 else 5
+    if year is not None:
+        YEAR = year
+    MINUTE_TS_CACHE.clear()
+    DAY_CACHE.clear()
+    LAST_TS[:] = [None, 0]
+
+
+def postscreen_events(lines):
+    """Yield a PostscreenEvent for each CONNECT and action of the lines
+
+    The lines may come from any iterable of strings, a file or a log
+    shipper. The event of an action is its name in ACTIONS, the value is
+    the rank of a DNSBL and None otherwise. The events do not depend on
+    the previous lines, an Aggregator keeps the clients.
+    """
+    cursor = LOG_CURSOR
+    rfc3339 = RFC3339
+    ip_filter = IP_FILTER
+    ip_search = IP_SEARCH
+    action_rules = ACTION_RULES
+    aton = inet_aton
+    unpack = unpack_ip
+    prefix_mask = PREFIX_MASK
+    for line in lines:
+        if "/postscreen[" not in line or ip_filter not in line:
+            continue
+        line_fields = line.split(None, cursor + 1)
+        if len(line_fields) < cursor + 2:
+            continue
+        token = line_fields[cursor]
+        detail = line_fields[cursor + 1]
+        found = ip_search(detail)
+        if found is None:
+            continue
+        if token == "CONNECT":
+            rules = None
+        else:
+            rules = action_rules.get(token)
+            if rules is None:
+                continue
+        if rfc3339:
+            syslog_date = line_fields[0]
+        else:
+            syslog_date = line_fields[0] + " " + line_fields[1] + " " + line_fields[2]
+        current_ip = unpack(aton(found.group(1)))[0] & prefix_mask
+        if rules is None:
+            yield PostscreenEvent(syslog_date, current_ip, "CONNECT", None)
+            continue
+        for detail_match, action in rules:
+            if detail_match is not None and not detail_match(detail):
+                continue
+            rank = int(detail.split(None)[1]) if action == DNSBL else None
+            yield PostscreenEvent(syslog_date, current_ip, ACTIONS[action], rank)
+            break
+
+
+class Aggregator(object):
+    """Statistics of the clients, built from log lines or postscreen events
+
+    feed() parses lines with the loop of parse_lines(), which is
+    postscreen_events() and add() fused for speed, and add() counts the
+    events one by one: both build the same clients, keyed by ip_to_int().
+    """
+    def __init__(self, clients=None):
+        self.clients = {} if clients is None else clients
+        self.counters = defaultdict(int)
+
+    def feed(self, lines, on_event=None):
+        """Parse the postscreen lines of an iterable of log lines"""
+        parse_lines(lines, self.clients, on_event=on_event, counters=self.counters)
+
+    def add(self, event):
+        """Count a PostscreenEvent"""
+        client = self.clients.get(event.ip)
+        if event.event == "CONNECT":
+            unix_ts = gen_unix_ts(event.syslog_date)
+            if client is None or not client.connect:
+                if client is None:
+                    client = self.clients[event.ip] = ClientStat()
+                client.first_seen = unix_ts
+            client.last_seen = unix_ts
+            client.connect += 1
+            self.counters["CONNECT"] += 1
+            return
+        # the actions of a client count from its first CONNECT
+        if client is None:
+            self.counters["actions without CONNECT"] += 1
+            return
+        action = ACTION_INDEX[event.event]
+        client.actions[action] += 1
+        client.mask |= 1 << action
+        if action == PASS_OLD:
+            if client.connect == 2 and client.actions[GRAYLIST] > 0:
+                client.reco_delay = client.last_seen - client.first_seen
+        elif action == DNSBL:
+            client.add_ranks({event.value: 1})
+        self.counters[event.event] += 1
+
+    def consume(self, events):
+        """Count the PostscreenEvent of an iterable"""
+        add = self.add
+        for event in events:
+            add(event)
+
+    def aggregate(self, filter_terms=None):
+        """Return the Aggregates of the clients matching filter_terms
+
+        filter_terms is an action filter compiled by compile_filter().
+        """
+        return aggregate_clients(self.clients, filter_terms)
+
+
+class SpaceSaving(object):
+    """Top counts of a stream of keys in bounded memory (Space-Saving)
+
+    At most capacity keys are counted. A new key replaces the key with the
+    smallest count and starts from it, the inherited count is kept as the
+    error of the key: the true count is between count - error and count.
+    A key counted more than total / capacity times is always kept.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # key -> [count, error]
+        # (count, key) of each counted key, a count may be outdated, it is
+        # refreshed when it reaches the top of the heap
+        self.heap = []
+        self.total = 0
+
+    def add(self, key, count=1):
+        """Count key"""
+        self.total += count
+        counter = self.counts.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        error = self.evict() if len(self.counts) >= self.capacity else 0
+        self.counts[key] = [error + count, error]
+        heappush(self.heap, (error + count, key))
+
+    def evict(self):
+        """Forget the key with the smallest count and return its count"""
+        heap = self.heap
+        while True:
+            count, key = heap[0]
+            current = self.counts[key][0]
+            if current == count:
+                heappop(heap)
+                del self.counts[key]
+                return count
+            heapreplace(heap, (current, key))
+
+    def top(self, size):
+        """Return the (key, count, error) of the size largest counts
+
+        The keys are sorted on their guaranteed count, count - error, a key
+        which replaced many others is not ranked on its inherited count.
+        """
+        return [(key, count, error) for key, (count, error) in
+                sorted(self.counts.items(), key=lambda item: item[1][0] - item[1][1],
+                       reverse=True)[:size]]
+
+
+def top_networks(log_files, actions, capacity):
+    """Count the actions of each network of the log files in a SpaceSaving
+
+    The networks are the --prefix of the clients, no client is kept, so
+    the memory is bounded by capacity whatever the size of the logs.
+    """
+    sketch = SpaceSaving(capacity)
+    wanted = frozenset(actions)
+    add = sketch.add
+    for log_file in log_files:
+        for event in postscreen_events(read_chunk(log_file, 0, None, PARSE_COUNTERS)):
+            if event.event in wanted:
+                add(event.ip)
+    return sketch
+
+
+def network_name(ip_key):
+    """Return the IP of a client key, or its network with --prefix"""
+    if PREFIX_LEN < 32:
+        return int_to_ip(ip_key) + "/" + str(PREFIX_LEN)
+    return int_to_ip(ip_key)
+
+
+def write_access(access_file, networks):
+    """Write the (network, action) pairs to a postscreen_access.cidr file
+
+    The lines are formatted like lasso-update.sh wrote them, a network is
+    written once. The file is written aside and renamed when complete, the
+    count of networks written is returned.
+    """
+    written = set()
+    with open(access_file + ".tmp", "w") as access:
+        for network, action in networks:
+            if "/" not in network:
+                network += "/32"
+            if network not in written:
+                written.add(network)
+                access.write(network + "\t" + action + "\n")
+    replace(access_file + ".tmp", access_file)
+    return len(written)
+
+
+def read_networks(cidr_file):
+    """Return the AccessNetwork of each IPv4 network of cidr_file
+
+    The file is a postscreen_access.cidr table, "network/len action", or a
+    Spamhaus DROP list, "network/len ; SBL id": the action of a DROP
+    network is reject and its SBL id is the comment. The host bits of a
+    network are cleared, the comments and IPv6 networks are skipped.
+    """
+    networks = []
+    ip_match = IP_REGEXP_FULL.match
+    masks = [(0xffffffff << (32 - length)) & 0xffffffff for length in range(33)]
+    with open(cidr_file) as cidr:
+        for line in cidr:
+            fields = line.split(None, 1)
+            if not fields or fields[0][0] in "#;":
+                continue
+            address, _, length = fields[0].rstrip(";").partition("/")
+            if not ip_match(address) or not (length or "32").isdigit() or int(length or 32) > 32:
+                continue
+            length = int(length or 32)
+            ip_key = ip_to_int(address)
+            start = ip_key & masks[length]
+            network = "%s/%d" % (address if start == ip_key else int_to_ip(start), length)
+            rest = fields[1].strip().lstrip(";").strip() if len(fields) > 1 else ""
+            action = rest.split(None, 1)[0].lower() if rest else "reject"
+            if action in ACCESS_ACTIONS:
+                comment = rest[len(action):].strip()
+            else:
+                action, comment = "reject", rest
+            networks.append(AccessNetwork(network, start, start | (~masks[length] & 0xffffffff),
+                                          action, comment))
+    return networks
+
+
+class CidrIndex(object):
+    """Find the network of an access table matching each client
+
+    The networks are flattened into sorted disjoint ranges: starts holds
+    the first IP of each range and owners the index of its network in
+    networks, or -1 between the networks. A lookup is a binary search of
+    the starts, 19 steps for 500,000 ranges. Like Postfix, the first
+    network of the table matching an IP wins over the networks after it.
+    """
+    def __init__(self, networks):
+        self.networks = networks
+        self.starts = array("I", [0])
+        self.owners = array("i", [-1])
+        # CIDR networks are nested or disjoint: the sweep keeps the stack
+        # of the networks containing the current one, with their owner, the
+        # largest of the networks starting at the same IP comes first
+        stack = []
+        for start, last, index in sorted((network.start, -network.end, index)
+                                         for index, network in enumerate(networks)):
+            while stack and stack[-1][0] < start:
+                end = stack.pop()[0]
+                self.cut(end + 1, stack[-1][1] if stack else -1)
+            owner = min(index, stack[-1][1]) if stack else index
+            self.cut(start, owner)
+            stack.append((-last, owner))
+        while stack:
+            end = stack.pop()[0]
+            if end < 0xffffffff:
+                self.cut(end + 1, stack[-1][1] if stack else -1)
+        self.numpy_starts = None
+        if numpy is not None:
+            self.numpy_starts = numpy.frombuffer(self.starts, dtype=numpy.uint32)
+
+    def cut(self, start, owner):
+        """Start a range of owner at start, merged with the previous one"""
+        if self.starts[-1] == start:
+            self.starts.pop()
+            self.owners.pop()
+        if self.owners and self.owners[-1] == owner:
+            return
+        self.starts.append(start)
+        self.owners.append(owner)
+
+    def lookup(self, ip_key):
+        """Return the AccessNetwork matching ip_key, or None"""
+        owner = self.owners[bisect_right(self.starts, ip_key) - 1]
+        return self.networks[owner] if owner >= 0 else None
+
+    def match(self, ip_keys):
+        """Return the index in networks matching each ip_keys, or -1
+
+        The keys are searched at once with NumPy when it is installed.
+        """
+        if self.numpy_starts is not None:
+            ranges = numpy.searchsorted(self.numpy_starts,
+                                        numpy.fromiter(ip_keys, dtype=numpy.uint32),
+                                        side="right") - 1
+            return numpy.frombuffer(self.owners, dtype=numpy.int32)[ranges].tolist()
+        starts = self.starts
+        owners = self.owners
+        return [owners[bisect_right(starts, ip_key) - 1] for ip_key in ip_keys]
+
+    def covering(self, ip_key):
+        """Return the AccessNetwork containing the --prefix network of ip_key"""
+        network = self.lookup(ip_key)
+        if network is None or network.end < ip_key | (~PREFIX_MASK & 0xffffffff):
+            return None
+        return network
+
+
+def load_access(cidr_files):
+    """Return the CidrIndex of the networks of the --cidr files, in order"""
+    networks = []
+    for cidr_file in cidr_files:
+        networks.extend(read_networks(cidr_file))
+    return CidrIndex(networks)
+
+
+def log_magic(log_file):
+    """Return the compression of log_file from its magic bytes, or None"""
+    with open(log_file, "rb") as maillog:
+        magic = maillog.read(6)
+    for compression, prefix in LOG_MAGICS:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def open_log(log_file):
+    """Open log_file for binary reading, decompressing it on the fly"""
+    compression = log_magic(log_file)
+    if compression == "gzip":
+        return gzip_open(log_file, "rb")
+    if compression == "bzip2":
+        return BZ2File(log_file)
+    if compression == "xz":
+        return LZMAFile(log_file)
+    if compression == "zstd":
         try:
-            find_module("GeoIP")
-            print("Using GeoIP module to open Geolocation ")
-            import GeoIP
-            GI = GeoIP.open(GEOFILE, GeoIP.GEOIP_MEMORY_CACHE)
+            from zstandard import ZstdDecompressor
         except ImportError:
-            print("ERROR: Could not import pygeoip or GeoIP modules for Geolocation!")
-            print("Install one/both modules or re-run without --geofile option.")
-            exit()
-    print("MaxMind GeoLite City database file ", GEOFILE)
+            raise IOError("the zstandard module is required to read " + log_file)
+        # the zstandard reader has no readlines(), the buffer adds it
+        return BufferedReader(ZstdDecompressor().stream_reader(open(log_file, "rb"),
+                                                               closefd=True), READ_BLOCK_SIZE)
+    return open(log_file, "rb")
+
+
+def postscreen_lines(maillog, counters=None):
+    """Yield the decoded postscreen lines of the binary file maillog
+
+    The file is read in large blocks and the lines are filtered on their
+    bytes, only the postscreen lines matching IP_FILTER are decoded.
+    """
+    ip_filter = IP_FILTER.encode()
+    while True:
+        lines = maillog.readlines(READ_BLOCK_SIZE)
+        if not lines:
+            break
+        if counters is not None:
+            counters["lines read"] += len(lines)
+            counters["bytes read"] += sum(map(len, lines))
+        for line in lines:
+            if b"/postscreen[" in line and ip_filter in line:
+                yield line.decode("utf-8", "replace")
+
+
+def mapped_lines(log_file, start=0, end=None, counters=None):
+    """Yield the postscreen lines of the plain log_file starting in [start, end)
+
+    The file is memory-mapped and searched for the postscreen tag, or for
+    the -i IP when given, so the other lines are never copied nor decoded.
+    counters adds up the lines and bytes of [start, end), the lines are
+    counted by block once the postscreen lines are found.
+    """
+    with open(log_file, "rb") as maillog:
+        size = fstat(maillog.fileno()).st_size
+        if end is None or end > size:
+            end = size
+        if start >= end:
+            return
+        log_map = mmap(maillog.fileno(), 0, access=ACCESS_READ)
+    # search for the rarest pattern, and check the other one in the line
+    anchor = scan_anchor()
+    other = b"/postscreen[" if IP_FILTER.strip() else b""
+    find = log_map.find
+    rfind = log_map.rfind
+    try:
+        line_end = 0
+        position = find(anchor, start)
+        while position >= 0:
+            # the previous line end bounds the search of the line start
+            line_start = rfind(b"\n", line_end, position) + 1 or line_end
+            if line_start >= end:
+                break
+            line_end = find(b"\n", position) + 1 or size
+            # a line running over start belongs to the previous chunk
+            if line_start >= start:
+                line = log_map[line_start:line_end]
+                if other in line:
+                    yield line.decode("utf-8", "replace")
+            position = find(anchor, line_end)
+        if counters is not None:
+            lines_read = 0
+            for block in range(start, end, READ_BLOCK_SIZE):
+                lines_read += log_map[block:min(block + READ_BLOCK_SIZE, end)].count(b"\n")
+            # a last line without its newline
+            if end == size and log_map[end - 1:end] != b"\n":
+                lines_read += 1
+            counters["lines read"] += lines_read
+            counters["bytes read"] += end - start
+            counters["memory-mapped chunks"] += 1
+    finally:
+        log_map.close()
+
+
+def scan_anchor():
+    """Return the rarest bytes of the wanted lines, the -i IP if given"""
+    if IP_FILTER.strip():
+        return IP_FILTER.encode()
+    return b"/postscreen["
+
+
+def is_sparse(log_file):
+    """Return True if few lines of the plain log_file are wanted
+
+    A sample from the start of the file tells if jumping from match to
+    match in a memory map beats reading all the lines.
+    """
+    with open(log_file, "rb") as maillog:
+        sample = maillog.read(READ_BLOCK_SIZE)
+    return sample.count(scan_anchor()) * SPARSE_RATIO < sample.count(b"\n")
+
+
+def read_chunk(log_file, start, end, counters=None):
+    """Yield the postscreen lines of log_file starting in [start, end)
+
+    An end of None reads the whole file. A compressed or special file is
+    streamed, a plain file is memory-mapped when the lines are sparse.
+    counters adds up the lines and bytes of the lines starting in the
+    chunk, so the chunks of a file add up to the whole file.
+    """
+    if end is None and (log_magic(log_file) or not isfile(log_file)):
+        with open_log(log_file) as maillog:
+            for line in postscreen_lines(maillog, counters):
+                yield line
+        return
+    if is_sparse(log_file):
+        for line in mapped_lines(log_file, start, end, counters):
+            yield line
+        return
+    ip_filter = IP_FILTER.encode()
+    with open(log_file, "rb") as maillog:
+        if end is None:
+            end = fstat(maillog.fileno()).st_size
+        position = start
+        if start > 0:
+            # the line running over start belongs to the previous chunk
+            maillog.seek(start - 1)
+            position += len(maillog.readline()) - 1
+        first_line = position
+        lines_read = 0
+        for lines_read, line in enumerate(maillog, 1):
+            if position >= end:
+                lines_read -= 1
+                break
+            position += len(line)
+            if b"/postscreen[" in line and ip_filter in line:
+                yield line.decode("utf-8", "replace")
+    if counters is not None:
+        counters["lines read"] += lines_read
+        counters["bytes read"] += position - first_line
+
+
+def parse_chunk(chunk):
+    """Parse a (log file, start, end) chunk in a worker process"""
+    ip_list = {}
+    counters = defaultdict(int)
+    parse_lines(read_chunk(*chunk, counters=counters), ip_list, partial=True,
+                counters=counters)
+    return ip_list, counters
+
+
+def log_chunks(log_file, jobs, start=0, end=None):
+    """Split log_file in (log file, start, end) chunks for jobs workers
+
+    A compressed file cannot be split, it is a single chunk.
+    """
+    if log_magic(log_file):
+        return [(log_file, 0, None)]
+    if end is None:
+        end = getsize(log_file)
+    # a few chunks per worker to keep all of them busy until the end
+    chunk_size = max((end - start) // (jobs * 4) + 1, 1 << 20)
+    return [(log_file, chunk_start, min(chunk_start + chunk_size, end))
+            for chunk_start in range(start, end, chunk_size)]
+
+
+def parse_parallel(chunks, ip_list, jobs, counters=None):
+    """Parse the log chunks with jobs worker processes into ip_list"""
+    # the workers rely on fork to inherit the command line settings
+    pool = get_context("fork").Pool(jobs)
+    try:
+        # the chunks are merged in the order of the log
+        for chunk_list, chunk_counters in pool.imap(parse_chunk, chunks):
+            for current_ip, part in chunk_list.items():
+                merge_partial(ip_list, current_ip, part)
+            if counters is not None:
+                for counter, count in chunk_counters.items():
+                    counters[counter] += count
+    finally:
+        pool.close()
+        pool.join()
+
+
+def expand_log_files(patterns):
+    """Return the log files matching patterns, oldest first
+
+    The rotated logs are ordered on their modification time, so the first
+    and last seen dates and the reconnection delays span the rotations.
+    """
+    log_files = []
+    for pattern in patterns:
+        matches = glob(pattern)
+        # keep an unmatched name for the "Cannot open maillog" error
+        for log_file in matches or [pattern]:
+            if log_file not in log_files:
+                log_files.append(log_file)
+    try:
+        return sorted(log_files, key=getmtime)
+    except OSError:
+        return log_files
+
+
+def complete_lines_end(log_file):
+    """Return the offset following the last complete line of log_file"""
+    with open(log_file, "rb") as maillog:
+        end = maillog.seek(0, SEEK_END)
+        while end > 0:
+            start = max(end - (1 << 16), 0)
+            maillog.seek(start)
+            newline = maillog.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def resume_ranges(log_file, checkpoint):
+    """Return the (log file, start, end) ranges logged since checkpoint
+
+    The checkpoint is the (inode, offset) of the log file at the end of the
+    previous run. When the inode changed, the log was rotated and the end
+    of the previous file is read first if a rotated copy is still around.
+    The checkpoint following the ranges is returned along with them.
+    """
+    inode = os_stat(log_file).st_ino
+    ranges = []
+    start = 0
+    if checkpoint is not None:
+        if checkpoint[0] == inode:
+            # restart from the beginning if the log was truncated
+            if checkpoint[1] <= getsize(log_file):
+                start = checkpoint[1]
+        else:
+            for rotated in sorted(glob(escape_glob(log_file) + "?*")):
+                if os_stat(rotated).st_ino == checkpoint[0]:
+                    ranges.append((rotated, checkpoint[1],
+                                   complete_lines_end(rotated)))
+                    break
+    end = complete_lines_end(log_file)
+    ranges.append((log_file, start, end))
+    return ([log_range for log_range in ranges if log_range[1] < log_range[2]],
+            (inode, end))
+
+
+def load_state(state_file, ip_list):
+    """Load the clients saved by save_state() into ip_list
+
+    Return the (inode, offset) checkpoint of the log file, or None when
+    there is no state file yet, or when it is truncated or corrupted and
+    the log is parsed again from its start.
+    """
+    try:
+        with gzip_open(state_file, "rb") as state:
+            saved = pickle_load(state)
+    except FileNotFoundError:
+        return None
+    except (IOError, EOFError, ValueError, UnpicklingError, zlib_error) as error:
+        print("Cannot read the state file", state_file, "(%s), parsing the log from its start" % error)
+        return None
+    if saved.get("version") != STATE_VERSION:
+        print("ERROR: Unknown state file version, remove", state_file)
+        exit(1)
+    for current_ip, saved_client in saved["clients"].items():
+        client = ip_list[current_ip] = ClientStat()
+        (client.first_seen, client.last_seen, client.connect,
+         client.reco_delay, actions, client.dnsbl_ranks) = saved_client
+        client.actions = array("I")
+        client.actions.frombytes(actions)
+        client.update_mask()
+    return saved["checkpoint"]
+
+
+def save_state(state_file, ip_list, checkpoint):
+    """Save the clients of ip_list and the log file checkpoint"""
+    saved = {
+        "version": STATE_VERSION,
+        "checkpoint": checkpoint,
+        "clients": dict(
+            (current_ip, (client.first_seen, client.last_seen, client.connect,
+                          client.reco_delay, client.actions.tobytes(),
+                          client.dnsbl_ranks))
+            for current_ip, client in ip_list.items())}
+    # write aside and rename, a crash never leaves a truncated state file
+    with gzip_open(state_file + ".tmp", "wb", compresslevel=1) as state:
+        pickle_dump(saved, state, HIGHEST_PROTOCOL)
+    replace(state_file + ".tmp", state_file)
+
+
+def summary_columns(clients, actions):
+    """Return the compressed columns of a block of (ip_key, client)
+
+    The IPs are sorted and stored as deltas, the last seen date as the
+    span since the first seen date (negative in out of order logs), the
+    graylist delay in milliseconds or SUMMARY_NO_DELAY and the DNSBL ranks
+    as (rank, count) pairs after their count by client.
+    """
+    columns = [array(typecode) for typecode in SUMMARY_TYPECODES]
+    keys, first_seen, seen_span, connect, reco_delay = columns
+    action_columns = [array("I") for _ in actions]
+    rank_pairs, ranks, rank_counts = array("I"), array("I"), array("I")
+    previous = 0
+    for ip_key, client in clients:
+        keys.append(ip_key - previous)
+        previous = ip_key
+        first_seen.append(int(client.first_seen))
+        seen_span.append(int(client.last_seen - client.first_seen))
+        connect.append(client.connect)
+        reco_delay.append(SUMMARY_NO_DELAY if client.reco_delay is None
+                          else int(round(client.reco_delay * 1000)))
+        for column, count in zip(action_columns, client.actions):
+            column.append(count)
+        dnsbl_ranks = client.dnsbl_ranks or {}
+        rank_pairs.append(len(dnsbl_ranks))
+        for rank, count in dnsbl_ranks.items():
+            ranks.append(rank)
+            rank_counts.append(count)
+    columns += action_columns + [rank_pairs, ranks, rank_counts]
+    if byteorder == "big":
+        for column in columns:
+            column.byteswap()
+    return compress(b"".join(column.tobytes() for column in columns), SUMMARY_COMPRESSION)
+
+
+def summary_arrays(data, offset, typecodes, length):
+    """Return the arrays of length values of each typecode in a summary block
+
+    The arrays start at offset of data, the offset following them is
+    returned with them.
+    """
+    arrays = []
+    for typecode in typecodes:
+        values = array(typecode)
+        end = offset + length * values.itemsize
+        values.frombytes(data[offset:end])
+        if byteorder == "big":
+            values.byteswap()
+        arrays.append(values)
+        offset = end
+    return arrays, offset
+
+
+def write_summary(summary_file, clients, metadata):
+    """Write the (ip_key, client) sorted on ip_key to a summary file
+
+    The file starts with SUMMARY_MAGIC, the format version and the JSON
+    metadata, then the clients follow in blocks of SUMMARY_BLOCK_SIZE,
+    each one a header (clients, bytes) and its compressed columns, see
+    summary_columns(). A block of 0 clients ends the file. The clients
+    may be a stream, only one block is kept in memory. The file is written
+    aside and renamed, the count of clients written is returned.
+    """
+    meta = compress(json_dumps(metadata, sort_keys=True).encode())
+    written = 0
+    with open(summary_file + ".tmp", "wb") as summary:
+        summary.write(SUMMARY_MAGIC + SUMMARY_HEADER.pack(SUMMARY_VERSION, len(meta)) + meta)
+        block = []
+        for ip_client in chain(clients, [None]):
+            if ip_client is not None:
+                block.append(ip_client)
+                if len(block) < SUMMARY_BLOCK_SIZE:
+                    continue
+            if block:
+                columns = summary_columns(block, metadata["actions"])
+                summary.write(SUMMARY_HEADER.pack(len(block), len(columns)) + columns)
+                written += len(block)
+                block = []
+        summary.write(SUMMARY_HEADER.pack(0, 0))
+    replace(summary_file + ".tmp", summary_file)
+    return written
+
+
+def read_summary(summary_file):
+    """Return the metadata and an iterator of the (ip_key, client) of a summary
+
+    The clients are read block by block as they are iterated, in the
+    order of their IP. The actions unknown to this version are ignored.
+    """
+    summary = open(summary_file, "rb")
+    magic = summary.read(len(SUMMARY_MAGIC))
+    if magic != SUMMARY_MAGIC:
+        summary.close()
+        raise IOError("not a postscreen_stats.py summary: " + summary_file)
+    version, meta_size = SUMMARY_HEADER.unpack(summary.read(SUMMARY_HEADER.size))
+    if version > SUMMARY_VERSION:
+        summary.close()
+        raise IOError("summary format %d is newer than this version: %s" % (
+            version, summary_file))
+    metadata = json_loads(decompress(summary.read(meta_size)).decode())
+    action_indexes = [ACTION_INDEX.get(action) for action in metadata["actions"]]
+
+    def clients():
+        with summary:
+            while True:
+                header = summary.read(SUMMARY_HEADER.size)
+                if len(header) < SUMMARY_HEADER.size:
+                    raise IOError("truncated summary: " + summary_file)
+                size, compressed = SUMMARY_HEADER.unpack(header)
+                if not size:
+                    return
+                try:
+                    data = memoryview(decompress(summary.read(compressed)))
+                except zlib_error:
+                    raise IOError("corrupted summary: " + summary_file)
+                columns, offset = summary_arrays(data, 0, SUMMARY_TYPECODES, size)
+                keys, first_seen, seen_span, connect, reco_delay = columns
+                action_columns, offset = summary_arrays(
+                    data, offset, "I" * (len(action_indexes) + 1), size)
+                rank_pairs = action_columns.pop()
+                (ranks, rank_counts), offset = summary_arrays(data, offset, "II",
+                                                              sum(rank_pairs))
+                ip_key = 0
+                pair = 0
+                for row, counts in enumerate(zip(*action_columns)):
+                    ip_key += keys[row]
+                    client = ClientStat()
+                    # the dates are whole seconds, kept as float like the parser does
+                    client.first_seen = float(first_seen[row])
+                    client.last_seen = float(first_seen[row] + seen_span[row])
+                    client.connect = connect[row]
+                    if reco_delay[row] != SUMMARY_NO_DELAY:
+                        client.reco_delay = reco_delay[row] / 1000.0
+                    for action, count in zip(action_indexes, counts):
+                        if count and action is not None:
+                            client.actions[action] = count
+                            client.mask |= 1 << action
+                    if rank_pairs[row]:
+                        client.dnsbl_ranks = dict(zip(ranks[pair:pair + rank_pairs[row]],
+                                                      rank_counts[pair:pair + rank_pairs[row]]))
+                        pair += rank_pairs[row]
+                    yield ip_key, client
+
+    return metadata, clients()
+
+
+def merge_clients(client, other):
+    """Add the statistics of the same client seen by another relay
+
+    The first seen date is the earliest one and the last seen date the
+    latest one, the graylist delay is the one of the relay which saw the
+    client first.
+    """
+    if other.reco_delay is not None and (client.reco_delay is None or
+                                         other.first_seen < client.first_seen):
+        client.reco_delay = other.reco_delay
+    client.first_seen = min(client.first_seen, other.first_seen)
+    client.last_seen = max(client.last_seen, other.last_seen)
+    client.connect += other.connect
+    for action, count in enumerate(other.actions):
+        if count:
+            client.actions[action] += count
+    client.mask |= other.mask
+    if other.dnsbl_ranks is not None:
+        client.add_ranks(other.dnsbl_ranks)
+
+
+def merge_summaries(summary_files):
+    """Return the merged metadata and an iterator of the merged clients
+
+    The summaries are merged in one pass on the order of their IPs, like
+    sorted runs: only a block of each summary is in memory at a time. The
+    counters and the latency sketches of the metadata are added up.
+    """
+    summaries = [read_summary(summary_file) for summary_file in summary_files]
+    prefixes = set(metadata["prefix"] for metadata, _ in summaries)
+    if len(prefixes) > 1:
+        raise IOError("the summaries roll up the clients to different --prefix lengths: " +
+                      ", ".join(str(prefix) for prefix in sorted(prefixes)))
+    sessions = None
+    counters = defaultdict(int)
+    for metadata, _ in summaries:
+        for counter, count in metadata["counters"].items():
+            counters[counter] += count
+        if metadata.get("latency") is not None:
+            if sessions is None:
+                sessions = SessionTracker()
+            sessions.add_record(metadata["latency"])
+    merged = {
+        "actions": list(ACTIONS),
+        "counters": counters,
+        "hosts": sorted(set(host for metadata, _ in summaries for host in metadata["hosts"])),
+        "latency": sessions.record() if sessions is not None else None,
+        "prefix": prefixes.pop() if prefixes else PREFIX_LEN,
+    }
 
-try:
-    MAILLOG = open(LOG_FILE)
-except IOError as ioe:
-    print("Cannot open maillog! ", ioe)
-    exit(1)
-else:
-    for line in MAILLOG:
-        # Get postscreen logs only
-        if "/postscreen[" in line:
-            # apply the user defined IP filter
-            if IP_FILTER in line:
-                # parse the log line
-                line_fields = line.split(None, LOG_CURSOR + 1)
-
-                # parse the ip
-                current_ip = '999.999.999.999'
-                if search(IP_REGEXP, line_fields[LOG_CURSOR + 1]):
-                    t = split(IP_REGEXP, line_fields[LOG_CURSOR + 1], maxsplit=1)
-                    current_ip = t[1]
-                    del t
-
-                if match("^CONNECT$", line_fields[LOG_CURSOR]):
-                    if RFC3339:
-                        syslog_date = line_fields[0]
-                    else:
-                        syslog_date = line_fields[0] + " " + line_fields[1] + \
-                            " " + line_fields[2]
-
-                    # first time we see the client, initiate a class instance
-                    # store in in the client_list dictionary
-                    if current_ip not in IP_LIST:
-                        IP_LIST[current_ip] = ClientStat()
-                        IP_LIST[current_ip].logs["FIRST SEEN"] = \
-                            gen_unix_ts(syslog_date)
-                        IP_LIST[current_ip].logs["LAST SEEN"] = \
-                            gen_unix_ts(syslog_date)
-                        # perform Geolocation
-                        if GEOFILE not in "":
-                            IP_LIST[current_ip].geoloc = GI.record_by_addr(current_ip)
-
-                    # ip is already known, update the last_seen timestamp
-                    else:
-                        IP_LIST[current_ip].logs["LAST SEEN"] = \
-                            gen_unix_ts(syslog_date)
-
-                    IP_LIST[current_ip].logs["CONNECT"] += 1
-
-                # client must be initialized to continue
-                # the string matching is organized to test the most probable
-                # value first, to speed things up
-                elif current_ip in IP_LIST:
-                    if match("^PASS$", line_fields[LOG_CURSOR]):
-                        if search("^OLD", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["PASS OLD"] += 1
-
-                            # if the connection count is 2, and the IP has already
-                            # been rejected with a code 450 calculate the
-                            # reconnection delay
-                            if (IP_LIST[current_ip].logs["CONNECT"] == 2 and
-                                    IP_LIST[current_ip].actions["NOQUEUE 450 deep protocol test reconnection"] > 0):
-                                IP_LIST[current_ip].logs["RECO. DELAY (graylist)"] = \
-                                    IP_LIST[current_ip].logs["LAST SEEN"] - \
-                                    IP_LIST[current_ip].logs["FIRST SEEN"]
-
-                        elif search("^NEW", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["PASS NEW"] += 1
-
-                    elif match("^NOQUEUE:$", line_fields[LOG_CURSOR]):
-                        if search("too many connections", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["NOQUEUE too many connections"] += 1
-                        elif search("all server ports busy", line_fields[LOG_CURSOR]):
-                            IP_LIST[current_ip].actions["NOQUEUE all server ports busy"] += 1
-                        elif search("450 4.3.2 Service currently unavailable", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["NOQUEUE 450 deep protocol test reconnection"] += 1
-
-                    elif match("^HANGUP$", line_fields[LOG_CURSOR]):
-                        IP_LIST[current_ip].actions["HANGUP"] += 1
-
-                    elif match("^DNSBL$", line_fields[LOG_CURSOR]):
-                        IP_LIST[current_ip].actions["DNSBL"] += 1
-                        # store the rank
-                        rank_line = line_fields[LOG_CURSOR + 1].split(None)
-                        IP_LIST[current_ip].dnsbl_ranks.append(rank_line[1])
-
-                    elif match("^PREGREET$", line_fields[LOG_CURSOR]):
-                        IP_LIST[current_ip].actions["PREGREET"] += 1
-
-                    elif match("^COMMAND$", line_fields[LOG_CURSOR]):
-                        if search("^PIPELINING", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["COMMAND PIPELINING"] += 1
-
-                        elif search("^TIME LIMIT", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["COMMAND TIME LIMIT"] += 1
-
-                        elif search("^COUNT LIMIT", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["COMMAND COUNT LIMIT"] += 1
-
-                        elif search("^LENGTH LIMIT", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["COMMAND LENGTH LIMIT"] += 1
-
-                    elif match("^WHITELISTED$", line_fields[LOG_CURSOR]):
-                        IP_LIST[current_ip].actions["WHITELISTED"] += 1
-
-                    elif match("^BLACKLISTED$", line_fields[LOG_CURSOR]):
-                        IP_LIST[current_ip].actions["BLACKLISTED"] += 1
-
-                    elif match("^BARE$", line_fields[LOG_CURSOR]):
-                        if search("^NEWLINE", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["BARE NEWLINE"] += 1
-
-                    elif match("^NON-SMTP$", line_fields[LOG_CURSOR]):
-                        if search("^COMMAND", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["NON-SMTP COMMAND"] += 1
-
-                    elif match("^WHITELIST$", line_fields[LOG_CURSOR]):
-                        if search("^VETO", line_fields[LOG_CURSOR + 1]):
-                            IP_LIST[current_ip].actions["WHITELIST VETO"] += 1
-
-    # done with the log file
-    MAILLOG.close()
-
-
-# additional reports shown in full mode only
-if REPORT_MODE in ('full', 'ip'):
-    for client in IP_LIST:
-        print(client)
-        for log in sorted(IP_LIST[client].logs):
-            if log in ('FIRST SEEN', 'LAST SEEN'):
-                print("\t", log, ":", dt.fromtimestamp(int(
-                    IP_LIST[client].logs[log])).strftime('%Y-%m-%d %H:%M:%S'))
-            else:
-                print("\t", log, ":", IP_LIST[client].logs[log])
-        print("\t--- postscreen actions ---")
-        for action in sorted(IP_LIST[client].actions):
-            print("\t", action, ":", IP_LIST[client].actions[action])
-            if action in 'DNSBL':
-                print("\tDNSBL ranks:", IP_LIST[client].dnsbl_ranks)
-        if GEOFILE not in "":
-            print("\tGeoLoc:", IP_LIST[client].geoloc)
-        print("")
+    def clients():
+        current_ip, client = None, None
+        for ip_key, other in heap_merge(*[stream for _, stream in summaries],
+                                        key=itemgetter(0)):
+            if ip_key == current_ip:
+                merge_clients(client, other)
+                continue
+            if client is not None:
+                yield current_ip, client
+            current_ip, client = ip_key, other
+        if client is not None:
+            yield current_ip, client
+
+    return merged, clients()
+
+
+def summary_metadata(sessions=None):
+    """Return the metadata of the summary of this run"""
+    return {
+        "actions": list(ACTIONS),
+        "counters": dict(PARSE_COUNTERS),
+        "hosts": [gethostname()],
+        "latency": sessions.record() if sessions is not None else None,
+        "prefix": PREFIX_LEN,
+    }
 
 
-# store the list of blocked clients for map generation
-if MAPDEST not in "" and GEOFILE not in "":
-    BLOCKED_CLIENTS = defaultdict(int)
+def comeback_bucket(delay):
+    """Return the COMEBACK bucket of a graylist reconnection delay"""
+    return COMEBACK_BUCKETS[bisect_left(COMEBACK_EDGES, delay)]
 
-POSTSCREEN_STATS = defaultdict(int)
-CLIENTS = defaultdict(int)
-COMEBACK = {'<10s': 0, '10s to 30s': 0, '>30s to 1min': 0, '>1min to 5min': 0,
-            '>5 min to 30min': 0, '>30min to 2h': 0, '>2h to 5h': 0,
-            '>5h to 12h': 0, '>12h to 24h': 0, '>24h': 0}
-BLOCKED_COUNTRIES = defaultdict(int)
 
+class LatencySketch(object):
+    """Mergeable histogram of durations in logarithmic buckets
 
-# normal report mode
-if REPORT_MODE in ('short', 'full', 'none'):
-    # basic accounting, browse through the list of objects and count
-    # the occurences
-    for client in IP_LIST:
+    A duration is counted in the bucket of its logarithm in base
+    LATENCY_GAMMA, so a quantile is within LATENCY_GAMMA - 1 of the true
+    duration whatever the count of durations, and the buckets are only
+    as many as the orders of magnitude of the durations. The durations
+    under LATENCY_MIN are counted in bucket 0. Two sketches are merged
+    by adding their buckets.
+    """
+    __slots__ = ("buckets", "count", "maximum")
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.maximum = 0.0
+
+    def add(self, duration):
+        """Count a duration in seconds"""
+        bucket = 0
+        if duration > LATENCY_MIN:
+            bucket = int(ceil(math_log(duration / LATENCY_MIN) * LATENCY_SCALE))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if duration > self.maximum:
+            self.maximum = duration
+
+    def merge(self, other):
+        """Add the durations of another LatencySketch"""
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, fraction):
+        """Return the duration below which fraction of the durations are"""
+        rank = fraction * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                if bucket == 0:
+                    return 0.0
+                # the middle of the bucket, in relative error
+                upper = LATENCY_MIN * LATENCY_GAMMA ** bucket
+                return min(2 * upper / (LATENCY_GAMMA + 1), self.maximum)
+        return self.maximum
+
+
+class SessionTracker(object):
+    """Decision latency of the postscreen sessions and reconnection delays
+
+    watch() passes the log lines through on their way to the parser and
+    pairs the lines of each session on the postscreen PID and the client
+    IP:port. The delay from the CONNECT to each action is counted in the
+    LatencySketch of the action, and at the end of the session the delay
+    to the last action, the decision, in the sketch of all the sessions
+    and of the hour of the CONNECT. A session ends at its DISCONNECT, or
+    at one of the DECISION_ACTIONS after which postscreen hands the
+    connection to smtpd or drops it without a DISCONNECT. PREGREET and
+    HANGUP log their own delay to the millisecond, the others are timed
+    with the time stamps, to the second with syslog. At most SESSION_LIMIT
+    sessions are open, the oldest ones are forgotten past it, so the
+    memory does not grow with the sessions.
+    """
+    def __init__(self):
+        self.sessions = OrderedDict()  # PID [IP]:port -> [CONNECT, hour, last delay]
+        self.decisions = LatencySketch()
+        self.hours = [LatencySketch() for _ in range(24)]
+        self.actions = defaultdict(LatencySketch)
+        self.reconnections = LatencySketch()
+        self.forgotten = 0
+
+    def watch(self, lines, ip_list):
+        """Yield the lines, tracking the sessions of the postscreen lines
+
+        ip_list are the clients updated by the parser of the lines, the
+        reconnection delay of a CONNECT is taken from the last CONNECT of
+        its client, before the parser counts it.
+        """
+        cursor = LOG_CURSOR
+        rfc3339 = RFC3339
+        ip_filter = IP_FILTER
+        session_search = SESSION_SEARCH
+        action_rules = ACTION_RULES
+        sessions = self.sessions
+        prefix_mask = PREFIX_MASK
+        for line in lines:
+            if "/postscreen[" not in line or ip_filter not in line:
+                yield line
+                continue
+            line_fields = line.split(None, cursor + 1)
+            found = session_search(line_fields[-1]) if len(line_fields) == cursor + 2 else None
+            if found is None:
+                yield line
+                continue
+            token = line_fields[cursor]
+            key = line_fields[cursor - 1] + found.group(0)
+            if token == "DISCONNECT":
+                session = sessions.pop(key, None)
+                if session is not None and session[2] is not None:
+                    self.decide(session[1], session[2])
+                yield line
+                continue
+            if token != "CONNECT" and token not in action_rules:
+                yield line
+                continue
+            if rfc3339:
+                syslog_date = line_fields[0]
+                hour = int(syslog_date[11:13])
+                unix_ts = gen_unix_ts(syslog_date) + fraction_ts(syslog_date)
+            else:
+                syslog_date = line_fields[0] + " " + line_fields[1] + " " + line_fields[2]
+                hour = int(line_fields[2][:2])
+                unix_ts = gen_unix_ts(syslog_date)
+            if token == "CONNECT":
+                client = ip_list.get(unpack_ip(inet_aton(found.group(1)))[0] & prefix_mask)
+                if client is not None and client.connect:
+                    self.reconnections.add(max(int(unix_ts) - client.last_seen, 0))
+                sessions.pop(key, None)
+                sessions[key] = [unix_ts, hour, None]
+                if len(sessions) > SESSION_LIMIT:
+                    sessions.popitem(last=False)
+                    self.forgotten += 1
+                yield line
+                continue
+            session = sessions.get(key)
+            if session is not None:
+                detail = line_fields[-1]
+                for detail_match, action in action_rules[token]:
+                    if detail_match is not None and not detail_match(detail):
+                        continue
+                    after = AFTER_SEARCH(detail) if token in TIMED_TOKENS else None
+                    delay = float(after.group(1)) if after else max(unix_ts - session[0], 0.0)
+                    self.actions[ACTIONS[action]].add(delay)
+                    session[2] = delay
+                    if action in DECISION_ACTIONS:
+                        del sessions[key]
+                        self.decide(session[1], delay)
+                    break
+            yield line
+
+    def decide(self, hour, delay):
+        """Count the decision delay of a session which CONNECTed at hour"""
+        self.decisions.add(delay)
+        self.hours[hour].add(delay)
+
+    def record(self):
+        """Return the sketches as a JSON serializable record"""
+        def sketch_record(sketch):
+            return [sketch.count, sketch.maximum, sorted(sketch.buckets.items())]
+        return {"decisions": sketch_record(self.decisions),
+                "hours": [sketch_record(sketch) for sketch in self.hours],
+                "actions": dict((action, sketch_record(sketch))
+                                for action, sketch in self.actions.items()),
+                "reconnections": sketch_record(self.reconnections),
+                "forgotten": self.forgotten}
+
+    def add_record(self, record):
+        """Add the sketches of a record() to the sketches"""
+        def add_sketch(sketch, sketch_record):
+            other = LatencySketch()
+            other.count, other.maximum = sketch_record[:2]
+            other.buckets = dict(sketch_record[2])
+            sketch.merge(other)
+        add_sketch(self.decisions, record["decisions"])
+        for sketch, sketch_record in zip(self.hours, record["hours"]):
+            add_sketch(sketch, sketch_record)
+        for action, sketch_record in record["actions"].items():
+            add_sketch(self.actions[action], sketch_record)
+        add_sketch(self.reconnections, record["reconnections"])
+        self.forgotten += record["forgotten"]
+
+    def merge(self, other):
+        """Add the sketches of another SessionTracker"""
+        self.decisions.merge(other.decisions)
+        for hour, sketch in zip(self.hours, other.hours):
+            hour.merge(sketch)
+        for action, sketch in other.actions.items():
+            self.actions[action].merge(sketch)
+        self.reconnections.merge(other.reconnections)
+        self.forgotten += other.forgotten
+
+
+def fraction_ts(rfc3339_ts):
+    """Return the fraction of second of an RFC 3339 time stamp, or 0"""
+    if rfc3339_ts[19:20] != ".":
+        return 0.0
+    return float("0" + rfc3339_ts[19:].rstrip("Zz").split("+")[0].split("-")[0])
+
+
+def print_latency(tracker, out=stdout):
+    """Print the quantiles of the sketches of a SessionTracker"""
+    quantiles = [0.5, 0.9, 0.99]
+
+    def print_row(name, sketch):
+        row = " ".join("%9.3f" % sketch.quantile(fraction) for fraction in quantiles)
+        print("%-44s %8d %s %9.3f" % (name, sketch.count, row, sketch.maximum), file=out)
+
+    header = "%-44s %8s %9s %9s %9s %9s" % ("", "count", "p50 s", "p90 s", "p99 s", "max s")
+    print("\n=== Decision latency, from the CONNECT to the last action ===", file=out)
+    print(header, file=out)
+    print_row("all sessions", tracker.decisions)
+    for hour, sketch in enumerate(tracker.hours):
+        if sketch.count:
+            print_row("%02d:00 to %02d:59" % (hour, hour), sketch)
+    print("\n=== Latency of the actions, from the CONNECT ===", file=out)
+    print(header, file=out)
+    for action in sorted(tracker.actions):
+        print_row(action, tracker.actions[action])
+    if tracker.reconnections.count:
+        print("\n=== Reconnection delay, every reconnection ===", file=out)
+        print(header, file=out)
+        print_row("all reconnections", tracker.reconnections)
+    if tracker.forgotten:
+        print(tracker.forgotten, "sessions forgotten over", SESSION_LIMIT,
+              "open sessions", file=out)
+
+
+def parse_duration(duration):
+    """Convert a duration like 90s, 5m, 1h or 7d to seconds"""
+    if duration[-1:] in DURATION_UNITS:
+        return int(duration[:-1]) * DURATION_UNITS[duration[-1]]
+    return int(duration)
+
+
+class RollingWindow(object):
+    """Event counters of the last span seconds, kept in time buckets
+
+    The totals are updated as events are added and old buckets expire, so
+    a report never has to walk through the clients.
+    """
+    def __init__(self, name, span, buckets=60):
+        self.name = name
+        self.span = span
+        self.width = max(span // buckets, 1)
+        self.buckets = deque()  # (bucket start, counters) oldest first
+        self.totals = defaultdict(int)
+
+    def add(self, unix_ts, event, count=1):
+        """Count an event logged at unix_ts"""
+        start = unix_ts - unix_ts % self.width
+        if not self.buckets or start > self.buckets[-1][0]:
+            self.buckets.append((start, defaultdict(int)))
+            self.expire(unix_ts)
+        # a late event is counted in the latest bucket
+        self.buckets[-1][1][event] += count
+        self.totals[event] += count
+
+    def expire(self, now_ts):
+        """Drop the buckets which are entirely older than the span"""
+        limit = now_ts - self.span
+        while self.buckets and self.buckets[0][0] + self.width <= limit:
+            for event, count in self.buckets.popleft()[1].items():
+                self.totals[event] -= count
+
+    def report(self):
+        """Print the statistics of the window"""
+        totals = self.totals
+        print("\n=== last", self.name, "===")
+        print(str(totals["new clients"]) + "/" + str(totals["CONNECT"]),
+              "new clients/CONNECT")
+        for action in sorted(totals):
+            if action in ACTION_NAMES and totals[action] > 0:
+                print(totals[action], action)
+        if totals["DNSBL"] > 0:
+            print("%.1f avg. dnsbl rank" %
+                  (float(totals["dnsbl ranks"]) / totals["DNSBL"]))
+        if totals["reconnections"] > 0:
+            print("%d seconds avg. reco. delay over %d reconnections" % (
+                totals["seconds reco. delay"] / totals["reconnections"],
+                totals["reconnections"]))
+            print(" | ".join(bucket + " " + str(totals[bucket])
+                             for bucket in COMEBACK_BUCKETS))
+
+
+def tail_lines(log_file, start=None):
+    """Yield the lists of lines appended to log_file like tail -F, forever
+
+    The log is read from start, or from its end by default, then the new
+    files created by the log rotation are read from their beginning. An
+    empty list is yielded every second while the log is idle.
+    """
+    global NOW_TS  # pylint: disable=global-statement
+    maillog = None
+    pending = b""
+    while True:
+        if maillog is None:
+            try:
+                maillog = open(log_file, "rb")
+            except IOError:
+                sleep(1)
+                continue
+            if start is None:
+                maillog.seek(0, SEEK_END)
+            else:
+                maillog.seek(start)
+            start = 0
+        data = maillog.read(1 << 20)
+        if data:
+            data = pending + data
+            cut = data.rfind(b"\n") + 1
+            pending = data[cut:]
+            # the log is live, a time stamp up to now is not in the future
+            NOW_TS = time() + 60
+            yield data[:cut].decode("utf-8", "replace").split("\n")
+            continue
+        try:
+            log_stat = os_stat(log_file)
+        except OSError:
+            log_stat = None
+        # reopen the log when it was rotated or truncated
+        if log_stat is None or \
+                log_stat.st_ino != fstat(maillog.fileno()).st_ino or \
+                log_stat.st_size < maillog.tell():
+            maillog.close()
+            maillog = None
+            pending = b""
+        sleep(1)
+        yield []
+
+
+def follow_log(log_file, ip_list, windows):
+    """Parse the lines appended to log_file like tail -F, forever
+
+    The statistics of the windows are printed every FOLLOW_INTERVAL
+    seconds. The clients idle for CLIENT_TTL seconds, or the least
+    recently seen ones above MAX_CLIENTS, are evicted from ip_list.
+    """
+    def window_event(syslog_date, current_ip, event, value):
+        """Count a parsed event in the windows"""
+        unix_ts = gen_unix_ts(syslog_date)
+        if event == "CONNECT":
+            # keep ip_list ordered from the least recently seen client
+            ip_list.move_to_end(current_ip)
+            counts = [("CONNECT", 1)]
+            if value:
+                counts.append(("new clients", 1))
+        elif event == "RECO. DELAY (graylist)":
+            # a zero delay is not counted, like in the report
+            if not value:
+                return
+            counts = [("reconnections", 1), ("seconds reco. delay", value),
+                      (comeback_bucket(value), 1)]
+        elif event == "DNSBL":
+            counts = [(event, 1), ("dnsbl ranks", int(value))]
+        else:
+            counts = [(event, 1)]
+        for window in windows:
+            for name, count in counts:
+                window.add(unix_ts, name, count)
+
+    next_report = time() + FOLLOW_INTERVAL
+    for lines in tail_lines(log_file):
+        parse_lines(lines, ip_list, on_event=window_event)
+
+        now_ts = time()
+        while ip_list:
+            oldest = next(iter(ip_list.values()))
+            if len(ip_list) <= MAX_CLIENTS and \
+                    oldest.last_seen > now_ts - CLIENT_TTL:
+                break
+            ip_list.popitem(last=False)
+
+        if now_ts >= next_report:
+            next_report = now_ts + FOLLOW_INTERVAL
+            print("\n=== " + dt.fromtimestamp(now_ts).strftime('%Y-%m-%d %H:%M:%S') +
+                  " - " + str(len(ip_list)) + " clients tracked ===")
+            for window in windows:
+                window.expire(now_ts)
+                window.report()
+            stdout.flush()
+
+
+class MetricsExporter(object):
+    """OpenMetrics counters of the clients of ip_list, kept up to date
+
+    The totals are computed once from the clients, then updated by the
+    events of the new lines, so a snapshot never walks through the
+    clients. The scrapes are answered with the last rendered snapshots.
+    """
+    def __init__(self, ip_list):
+        self.ip_list = ip_list
+        self.totals = defaultdict(int)
+        self.lines_read = 0
+        self.parse_seconds = 0.0
+        # (OpenMetrics, Prometheus text format) snapshots, swapped at once
+        self.snapshots = (b"", b"")
+
+    def count_clients(self):
+        """Compute the totals from the clients parsed so far"""
+        totals = self.totals
+        totals.clear()
+        for client in self.ip_list.values():
+            totals["clients"] += 1
+            totals["CONNECT"] += client.connect
+            for action, count in zip(ACTIONS, client.actions):
+                if count:
+                    totals[action] += count
+                    totals["clients " + action] += 1
+            if client.mask & BLOCKED_MASK:
+                totals["blocked clients"] += 1
+            if client.dnsbl_ranks is not None:
+                for rank, count in client.dnsbl_ranks.items():
+                    totals["dnsbl ranks"] += rank * count
+            if client.reco_delay:
+                self.reconnection(client.reco_delay)
+
+    def reconnection(self, delay):
+        """Count a graylist reconnection delay"""
+        totals = self.totals
+        totals["reconnections"] += 1
+        totals["seconds reco. delay"] += delay
+        totals[comeback_bucket(delay)] += 1
+
+    def event(self, syslog_date, current_ip, event, value):
+        """Count a parsed event, the on_event callback of parse_lines()"""
+        # pylint: disable=unused-argument
+        totals = self.totals
+        if event == "CONNECT":
+            totals["CONNECT"] += 1
+            if value:
+                totals["clients"] += 1
+            return
+        if event == "RECO. DELAY (graylist)":
+            if value:
+                self.reconnection(value)
+            return
+        totals[event] += 1
+        action = ACTION_INDEX[event]
+        client = self.ip_list[current_ip]
+        # the first action of its kind of the client
+        if client.actions[action] == 1:
+            totals["clients " + event] += 1
+            if client.mask & BLOCKED_MASK == 1 << action:
+                totals["blocked clients"] += 1
+        if action == DNSBL:
+            totals["dnsbl ranks"] += int(value)
+
+    def families(self):
+        """Return the (name, type, help, samples) of the metric families"""
+        totals = self.totals
+        comeback = []
+        cumulated = 0
+        for bucket, edge in zip(COMEBACK_BUCKETS, COMEBACK_EDGES + ["+Inf"]):
+            cumulated += totals[bucket]
+            comeback.append(("_bucket", '{le="%s"}' % edge, cumulated))
+        comeback += [("_count", "", totals["reconnections"]),
+                     ("_sum", "", totals["seconds reco. delay"])]
+        return [
+            ("postscreen_connections", "counter", "CONNECT logged by postscreen.",
+             [("_total", "", totals["CONNECT"])]),
+            ("postscreen_actions", "counter", "Postscreen actions logged.",
+             [("_total", '{action="%s"}' % action, totals[action]) for action in ACTIONS]),
+            ("postscreen_clients", "gauge", "Clients which connected to postscreen.",
+             [("", "", totals["clients"])]),
+            ("postscreen_action_clients", "gauge", "Clients with each postscreen action.",
+             [("", '{action="%s"}' % action, totals["clients " + action])
+              for action in ACTIONS]),
+            ("postscreen_blocked_clients", "gauge", "Clients blocked by postscreen at least once.",
+             [("", "", totals["blocked clients"])]),
+            ("postscreen_dnsbl_ranks", "counter", "Sum of the DNSBL ranks of the DNSBL actions.",
+             [("_total", "", totals["dnsbl ranks"])]),
+            ("postscreen_graylist_reconnection_delay_seconds", "histogram",
+             "First reconnection delay of the clients rejected by the deep protocol tests.",
+             comeback),
+            ("postscreen_exporter_lines_read", "counter", "Log lines read by the exporter.",
+             [("_total", "", self.lines_read)]),
+            ("postscreen_exporter_parse_seconds", "counter", "CPU time spent parsing the log.",
+             [("_total", "", round(self.parse_seconds, 6))]),
+            ("postscreen_exporter_snapshot_timestamp_seconds", "gauge",
+             "Time of the snapshot of the metrics.", [("", "", round(time(), 3))])]
+
+    def render(self):
+        """Render the metrics in both formats and swap the snapshots"""
+        families = self.families()
+        self.snapshots = (metrics_text(families, True), metrics_text(families, False))
+
+
+def metrics_text(families, openmetrics):
+    """Return the OpenMetrics or Prometheus text format of the families"""
+    lines = []
+    for name, kind, help_text, samples in families:
+        # the text format names a counter family like its samples
+        family = name + "_total" if kind == "counter" and not openmetrics else name
+        lines.append("# HELP %s %s" % (family, help_text))
+        lines.append("# TYPE %s %s" % (family, kind))
+        for suffix, labels, value in samples:
+            lines.append("%s%s%s %s" % (name, suffix, labels, value))
+    if openmetrics:
+        lines.append("# EOF")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answer the scrapes of /metrics with the snapshot of the exporter"""
+    exporter = None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the snapshot in the format accepted by the scraper"""
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics, text = self.exporter.snapshots
+        if "application/openmetrics-text" in self.headers.get("Accept", ""):
+            body, content_type = openmetrics, OPENMETRICS_TYPE
+        else:
+            body, content_type = text, PROMETHEUS_TYPE
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Do not log the scrapes"""
+
+
+def export_metrics(log_file, address):
+    """Serve the metrics of log_file on [host:]port while following it
+
+    The log is parsed up to its end, with the -j workers, then the new
+    lines are parsed as they are logged and the snapshots are rendered
+    every EXPORTER_INTERVAL seconds. The HTTP server runs in a thread and
+    binds to 127.0.0.1 unless a host is given.
+    """
+    host, _, port = address.rpartition(":")
+    ip_list = {}
+    end = complete_lines_end(log_file)
+    exporter = MetricsExporter(ip_list)
+    # the first snapshot tells the log is being parsed
+    exporter.render()
+    MetricsHandler.exporter = exporter
+    server = HTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+    server_thread = Thread(target=server.serve_forever, name="metrics")
+    server_thread.daemon = True
+    server_thread.start()
+    print("Serving the metrics of", log_file, "at http://%s:%d/metrics" % server.server_address[:2])
+    stdout.flush()
+
+    cpu = process_time()
+    if JOBS > 1:
+        parse_parallel(log_chunks(log_file, JOBS, 0, end), ip_list, JOBS, PARSE_COUNTERS)
+    else:
+        parse_lines(read_chunk(log_file, 0, end, PARSE_COUNTERS), ip_list,
+                    counters=PARSE_COUNTERS)
+    exporter.lines_read = PARSE_COUNTERS["lines read"]
+    exporter.count_clients()
+    exporter.parse_seconds = process_time() - cpu
+    exporter.render()
+
+    next_snapshot = time() + EXPORTER_INTERVAL
+    for lines in tail_lines(log_file, end):
+        if lines:
+            cpu = process_time()
+            parse_lines(lines, ip_list, on_event=exporter.event)
+            exporter.lines_read += len(lines) - 1
+            exporter.parse_seconds += process_time() - cpu
+        if time() >= next_snapshot:
+            next_snapshot = time() + EXPORTER_INTERVAL
+            exporter.render()
+
+
+def compile_filter(ac_filter):
+    """Compile an ACTION_FILTER into a list of (required, forbidden) masks
+
+    The filter matches the clients with all the actions of the required
+    mask and none of the forbidden mask for at least one of the pairs.
+    Actions are combined with & (and), | (or), ! (not) and parentheses.
+    An action which postscreen never logs is never matched.
+    """
+    if ac_filter is None:
+        return None
+    tokens = [token.strip() for token in FILTER_TOKENS.findall(ac_filter)
+              if token.strip()]
+    filter_terms, position = compile_or(tokens, 0)
+    if position != len(tokens):
+        raise ValueError("unexpected " + tokens[position])
+    return filter_terms
+
+
+def compile_or(tokens, position):
+    """Compile the | separated terms of the filter from tokens[position]"""
+    filter_terms, position = compile_and(tokens, position)
+    while position < len(tokens) and tokens[position] == "|":
+        or_terms, position = compile_and(tokens, position + 1)
+        filter_terms = filter_terms + or_terms
+    return filter_terms, position
+
+
+def compile_and(tokens, position):
+    """Compile the & separated factors of the filter from tokens[position]"""
+    filter_terms, position = compile_not(tokens, position)
+    while position < len(tokens) and tokens[position] == "&":
+        and_terms, position = compile_not(tokens, position + 1)
+        filter_terms = and_filters(filter_terms, and_terms)
+    return filter_terms, position
+
+
+def compile_not(tokens, position):
+    """Compile an action, a negation or a parenthesis from tokens[position]"""
+    if position >= len(tokens):
+        raise ValueError("incomplete filter")
+    token = tokens[position]
+    if token == "!":
+        filter_terms, position = compile_not(tokens, position + 1)
+        # !(a | b) = !a & !b and !(a & !b) = !a | b
+        negation = [(0, 0)]
+        for required, forbidden in filter_terms:
+            negation = and_filters(negation, [
+                (0, 1 << action) for action in range(len(ACTIONS)) if required >> action & 1] + [
+                    (1 << action, 0) for action in range(len(ACTIONS)) if forbidden >> action & 1])
+        return negation, position
+    if token == "(":
+        filter_terms, position = compile_or(tokens, position + 1)
+        if position >= len(tokens) or tokens[position] != ")":
+            raise ValueError("missing )")
+        return filter_terms, position + 1
+    if token in "&|)":
+        raise ValueError("unexpected " + token)
+    if token not in ACTION_INDEX:
+        return [], position + 1
+    return [(1 << ACTION_INDEX[token], 0)], position + 1
+
+
+def and_filters(filter_terms, and_terms):
+    """Return the (required, forbidden) masks of both filters combined"""
+    return [(required | and_required, forbidden | and_forbidden)
+            for required, forbidden in filter_terms
+            for and_required, and_forbidden in and_terms
+            if not (required | and_required) & (forbidden | and_forbidden)]
+
+
+def aggregate_clients(ip_list, filter_terms):
+    """Compute the report aggregates of the clients matching filter_terms
+
+    Return the Aggregates (postscreen stats, clients stats, comeback,
+    unique clients, blocked clients):
+    - postscreen stats: {action: count}, with CONNECT
+    - clients stats: {stat: value} of the clients statistics report
+    - comeback: {bucket: count} of the graylist reconnection delays
+    - unique clients: {action: count of clients}, with CONNECT
+    - blocked clients: keys of the clients blocked once, with --geofile
+    """
+    if numpy is not None and ip_list:
+        return aggregate_columns(ip_list, filter_terms)
+    postscreen_stats = defaultdict(int)
+    clients_stats = defaultdict(int)
+    comeback = dict((bucket, 0) for bucket in COMEBACK_BUCKETS)
+    unique_clients = defaultdict(int)
+    geolocate = GEOFILE not in ""
+    blocked_clients = []
+    for current_ip, client in ip_list.items():
         # go to the next client if this one doesn't match the action filter
-        if not IP_LIST[client].action_filter(ACTION_FILTER):
+        if not client.action_filter(filter_terms):
             continue
 
-        CLIENTS["clients"] += 1
+        clients_stats["clients"] += 1
+        if client.connect > 0:
+            postscreen_stats["CONNECT"] += client.connect
+            unique_clients["CONNECT"] += 1
         # calculate the average reconnection delay (graylist)
-        if IP_LIST[client].logs["RECO. DELAY (graylist)"] > 0:
-            CLIENTS["reconnections"] += 1
-            CLIENTS["seconds avg. reco. delay"] += \
-                IP_LIST[client].logs["RECO. DELAY (graylist)"]
-            if IP_LIST[client].logs["RECO. DELAY (graylist)"] < 10:
-                COMEBACK['<10s'] += 1
-            elif 10 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 30:
-                COMEBACK['10s to 30s'] += 1
-            elif 30 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 60:
-                COMEBACK['>30s to 1min'] += 1
-            elif 60 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 300:
-                COMEBACK['>1min to 5min'] += 1
-            elif 300 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 1800:
-                COMEBACK['>5 min to 30min'] += 1
-            elif 1800 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 7200:
-                COMEBACK['>30min to 2h'] += 1
-            elif 7200 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 18000:
-                COMEBACK['>2h to 5h'] += 1
-            elif 18000 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 43200:
-                COMEBACK['>5h to 12h'] += 1
-            elif 43200 < IP_LIST[client].logs["RECO. DELAY (graylist)"] <= 86400:
-                COMEBACK['>12h to 24h'] += 1
-            else:
-                COMEBACK['>24h'] += 1
+        if client.reco_delay:
+            clients_stats["reconnections"] += 1
+            clients_stats["seconds avg. reco. delay"] += client.reco_delay
+            comeback[comeback_bucket(client.reco_delay)] += 1
 
-        for action in sorted(IP_LIST[client].actions):
-            POSTSCREEN_STATS[action] += IP_LIST[client].actions[action]
+        for action, count in zip(ACTIONS, client.actions):
+            if count > 0:
+                postscreen_stats[action] += count
+                unique_clients[action] += 1
 
         # calculate the average DNSBL trigger level
-        if IP_LIST[client].actions["DNSBL"] > 0:
-            for rank in IP_LIST[client].dnsbl_ranks:
-                CLIENTS["avg. dnsbl rank"] += int(rank)
-
-        # if client was blocked at any point, add its country to the count
-        if (GEOFILE not in "" and  # pylint: disable=too-many-boolean-expressions
-                IP_LIST[client].geoloc > 0 and (
-                    IP_LIST[client].actions["BLACKLISTED"] > 0 or
-                    IP_LIST[client].actions["DNSBL"] > 0 or
-                    IP_LIST[client].actions["PREGREET"] > 0 or
-                    IP_LIST[client].actions["COMMAND PIPELINING"] > 0 or
-                    IP_LIST[client].actions["COMMAND TIME LIMIT"] > 0 or
-                    IP_LIST[client].actions["COMMAND COUNT LIMIT"] > 0 or
-                    IP_LIST[client].actions["COMMAND LENGTH LIMIT"] > 0 or
-                    IP_LIST[client].actions["BARE NEWLINE"] > 0 or
-                    IP_LIST[client].actions["NON-SMTP COMMAND"] > 0)):
-            BLOCKED_COUNTRIES[IP_LIST[client].geoloc["country_name"]] += 1
-            CLIENTS["blocked clients"] += 1
-            if MAPDEST not in "":
-                BLOCKED_CLIENTS[client] = 1
+        if client.dnsbl_ranks is not None:
+            for rank, count in client.dnsbl_ranks.items():
+                clients_stats["avg. dnsbl rank"] += rank * count
+
+        # if client was blocked at any point, it is geolocated
+        if geolocate and any(client.actions[action] for action in BLOCKED_ACTIONS):
+            blocked_clients.append(current_ip)
+    finish_averages(postscreen_stats, clients_stats)
+    return Aggregates(postscreen_stats, clients_stats, comeback, unique_clients,
+                      blocked_clients)
+
+
+def aggregate_columns(ip_list, filter_terms):
+    """Compute aggregate_clients() with NumPy over columns of the clients"""
+    clients = list(ip_list.values())
+    # one row per client, one column per action
+    actions = numpy.frombuffer(b"".join(client.actions.tobytes() for client in clients),
+                               dtype=numpy.uint32).reshape(len(clients), len(ACTIONS))
+    connect = numpy.fromiter((client.connect for client in clients),
+                             dtype=numpy.int64, count=len(clients))
+    reco_delay = numpy.fromiter((client.reco_delay or 0 for client in clients),
+                                dtype=numpy.float64, count=len(clients))
+
+    # the action filter is tested on the masks of all the clients at once
+    if filter_terms is None:
+        selected = numpy.ones(len(clients), dtype=bool)
+    else:
+        masks = numpy.fromiter((client.mask for client in clients),
+                               dtype=numpy.int64, count=len(clients))
+        selected = numpy.zeros(len(clients), dtype=bool)
+        for required, forbidden in filter_terms:
+            selected |= (masks & required == required) & (masks & forbidden == 0)
+    actions = actions[selected]
+    connect = connect[selected]
+
+    postscreen_stats = defaultdict(int)
+    clients_stats = defaultdict(int)
+    unique_clients = defaultdict(int)
+    if len(actions):
+        clients_stats["clients"] = len(actions)
+    if connect.any():
+        postscreen_stats["CONNECT"] = int(connect.sum())
+        unique_clients["CONNECT"] = int(numpy.count_nonzero(connect))
+    for action, total, unique in zip(ACTIONS, actions.sum(axis=0, dtype=numpy.int64),
+                                     numpy.count_nonzero(actions, axis=0)):
+        if total > 0:
+            postscreen_stats[action] = int(total)
+            unique_clients[action] = int(unique)
+
+    # graylist reconnection delays histogram, the buckets bounds are
+    # inclusive like comeback_bucket()
+    delays = reco_delay[selected & (reco_delay > 0)]
+    if len(delays) > 0:
+        clients_stats["reconnections"] = len(delays)
+        clients_stats["seconds avg. reco. delay"] = float(delays.sum())
+    comeback = dict(zip(COMEBACK_BUCKETS, (int(count) for count in numpy.bincount(
+        numpy.searchsorted(COMEBACK_EDGES, delays, side="left"),
+        minlength=len(COMEBACK_BUCKETS)))))
+
+    # only the clients listed by a DNSBL have ranks to walk through
+    indexes = numpy.flatnonzero(selected)
+    for index in indexes[actions[:, DNSBL] > 0]:
+        for rank, count in clients[index].dnsbl_ranks.items():
+            clients_stats["avg. dnsbl rank"] += rank * count
+
+    blocked_clients = []
+    if GEOFILE not in "":
+        keys = list(ip_list)
+        blocked_clients = [keys[index] for index in
+                           indexes[(actions[:, BLOCKED_ACTIONS] > 0).any(axis=1)]]
+    finish_averages(postscreen_stats, clients_stats)
+    return Aggregates(postscreen_stats, clients_stats, comeback, unique_clients,
+                      blocked_clients)
 
+
+def finish_averages(postscreen_stats, clients_stats):
+    """Turn the sums of the clients stats into averages"""
     # calculate the average reconnection delay
-    if CLIENTS["reconnections"] > 0:
-        CLIENTS["seconds avg. reco. delay"] /= CLIENTS["reconnections"]
+    if clients_stats["reconnections"] > 0:
+        clients_stats["seconds avg. reco. delay"] /= clients_stats["reconnections"]
 
     # calculate the average DNSBL trigger rank
-    if POSTSCREEN_STATS["DNSBL"] > 0 and CLIENTS["avg. dnsbl rank"] > 0:
-        CLIENTS["avg. dnsbl rank"] /= POSTSCREEN_STATS["dnsbl"]
+    if postscreen_stats.get("DNSBL", 0) > 0:
+        clients_stats["avg. dnsbl rank"] /= float(postscreen_stats["DNSBL"])
+
+
+def is_mmdb(geo_file):
+    """Return True if geo_file is a MaxMind DB (GeoLite2 .mmdb) file
+
+    The metadata marker of the format is in the last 128KiB of the file.
+    """
+    with open(geo_file, "rb") as database:
+        database.seek(max(getsize(geo_file) - MMDB_METADATA_SIZE, 0))
+        return MMDB_METADATA_MARKER in database.read()
+
 
-if REPORT_MODE in ('short', 'full'):
+def open_geo_database(geo_file):
+    """Open the geo_file database and return its lookup function
+
+    The database is memory-mapped so that the processes share its pages:
+    a GeoLite2 .mmdb file with the maxminddb module, a legacy .dat file
+    with the pygeoip or GeoIP module.
+    """
+    global GI  # pylint: disable=global-statement,invalid-name
+    if is_mmdb(geo_file):
+        try:
+            import maxminddb
+        except ImportError:
+            print("ERROR: Could not import maxminddb module for Geolocation!")
+            print("Install it or re-run without --geofile option.")
+            exit(1)
+        GI = maxminddb.open_database(geo_file, maxminddb.MODE_MMAP)
+        return mmdb_location
+    try:
+        import pygeoip
+        GI = pygeoip.GeoIP(geo_file, pygeoip.MMAP_CACHE)
+    except ImportError:
+        try:
+            import GeoIP
+            GI = GeoIP.open(geo_file, GeoIP.GEOIP_MMAP_CACHE)
+        except ImportError:
+            print("ERROR: Could not import pygeoip or GeoIP modules for Geolocation!")
+            print("Install one/both modules or re-run without --geofile option.")
+            exit(1)
+    return legacy_location
+
+
+def geo_lookup():
+    """Return the lookup function of GEOFILE, opened on the first call"""
+    global GEO_LOOKUP  # pylint: disable=global-statement,invalid-name
+    if GEO_LOOKUP is None:
+        GEO_LOOKUP = open_geo_database(GEOFILE)
+    return GEO_LOOKUP
+
+
+def mmdb_location(address):
+    """Look up address in the GeoLite2 database
+
+    Return the (location, prefix length) of the network of address.
+    """
+    record, prefix = GI.get_with_prefix_len(address)
+    if not record:
+        return None, prefix
+    country = record.get("country") or record.get("registered_country") or {}
+    city = record.get("city", {})
+    location = record.get("location", {})
+    return (country.get("names", {}).get("en"), country.get("iso_code"),
+            city.get("names", {}).get("en"),
+            location.get("latitude"), location.get("longitude")), prefix
+
+
+def legacy_location(address):
+    """Look up address in the legacy GeoIP database
+
+    Return the (location, prefix length) of its network, the legacy API
+    does not tell the network so the location stands for the address only.
+    """
+    record = GI.record_by_addr(address)
+    if not record:
+        return None, 32
+    return (record.get("country_name"), record.get("country_code"), record.get("city"),
+            record.get("latitude"), record.get("longitude")), 32
+
+
+def cached_location(geo_cache, ip_key):
+    """Return the cached location of the network of ip_key
+
+    The cache is {prefix length: {network: location}}, KeyError is raised
+    if no network of ip_key is cached.
+    """
+    for prefix, locations in geo_cache.items():
+        network = ip_key >> (32 - prefix)
+        if network in locations:
+            return locations[network]
+    raise KeyError(ip_key)
+
+
+def lookup_networks(ip_keys):
+    """Look up the sorted ip_keys in the database, once per network
+
+    Return the {prefix length: {network: location}} found.
+    """
+    found = {}
+    lookup = geo_lookup()
+    for ip_key in ip_keys:
+        try:
+            cached_location(found, ip_key)
+        except KeyError:
+            location, prefix = lookup(int_to_ip(ip_key))
+            found.setdefault(prefix, {})[ip_key >> (32 - prefix)] = location
+    return found
+
+
+def locate_clients(ip_list, ip_keys, geo_cache):
+    """Set the geoloc of the ip_keys clients of ip_list
+
+    The location is a (country, country code, city, latitude, longitude)
+    tuple or None. The networks missing from geo_cache are looked up and
+    added to it, by JOBS worker processes for the large batches.
+    """
+    missing = []
+    for ip_key in ip_keys:
+        try:
+            ip_list[ip_key].geoloc = cached_location(geo_cache, ip_key)
+        except KeyError:
+            missing.append(ip_key)
+    if not missing:
+        return
+    # the neighbours share their network, keep them in the same batch
+    missing.sort()
+    # open the database before the workers fork, they share its mapping
+    geo_lookup()
+    if JOBS > 1 and len(missing) > GEO_BATCH_SIZE:
+        batch_size = len(missing) // JOBS + 1
+        pool = get_context("fork").Pool(JOBS)
+        try:
+            found_list = pool.map(lookup_networks, [
+                missing[start:start + batch_size]
+                for start in range(0, len(missing), batch_size)])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        found_list = [lookup_networks(missing)]
+    for found in found_list:
+        for prefix, locations in found.items():
+            geo_cache.setdefault(prefix, {}).update(locations)
+    for ip_key in missing:
+        ip_list[ip_key].geoloc = cached_location(geo_cache, ip_key)
+
+
+def geo_database_id(geo_file):
+    """Return the (mtime, size) identifying the version of geo_file"""
+    geo_stat = os_stat(geo_file)
+    return geo_stat.st_mtime, geo_stat.st_size
+
+
+def load_geo_cache(cache_file, geo_file):
+    """Return the geolocation cache saved by save_geo_cache()
+
+    The cache is empty when cache_file is missing or was made from
+    another version of the geo_file database.
+    """
+    try:
+        with gzip_open(cache_file, "rb") as cache:
+            saved = pickle_load(cache)
+    except IOError:
+        return {}
+    if saved.get("version") != GEO_CACHE_VERSION or \
+       saved.get("database") != geo_database_id(geo_file):
+        return {}
+    return saved["networks"]
+
+
+def save_geo_cache(cache_file, geo_file, geo_cache):
+    """Save the geolocation cache of the geo_file database"""
+    saved = {
+        "version": GEO_CACHE_VERSION,
+        "database": geo_database_id(geo_file),
+        "networks": geo_cache}
+    # write aside and rename like save_state()
+    with gzip_open(cache_file + ".tmp", "wb", compresslevel=1) as cache:
+        pickle_dump(saved, cache, HIGHEST_PROTOCOL)
+    replace(cache_file + ".tmp", cache_file)
+
+
+def count_countries(ip_list, ip_keys):
+    """Return {country: count of clients} of the located ip_keys clients"""
+    countries = defaultdict(int)
+    for ip_key in ip_keys:
+        countries[ip_list[ip_key].geoloc[0]] += 1
+    return countries
+
+
+def map_points(ip_list, ip_keys):
+    """Group the located ip_keys clients of ip_list by coordinates
+
+    Return the list of [latitude, longitude, place, clients, connections,
+    details] points. The details list the MAP_POPUP_CLIENTS clients with
+    the most connections as [ip, connections, first seen, last seen,
+    graylist delay, [action index, count, ...], DNSBL ranks].
+    """
+    points = {}
+    for ip_key in ip_keys:
+        client = ip_list[ip_key]
+        country, country_code, city, latitude, longitude = client.geoloc
+        if latitude is None or longitude is None:
+            continue
+        point = points.get((latitude, longitude))
+        if point is None:
+            place = ", ".join(str(name) for name in (city, country_code or country) if name)
+            point = points[(latitude, longitude)] = [latitude, longitude, place, 0, 0, []]
+        point[3] += 1
+        point[4] += client.connect
+        point[5].append(ip_key)
+    for point in points.values():
+        top_keys = sorted(point[5], key=lambda ip_key: ip_list[ip_key].connect,
+                          reverse=True)[:MAP_POPUP_CLIENTS]
+        point[5] = [map_client(ip_key, ip_list[ip_key]) for ip_key in top_keys]
+    return list(points.values())
+
+
+def map_client(ip_key, client):
+    """Return the details of client shown in the popups of the map"""
+    actions = []
+    for index, count in enumerate(client.actions):
+        if count > 0:
+            actions += [index, count]
+    return [network_name(ip_key), client.connect, int(client.first_seen),
+            int(client.last_seen), client.reco_delay and int(client.reco_delay),
+            actions, client.rank_list()]
+
+
+def map_asset(name):
+    """Return the URL of the Leaflet file name, local with --map-assets"""
+    if MAP_ASSETS not in "":
+        return MAP_ASSETS.rstrip("/") + "/" + name
+    return MAP_CDN[name]
+
+
+def map_html(points, mapped_clients):
+    """Return the HTML page of the map of the points
+
+    The points are embedded as one JSON blob, the markers of the close
+    points are clustered (or drawn as a heat map) and the popups are only
+    built when they are opened.
+    """
+    data = json_dumps({"actions": ACTIONS, "points": points},
+                      separators=(",", ":"))
+    if MAP_HEAT:
+        scripts = ['leaflet.js', 'leaflet-heat.js']
+        styles = ['leaflet.css']
+    else:
+        scripts = ['leaflet.js', 'leaflet.markercluster.js']
+        styles = ['leaflet.css', 'MarkerCluster.css', 'MarkerCluster.Default.css']
+    return "".join([
+        MAP_HEAD,
+        "".join('    <link rel="stylesheet" href="%s" />\n' % map_asset(style)
+                for style in styles),
+        "".join('    <script src="%s"></script>\n' % map_asset(script)
+                for script in scripts),
+        '  </head>\n  <body>\n',
+        '    <h1>Postscreen Map of Blocked IPs</h1>\n    <div id="map"></div>\n',
+        '    <p>mapping %d blocked IPs at %d locations</p>\n' % (mapped_clients, len(points)),
+        MAP_FOOTER,
+        # "</" would end the script element in the middle of the data
+        '    <script>\n    var MAP_DATA = ', data.replace("</", "<\\/"), ';\n',
+        '    var MAP_TILES = ', json_dumps(MAP_TILES), ';\n',
+        '    var MAP_HEAT = ', json_dumps(MAP_HEAT), ';\n',
+        MAP_SCRIPT,
+        '    </script>\n  </body>\n</html>\n'])
+
+
+def column_name(action):
+    """Return the SQL and export column name of action"""
+    return COLUMN_NAME.sub("_", action.lower())
+
+
+def history_day(syslog_date):
+    """Return the YYYY-MM-DD day of a syslog or RFC3339 time stamp"""
+    if RFC3339:
+        return syslog_date[:10]
+    month_day = syslog_date.rsplit(" ", 1)[0]
+    day = DAY_CACHE.get(month_day)
+    if day is None:
+        day = DAY_CACHE[month_day] = dt.strptime(
+            str(YEAR) + " " + month_day, "%Y %b %d").strftime("%Y-%m-%d")
+    return day
+
+
+def open_history(history_file):
+    """Open the SQLite history database, creating its tables
+
+    client_days has a row per client and day, with the columns of the
+    ClientStat and a column per action, its DNSBL ranks are in dnsbl_ranks.
+    daily rolls up the clients and the total of each event per day.
+    """
+    database = sqlite_connect(history_file)
+    database.executescript("""
+        CREATE TABLE IF NOT EXISTS client_days (
+            ip INTEGER NOT NULL, day TEXT NOT NULL, first_seen REAL,
+            last_seen REAL, connect INTEGER NOT NULL, reco_delay REAL,
+            %s,
+            PRIMARY KEY (ip, day)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS client_days_day ON client_days (day);
+        CREATE TABLE IF NOT EXISTS dnsbl_ranks (
+            ip INTEGER NOT NULL, day TEXT NOT NULL, rank INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (ip, day, rank)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS dnsbl_ranks_day ON dnsbl_ranks (day);
+        CREATE TABLE IF NOT EXISTS daily (
+            day TEXT NOT NULL, event TEXT NOT NULL, clients INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (day, event)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS checkpoint (inode INTEGER, offset INTEGER);
+        """ % ",\n".join("%s INTEGER NOT NULL DEFAULT 0" % column_name(action)
+                         for action in ACTIONS))
+    return database
+
+
+def history_checkpoint(database):
+    """Return the (inode, offset) checkpoint of the log file, or None"""
+    row = database.execute("SELECT inode, offset FROM checkpoint").fetchone()
+    return tuple(row) if row else None
+
+
+def history_events(days):
+    """Return an on_event callback of parse_lines() counting by day
+
+    The events are added to the ClientStat of days, keyed on (ip, day).
+    """
+    def day_event(syslog_date, current_ip, event, value):
+        """Count a parsed event in the day of its client"""
+        key = (current_ip, history_day(syslog_date))
+        client = days.get(key)
+        if client is None:
+            client = days[key] = ClientStat()
+        if event == "CONNECT":
+            client.last_seen = gen_unix_ts(syslog_date)
+            if not client.connect:
+                client.first_seen = client.last_seen
+            client.connect += 1
+        elif event == "RECO. DELAY (graylist)":
+            client.reco_delay = value
+        else:
+            client.actions[ACTION_INDEX[event]] += 1
+            if value is not None:
+                client.add_ranks({int(value): 1})
+    return day_event
+
+
+def save_history(database, days, checkpoint):
+    """Add the days of the clients to the history and roll them up
+
+    The rows are added to the existing ones of the same client and day,
+    all in one transaction with the checkpoint of the log file.
+    """
+    columns = [column_name(action) for action in ACTIONS]
+    with database:
+        database.executemany(
+            "INSERT INTO client_days VALUES (?, ?, ?, ?, ?, ?, %s) "
+            "ON CONFLICT (ip, day) DO UPDATE SET "
+            # the first and last seen are unset on the days without CONNECT
+            "first_seen = COALESCE(MIN(first_seen, excluded.first_seen), "
+            "first_seen, excluded.first_seen), "
+            "last_seen = COALESCE(MAX(last_seen, excluded.last_seen), "
+            "last_seen, excluded.last_seen), "
+            "connect = connect + excluded.connect, "
+            "reco_delay = COALESCE(reco_delay, excluded.reco_delay), %s" % (
+                ", ".join("?" * len(columns)),
+                ", ".join("%s = %s + excluded.%s" % (column, column, column)
+                          for column in columns)),
+            ((ip_key, day, client.first_seen if client.connect else None,
+              client.last_seen if client.connect else None, client.connect,
+              client.reco_delay) + tuple(client.actions)
+             for (ip_key, day), client in days.items()))
+        database.executemany(
+            "INSERT INTO dnsbl_ranks VALUES (?, ?, ?, ?) ON CONFLICT (ip, day, rank) "
+            "DO UPDATE SET count = count + excluded.count",
+            ((ip_key, day, rank, count)
+             for (ip_key, day), client in days.items() if client.dnsbl_ranks
+             for rank, count in client.dnsbl_ranks.items()))
+
+        # roll up the days which got new rows
+        touched = sorted(set(day for _, day in days))
+        database.executemany("DELETE FROM daily WHERE day = ?",
+                             ((day,) for day in touched))
+        for event, column in [("CONNECT", "connect")] + list(zip(ACTIONS, columns)):
+            for start in range(0, len(touched), HISTORY_BATCH_SIZE):
+                batch = touched[start:start + HISTORY_BATCH_SIZE]
+                database.execute(
+                    "INSERT INTO daily SELECT day, ?, COUNT(*), SUM(%s) FROM client_days "
+                    "WHERE %s > 0 AND day IN (%s) GROUP BY day" % (
+                        column, column, ", ".join("?" * len(batch))),
+                    [event] + batch)
+
+        database.execute("DELETE FROM checkpoint")
+        if checkpoint is not None:
+            database.execute("INSERT INTO checkpoint VALUES (?, ?)", checkpoint)
+
+
+def history_range(since, until):
+    """Return the SQL condition and parameters of the days since to until"""
+    return "day BETWEEN ? AND ?", [since or "0000-00-00", until or "9999-99-99"]
+
+
+def load_history(database, ip_list, filter_terms, since="", until=""):
+    """Load the clients of the history into ip_list, summed over the days
+
+    The days since to until (all by default), the -i IP and the action
+    filter are applied by the query.
+    """
+    # no client matches a filter without terms, like 'DNSBL&!DNSBL'
+    if filter_terms is not None and not filter_terms:
+        return
+    columns = [column_name(action) for action in ACTIONS]
+    where, params = history_range(since, until)
+    ip_filter = IP_FILTER.strip()
+    if IP_REGEXP_FULL.match(ip_filter):
+        where += " AND ip = ?"
+        params.append(ip_to_int(ip_filter))
+    # a client matches the action filter if one of the terms holds over
+    # the sum of its days
+    having = "SUM(connect) > 0"
+    if filter_terms is not None:
+        having += " AND (%s)" % " OR ".join(
+            "(%s)" % " AND ".join(
+                ["SUM(%s) > 0" % columns[action] for action in range(len(ACTIONS))
+                 if required & 1 << action] +
+                ["SUM(%s) = 0" % columns[action] for action in range(len(ACTIONS))
+                 if forbidden & 1 << action] or ["1"])
+            for required, forbidden in filter_terms)
+    for row in database.execute(
+            "SELECT ip, MIN(first_seen), MAX(last_seen), SUM(connect), %s "
+            "FROM client_days WHERE %s GROUP BY ip HAVING %s ORDER BY 2" % (
+                ", ".join("SUM(%s)" % column for column in columns), where, having),
+            params):
+        if ip_filter and ip_filter not in int_to_ip(row[0]):
+            continue
+        client = ip_list[row[0]] = ClientStat()
+        client.first_seen, client.last_seen, client.connect = row[1:4]
+        client.actions = array("I", row[4:])
+        client.update_mask()
+
+    # the first reconnection delay of the clients, from their first day
+    for ip_key, reco_delay in database.execute(
+            "SELECT ip, reco_delay FROM client_days WHERE %s "
+            "AND reco_delay IS NOT NULL ORDER BY day DESC" % where, params):
+        if ip_key in ip_list:
+            ip_list[ip_key].reco_delay = reco_delay
+    for ip_key, rank, count in database.execute(
+            "SELECT ip, rank, SUM(count) FROM dnsbl_ranks WHERE %s "
+            "GROUP BY ip, rank" % where, params):
+        if ip_key in ip_list:
+            ip_list[ip_key].add_ranks({rank: count})
+
+
+class HistoryClients(dict):
+    """The clients of a history update, loaded from the history on demand
+
+    The clients already in the history carry on like with --state, so
+    their counts and graylist delays span the runs. Only the clients of
+    the new lines are read, the first time the parser looks them up, and
+    only with the columns the parser carries on: the first and last seen,
+    the CONNECT count and the 450 rejects of the graylist delay.
+    """
+
+    def __init__(self, database):
+        dict.__init__(self)
+        self.database = database
+        self.looked_up = set()
+        self.query = ("SELECT MIN(first_seen), MAX(last_seen), SUM(connect), SUM(%s) "
+                      "FROM client_days WHERE ip = ?" % column_name(ACTIONS[GRAYLIST]))
+
+    def get(self, ip_key, default=None):
+        """Return the client of ip_key, loaded from the history if new"""
+        if ip_key not in self.looked_up:
+            self.looked_up.add(ip_key)
+            first_seen, last_seen, connect, graylist = self.database.execute(
+                self.query, (ip_key,)).fetchone()
+            if connect:
+                client = self[ip_key] = ClientStat()
+                client.first_seen, client.last_seen, client.connect = first_seen, last_seen, connect
+                client.actions[GRAYLIST] = graylist
+                client.update_mask()
+        return dict.get(self, ip_key, default)
+
+
+def report_days(database, since="", until=""):
+    """Print the daily rollups of the history, of the days since to until"""
+    where, params = history_range(since, until)
+    day = None
+    for day_row, event, clients, total in database.execute(
+            "SELECT day, event, clients, total FROM daily WHERE %s "
+            "ORDER BY day, event != 'CONNECT', event" % where, params):
+        if day_row != day:
+            day = day_row
+            print("\n=== " + day + " ===")
+        print(str(clients) + "/" + str(total), event)
+
+
+def export_columns():
+    """Return the names of the columns of the exported clients table"""
+    columns = ["ip", "first_seen", "last_seen", "connect", "reco_delay"]
+    columns += [column_name(action) for action in ACTIONS]
+    columns.append("dnsbl_ranks")
+    if GEOFILE not in "":
+        columns += ["country", "country_code", "city", "latitude", "longitude"]
+    return columns
+
+
+def export_batches(ip_list, ip_keys):
+    """Yield the rows of the ip_keys clients by lists of EXPORT_BATCH_SIZE
+
+    A row follows export_columns(), the time stamps are unix times and the
+    DNSBL ranks a space separated string.
+    """
+    geolocated = GEOFILE not in ""
+    no_location = (None,) * 5
+    batch = []
+    for ip_key in ip_keys:
+        client = ip_list[ip_key]
+        row = (network_name(ip_key), int(client.first_seen), int(client.last_seen),
+               client.connect, client.reco_delay and int(client.reco_delay)) + \
+            tuple(client.actions) + (" ".join(client.rank_list()),)
+        if geolocated:
+            row += client.geoloc or no_location
+        batch.append(row)
+        if len(batch) == EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_csv(export_file, columns, batches):
+    """Write the batches of rows to a CSV file with a header"""
+    with open(export_file, "w", newline="") as export:
+        writer = csv_writer(export)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+
+
+def export_jsonl(export_file, columns, batches):
+    """Write the batches of rows to a JSON Lines file, one object per client
+
+    The objects are formatted from a template of the columns, a dict per
+    client through json.dumps() is several times slower.
+    """
+    template = "{%s}\n" % ",".join('"%s":%%s' % column for column in columns)
+    ranks = columns.index("dnsbl_ranks")
+    with open(export_file, "w") as export:
+        for batch in batches:
+            lines = []
+            for row in batch:
+                values = list(row)
+                values[0] = '"%s"' % row[0]
+                if row[4] is None:
+                    values[4] = "null"
+                values[ranks] = "[%s]" % row[ranks].replace(" ", ",")
+                # the geolocation, when exported, may hold any string
+                for index in range(ranks + 1, len(row)):
+                    values[index] = json_dumps(row[index])
+                lines.append(template % tuple(values))
+            export.write("".join(lines))
+
+
+def export_sqlite(export_file, columns, batches):
+    """Write the batches of rows to the clients table of a SQLite database"""
+    database = sqlite_connect(export_file)
+    try:
+        # the file is new and renamed when complete, no journal is needed
+        database.execute("PRAGMA journal_mode = OFF")
+        database.execute("PRAGMA synchronous = OFF")
+        database.execute("CREATE TABLE clients (%s)" % ", ".join(
+            column + (" TEXT PRIMARY KEY" if column == "ip" else "") for column in columns))
+        insert = "INSERT INTO clients VALUES (%s)" % ", ".join("?" * len(columns))
+        for batch in batches:
+            database.executemany(insert, batch)
+        database.commit()
+    finally:
+        database.close()
+
+
+def export_parquet(export_file, columns, batches):
+    """Write the batches of rows to a Parquet file, a row group per batch"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("ERROR: Could not import pyarrow module for the Parquet export!")
+        print("Install it or export to another format.")
+        exit(1)
+    integer_columns = set(["first_seen", "last_seen", "connect", "reco_delay"] +
+                          columns[5:5 + len(ACTIONS)])
+    schema = pyarrow.schema([
+        (column, pyarrow.int64() if column in integer_columns else
+         pyarrow.float64() if column in ("latitude", "longitude") else pyarrow.string())
+        for column in columns])
+    with pyarrow.parquet.ParquetWriter(export_file, schema, compression="zstd") as writer:
+        for batch in batches:
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(values, type=field.type)
+                 for values, field in zip(zip(*batch), schema)], schema=schema))
+
+
+def export_clients(export_file, export_format, ip_list, ip_keys):
+    """Export the ip_keys clients of ip_list to export_file
+
+    The rows are written by batches, the file is written aside and renamed
+    when complete.
+    """
+    if export_format in "":
+        export_format = EXPORT_EXTENSIONS.get(
+            export_file.rsplit(".", 1)[-1].lower(), "csv")
+    if export_format not in EXPORT_WRITERS:
+        print("ERROR: Unknown export format", export_format)
+        exit(1)
+    if isfile(export_file + ".tmp"):
+        remove(export_file + ".tmp")
+    EXPORT_WRITERS[export_format](export_file + ".tmp", export_columns(),
+                                  export_batches(ip_list, ip_keys))
+    replace(export_file + ".tmp", export_file)
+
+
+def print_clients(ip_list, out=stdout, access_index=None):
+    """Print the full report of each client of ip_list
+
+    access_index is the CidrIndex of the access tables, the network
+    matching each client is printed.
+    """
+    for current_ip, client in ip_list.items():
+        print(network_name(current_ip), file=out)
+        for log, value in client.logs():
+            if log in ('FIRST SEEN', 'LAST SEEN'):
+                print("\t", log, ":", dt.fromtimestamp(int(
+                    value)).strftime('%Y-%m-%d %H:%M:%S'), file=out)
+            else:
+                print("\t", log, ":", value, file=out)
+        print("\t--- postscreen actions ---", file=out)
+        for action, count in zip(ACTIONS, client.actions):
+            if count == 0:
+                continue
+            print("\t", action, ":", count, file=out)
+            if action in 'DNSBL':
+                print("\tDNSBL ranks:", client.rank_list(), file=out)
+        if GEOFILE not in "":
+            print("\tGeoLoc:", client.geoloc, file=out)
+        if access_index is not None:
+            network = access_index.lookup(current_ip)
+            if network is not None:
+                print(("\tAccess: %s %s %s" % (network.network, network.action,
+                                               network.comment)).rstrip(), file=out)
+        print("", file=out)
+
+
+def print_report(aggregates, blocked_countries=None, out=stdout):
+    """Print the short report of the Aggregates of aggregate_clients()
+
+    blocked_countries is the {country: clients} count of the geolocated
+    blocked clients, see count_countries().
+    """
+    postscreen_stats, clients_stats, comeback, unique_clients = aggregates[:4]
     # display unique clients and total postscreen actions
-    print("\n=== unique clients/total postscreen actions ===")
-    # print the count of CONNECT first (apply the ACTION_FILTER)
-    print(str(len([cs.logs['CONNECT'] for cs in IP_LIST.items()
-                   if cs.logs['CONNECT'] > 0 and cs.action_filter(ACTION_FILTER)]))
-          + "/" + str(sum([cs.logs['CONNECT'] for cs in IP_LIST.items()
-                           if cs.logs['CONNECT'] > 0 and cs.action_filter(ACTION_FILTER)]))
-          + " CONNECT")
-    # then print the list of actions, ACTION_FILTER was applied earlied
-    # when the POSTSCREEN_STATS dictionary was built
-    for action in sorted(POSTSCREEN_STATS):
-        print(str(len([cs.actions[action] for cs in IP_LIST.items()
-                       if cs.actions[action] > 0 and cs.action_filter(ACTION_FILTER)]))
-              + "/" + str(POSTSCREEN_STATS[action]), action)
-
-    print("\n=== clients statistics ===")
-    for stat in sorted(CLIENTS):
-        print(CLIENTS[stat], stat)
-
-    if CLIENTS["reconnections"] > 0:
-        print("\n=== First reconnection delay (graylist) ===")
-        print("delay | <10s | 10to30s | >30to1m | >1to5m | >5to30m | " +
-              ">30mto2h | >2hto5h | >5hto12h | >12to24h | >24h |")
+    print("\n=== unique clients/total postscreen actions ===", file=out)
+    # print the count of CONNECT first, then the list of actions
+    # (ACTION_FILTER was applied when the aggregates were built)
+    print(str(unique_clients["CONNECT"]) + "/" +
+          str(postscreen_stats.get("CONNECT", 0)) + " CONNECT", file=out)
+    for action in sorted(postscreen_stats):
+        if action != "CONNECT":
+            print(str(unique_clients[action]) + "/" + str(postscreen_stats[action]),
+                  action, file=out)
+
+    print("\n=== clients statistics ===", file=out)
+    for stat in sorted(clients_stats):
+        print(clients_stats[stat], stat, file=out)
+
+    if clients_stats["reconnections"] > 0:
+        print("\n=== First reconnection delay (graylist) ===", file=out)
+        print("delay | <=10s | 10to30s | >30to1m | >1to5m | >5to30m | " +
+              ">30mto2h | >2hto5h | >5hto12h | >12to24h | >24h |", file=out)
         # display the absolute values
-        print("count | ")
-        print(str(COMEBACK['<10s']).ljust(5) + "| ")
-        print(str(COMEBACK['10s to 30s']).ljust(8) + "| ")
-        print(str(COMEBACK['>30s to 1min']).ljust(8) + "| ")
-        print(str(COMEBACK['>1min to 5min']).ljust(7) + "| ")
-        print(str(COMEBACK['>5 min to 30min']).ljust(8) + "| ")
-        print(str(COMEBACK['>30min to 2h']).ljust(9) + "| ")
-        print(str(COMEBACK['>2h to 5h']).ljust(8) + "| ")
-        print(str(COMEBACK['>5h to 12h']).ljust(9) + "| ")
-        print(str(COMEBACK['>12h to 24h']).ljust(9) + "| ")
-        print(str(COMEBACK['>24h']).ljust(5) + "|")
+        print("count | ", end="", file=out)
+        for bucket, width in zip(COMEBACK_BUCKETS, COMEBACK_WIDTHS):
+            print(str(comeback[bucket]).ljust(width) + "| ", end="", file=out)
+        print("", file=out)
         # calculate and display the percentages
         getcontext().prec = 2
-        DEC_CAMEBACK = Decimal(CLIENTS["reconnections"])
-
-        print("pct % | ")
-        print(str(Decimal(COMEBACK['<10s']) /
-                  DEC_CAMEBACK * 100).ljust(5) + "| ")
-        print(str(Decimal(COMEBACK['10s to 30s']) /
-                  DEC_CAMEBACK * 100).ljust(8) + "| ")
-        print(str(Decimal(COMEBACK['>30s to 1min']) /
-                  DEC_CAMEBACK * 100).ljust(8) + "| ")
-        print(str(Decimal(COMEBACK['>1min to 5min']) /
-                  DEC_CAMEBACK * 100).ljust(7) + "| ")
-        print(str(Decimal(COMEBACK['>5 min to 30min']) /
-                  DEC_CAMEBACK * 100).ljust(8) + "| ")
-        print(str(Decimal(COMEBACK['>30min to 2h']) /
-                  DEC_CAMEBACK * 100).ljust(9) + "| ")
-        print(str(Decimal(COMEBACK['>2h to 5h']) /
-                  DEC_CAMEBACK * 100).ljust(8) + "| ")
-        print(str(Decimal(COMEBACK['>5h to 12h']) /
-                  DEC_CAMEBACK * 100).ljust(9) + "| ")
-        print(str(Decimal(COMEBACK['>12h to 24h']) /
-                  DEC_CAMEBACK * 100).ljust(9) + "| ")
-        print(str(Decimal(COMEBACK['>24h']) /
-                  DEC_CAMEBACK * 100).ljust(5) + "|")
+        reconnections = Decimal(clients_stats["reconnections"])
+
+        print("pct % | ", end="", file=out)
+        for bucket, width in zip(COMEBACK_BUCKETS, COMEBACK_WIDTHS):
+            print(str(Decimal(comeback[bucket]) /
+                      reconnections * 100).ljust(width) + "| ", end="", file=out)
+        print("", file=out)
+
+    if blocked_countries is not None:
+        total_blocked = Decimal(clients_stats["blocked clients"])
+        print("\n=== Top 20 Countries of Blocked Clients ===", file=out)
+        sorted_countries = sorted(blocked_countries.items(),
+                                  key=itemgetter(1), reverse=True)
+        count_format = ""
+        for country, country_clients in sorted_countries[:20]:
+            if count_format in "":
+                count_format = "%" + str(len(str(country_clients))) + "d"
+            client_percent = "(%5.2f%%)" % \
+                float(Decimal(country_clients) / total_blocked * 100)
+            print(count_format % country_clients, client_percent, country, file=out)
+
+
+def render_map(ip_list, ip_keys):
+    """Return the HTML map of the geolocated ip_keys clients of ip_list"""
+    return map_html(map_points(ip_list, ip_keys), len(ip_keys))
+
+
+def stats_phase(phase):
+    """End the running phase of the --stats timings and start phase
+
+    The phases are timed whatever the options, a few calls per run.
+    """
+    now, cpu = time(), process_time()
+    running, started, cpu_started = PHASE_START
+    if running is not None:
+        spent = PHASE_TIMES.setdefault(running, [0.0, 0.0])
+        spent[0] += now - started
+        spent[1] += cpu - cpu_started
+    PHASE_START[:] = [phase, now, cpu]
+
+
+def stats_record(ip_list):
+    """Return the --stats timings, counters and peak memory as a dict
+
+    The peak RSS is in KiB on Linux, the workers of -j are accounted
+    apart as they are separate processes.
+    """
+    stats_phase(None)
+    own_usage = getrusage(RUSAGE_SELF)
+    workers_usage = getrusage(RUSAGE_CHILDREN)
+    action_names = ("CONNECT",) + ACTIONS
+    return {
+        "version": STATS_VERSION,
+        "date": NOW.strftime("%Y-%m-%d %H:%M:%S"),
+        "arguments": argv[1:],
+        "phases": OrderedDict((phase, {"wall": wall, "cpu": cpu})
+                              for phase, (wall, cpu) in PHASE_TIMES.items()),
+        "counters": dict((counter, count) for counter, count in PARSE_COUNTERS.items()
+                         if counter not in action_names),
+        "actions": dict((action, PARSE_COUNTERS[action]) for action in action_names),
+        "clients": len(ip_list),
+        "peak rss KiB": own_usage.ru_maxrss,
+        "workers peak rss KiB": workers_usage.ru_maxrss,
+        "workers cpu": workers_usage.ru_utime + workers_usage.ru_stime}
+
+
+def print_stats(record):
+    """Print the --stats record on stderr, away from the reports"""
+    print("\n=== run statistics ===", file=stderr)
+    print("phase               wall s     cpu s", file=stderr)
+    for phase, times in record["phases"].items():
+        print("%-16s %9.3f %9.3f" % (phase, times["wall"], times["cpu"]), file=stderr)
+    print("%-16s %9.3f %9.3f" % ("total", sum(times["wall"] for times in record["phases"].values()),
+                                 sum(times["cpu"] for times in record["phases"].values())),
+          file=stderr)
+    if JOBS > 1:
+        print("%-16s %9s %9.3f" % ("workers", "", record["workers cpu"]), file=stderr)
+    parse_wall = record["phases"].get("parse", {}).get("wall")
+    counters = record["counters"]
+    print("", file=stderr)
+    for counter in sorted(counters):
+        print(counters[counter], counter, file=stderr)
+    if parse_wall:
+        print(int(counters.get("lines read", 0) / parse_wall), "lines read/s", file=stderr)
+    print(record["clients"], "clients", file=stderr)
+    print(record["peak rss KiB"] // 1024, "MiB peak RSS", file=stderr)
+    if JOBS > 1:
+        print(record["workers peak rss KiB"] // 1024, "MiB workers peak RSS", file=stderr)
+    print("\n--- postscreen lines by action ---", file=stderr)
+    for action in sorted(record["actions"], key=lambda action: action != "CONNECT"):
+        if record["actions"][action]:
+            print(record["actions"][action], action, file=stderr)
+
+
+def read_options(args):
+    """Set the module settings from the command line arguments"""
+    # pylint: disable=global-statement,too-many-branches,too-many-statements
+    global ACTION_FILTER, GEOFILE, GEO_CACHE_FILE, LOG_PATTERNS, YEAR, RFC3339, \
+        LOG_CURSOR, IP_FILTER, REPORT_MODE, MAPDEST, MAP_MIN_CONN, MAP_TILES, \
+        MAP_ASSETS, MAP_HEAT, EXPORT_FILE, EXPORT_FORMAT, HISTORY_FILE, \
+        HISTORY_QUERY, HISTORY_SINCE, HISTORY_UNTIL, JOBS, STATE_FILE, FOLLOW, \
+        FOLLOW_WINDOWS, FOLLOW_INTERVAL, CLIENT_TTL, MAX_CLIENTS, STATS, \
+        STATS_JSON_FILE, PROFILE_FILE, EXPORTER_ADDRESS, PREFIX_LEN, PREFIX_MASK, \
+        TOP_NETWORKS, TOP_ACTIONS, ACCESS_FILE, CIDR_FILES, LATENCY, SUMMARY_FILE, \
+        MERGE_PATTERNS
+    args_list, _ = getopt(args, 'a:i:f:j:r:y:h', [
+        'action=', 'geofile=', 'mapdest=', 'ip=', 'year=', 'report=',
+        'help', 'file=', 'rfc3339', 'map-min-conn=', 'jobs=', 'state=',
+        'follow', 'windows=', 'interval=', 'client-ttl=', 'max-clients=',
+        'geocache=', 'map-tiles=', 'map-assets=', 'map-heat', 'export=',
+        'export-format=', 'db=', 'query', 'since=', 'until=', 'stats',
+        'stats-json=', 'profile=', 'exporter=', 'prefix=', 'top=',
+        'top-actions=', 'access=', 'cidr=', 'latency', 'summary=', 'merge='])
+
+    LOG_PATTERNS = []
+    CIDR_FILES = []
+    MERGE_PATTERNS = []
+    for argument, value in args_list:
+        if argument in ('-a', '--action'):
+            ACTION_FILTER = str(value)
+        elif argument in '--geofile':
+            GEOFILE = value
+        elif argument in '--geocache':
+            GEO_CACHE_FILE = value
+        elif argument in ('-f', '--file'):
+            LOG_PATTERNS.append(value)
+        elif argument in ('-y', '--year'):
+            YEAR = value
+        # a substring test would take -r for --rfc3339 and -h for --map-heat
+        elif argument == '--rfc3339':
+            RFC3339 = True
+            LOG_CURSOR = 3
+        elif argument in ('-i', '--ip'):
+            IP_FILTER = value
+            print("Filtering results on IP", IP_FILTER)
+        elif argument in ('-r', '--report'):
+            if value in ('short', 'full', 'ip', 'none', 'days'):
+                REPORT_MODE = value
+            else:
+                print("ERROR: Unknown report type")
+                usage()
+                exit()
+        elif argument in '--mapdest':
+            MAPDEST = value
+            print("HTML map file will be generated at ", MAPDEST)
+        elif argument in '--map-min-conn':
+            MAP_MIN_CONN = int(value)
+        elif argument in '--map-tiles':
+            MAP_TILES = value
+        elif argument in '--map-assets':
+            MAP_ASSETS = value
+        elif argument == '--map-heat':
+            MAP_HEAT = True
+        elif argument in '--export':
+            EXPORT_FILE = value
+        elif argument in '--export-format':
+            EXPORT_FORMAT = value
+        elif argument in '--db':
+            HISTORY_FILE = value
+        elif argument in '--query':
+            HISTORY_QUERY = True
+        elif argument in '--since':
+            HISTORY_SINCE = value
+        elif argument in '--until':
+            HISTORY_UNTIL = value
+        elif argument in ('-j', '--jobs'):
+            JOBS = int(value)
+        elif argument in '--state':
+            STATE_FILE = value
+        elif argument in '--follow':
+            FOLLOW = True
+        elif argument in '--windows':
+            FOLLOW_WINDOWS = value
+        elif argument in '--interval':
+            FOLLOW_INTERVAL = parse_duration(value)
+        elif argument in '--client-ttl':
+            CLIENT_TTL = parse_duration(value)
+        elif argument in '--max-clients':
+            MAX_CLIENTS = int(value)
+        elif argument in '--exporter':
+            EXPORTER_ADDRESS = value
+        elif argument in '--prefix':
+            PREFIX_LEN = int(value)
+            if not 0 < PREFIX_LEN <= 32:
+                print("ERROR: The --prefix length is from 1 to 32")
+                exit(1)
+            PREFIX_MASK = (0xffffffff << (32 - PREFIX_LEN)) & 0xffffffff
+        elif argument in '--top':
+            TOP_NETWORKS = int(value)
+        elif argument in '--top-actions':
+            TOP_ACTIONS = value
+        elif argument in '--access':
+            ACCESS_FILE = value
+        elif argument in '--cidr':
+            CIDR_FILES.append(value)
+        elif argument in '--latency':
+            LATENCY = True
+        elif argument in '--summary':
+            SUMMARY_FILE = value
+        elif argument in '--merge':
+            MERGE_PATTERNS.append(value)
+        elif argument in '--stats':
+            STATS = True
+        elif argument in '--stats-json':
+            STATS_JSON_FILE = value
+        elif argument in '--profile':
+            PROFILE_FILE = value
+        elif argument in ('-h', '--help'):
+            usage()
+            exit()
+
 
+def parse_logs(history, log_files, filter_terms, sessions=None):
+    """Parse the log files of the command line and return the clients
+
+    With the --db history, the new lines are added to it and the clients
+    are loaded back from it. With --state, the parse resumes after the
+    lines parsed by the last run. The lines parsed go through the
+    SessionTracker sessions, without -j.
+    """
+    global IP_FILTER  # pylint: disable=global-statement
+    ip_list = {}
+    log_file = log_files[-1]
+
+    def log_lines(*log_range):
+        lines = read_chunk(*log_range, counters=PARSE_COUNTERS)
+        return lines if sessions is None else sessions.watch(lines, ip_list)
+
+    if history is not None:
+        if not HISTORY_QUERY:
+            # the history keeps all the clients, -i only filters the reports
+            report_ip_filter, IP_FILTER = IP_FILTER, " "
+            checkpoint = history_checkpoint(history)
+            if checkpoint is not None:
+                ip_list = HistoryClients(history)
+            log_ranges, checkpoint = resume_ranges(log_file, checkpoint)
+            # the older rotated logs are imported by the first run only
+            if history_checkpoint(history) is None:
+                log_ranges = [(older_file, 0, None) for older_file in log_files[:-1]] + log_ranges
+            if log_magic(log_file):
+                log_ranges, checkpoint = [(any_file, 0, None) for any_file in log_files], None
+            history_days = {}
+            for log_range in log_ranges:
+                parse_lines(log_lines(*log_range), ip_list,
+                            on_event=history_events(history_days), counters=PARSE_COUNTERS)
+            stats_phase("history update")
+            save_history(history, history_days, checkpoint)
+            IP_FILTER = report_ip_filter
+        stats_phase("history query")
+        ip_list = {}
+        load_history(history, ip_list, filter_terms, HISTORY_SINCE, HISTORY_UNTIL)
+    elif STATE_FILE not in "":
+        # incremental mode: resume after the lines parsed by the last run
+        checkpoint = load_state(STATE_FILE, ip_list)
+        log_ranges, checkpoint = resume_ranges(log_file, checkpoint)
+        if JOBS > 1:
+            parse_parallel([chunk for log_range in log_ranges
+                            for chunk in log_chunks(log_range[0], JOBS, *log_range[1:])],
+                           ip_list, JOBS, PARSE_COUNTERS)
+        else:
+            for log_range in log_ranges:
+                parse_lines(log_lines(*log_range), ip_list, counters=PARSE_COUNTERS)
+        stats_phase("state save")
+        save_state(STATE_FILE, ip_list, checkpoint)
+    elif JOBS > 1:
+        parse_parallel([chunk for any_file in log_files
+                        for chunk in log_chunks(any_file, JOBS)], ip_list, JOBS,
+                       PARSE_COUNTERS)
+    else:
+        for any_file in log_files:
+            parse_lines(log_lines(any_file, 0, None), ip_list, counters=PARSE_COUNTERS)
+    return ip_list
+
+
+def report_top(sketch, top_actions, access_index=None):
+    """Print the --top networks of the sketch and write the --access file
+
+    With the CidrIndex of --cidr, the networks it covers are tagged with
+    its network and only the others are added to the --access file.
+    """
+    top = sketch.top(TOP_NETWORKS)
+    print("\n=== Top", TOP_NETWORKS, "networks by", ", ".join(top_actions), "===")
+    # a network was counted between count - error and count times
+    uncovered = []
+    for ip_key, count, error in top:
+        covering = access_index.covering(ip_key) if access_index is not None else None
+        if covering is None:
+            uncovered.append((network_name(ip_key), "reject"))
+        print(("%9d %-12s %-18s %s" % (count - error, "(+%d)" % error if error else "",
+                                       network_name(ip_key),
+                                       "in " + covering.network if covering else "")).rstrip())
+    print(sketch.total, "actions,", len(sketch.counts), "networks counted")
+    if ACCESS_FILE not in "":
+        write_access_file(access_index, uncovered)
+
+
+def report_access(access_index, ip_list, ip_keys, offender_actions):
+    """Print the --cidr networks matching clients and the uncovered offenders
+
+    The offenders are the ip_keys clients with one of offender_actions,
+    they are covered by a network of the table whatever its action.
+    """
+    stats_phase("access")
+    offenders = [ACTION_INDEX[action] for action in offender_actions]
+    offender_mask = sum(1 << action for action in offenders)
+    host_mask = ~PREFIX_MASK & 0xffffffff
+    networks = access_index.networks
+    active = defaultdict(lambda: [0, 0])  # network index -> [clients, connections]
+    uncovered = []
+    covered = 0
+    for ip_key, owner in zip(ip_keys, access_index.match(ip_keys)):
+        client = ip_list[ip_key]
+        if owner >= 0:
+            counts = active[owner]
+            counts[0] += 1
+            counts[1] += client.connect
+        if client.mask & offender_mask:
+            if owner >= 0 and networks[owner].end >= ip_key | host_mask:
+                covered += 1
+            else:
+                uncovered.append((sum(client.actions[action] for action in offenders),
+                                  client.connect, ip_key))
+
+    print("\n===", len(active), "of the", len(networks), "--cidr networks matched clients ===")
+    print("%9s %11s  %-18s %s" % ("clients", "connections", "network", "action"))
+    for owner, (clients, connections) in sorted(
+            active.items(), key=lambda item: item[1][1], reverse=True)[:ACCESS_REPORT_SIZE]:
+        network = networks[owner]
+        print(("%9d %11d  %-18s %s %s" % (clients, connections, network.network,
+                                          network.action, network.comment)).rstrip())
+
+    print("\n===", len(uncovered), "of the", len(uncovered) + covered, "clients with",
+          ", ".join(offender_actions), "are not covered ===")
+    print("%9s %11s  %s" % ("actions", "connections", "client"))
+    for count, connections, ip_key in sorted(uncovered, reverse=True)[:ACCESS_REPORT_SIZE]:
+        print("%9d %11d  %s" % (count, connections, network_name(ip_key)))
+
+
+def write_access_file(access_index, networks):
+    """Write the --cidr networks then the (network, action) networks to --access"""
+    if access_index is not None:
+        networks = [(network.network, network.action)
+                    for network in access_index.networks] + networks
+    print("Wrote", write_access(ACCESS_FILE, networks), "networks to", ACCESS_FILE)
+
+
+def finish_run(ip_list, profiler):
+    """Dump the --profile and print or write the --stats of the run"""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(PROFILE_FILE)
+        from pstats import Stats
+        print("\n=== profile, see also python -m pstats", PROFILE_FILE, "===", file=stderr)
+        Stats(profiler, stream=stderr).sort_stats("tottime").print_stats(PROFILE_TOP)
+    if STATS or STATS_JSON_FILE not in "":
+        stats = stats_record(ip_list)
+        if STATS:
+            print_stats(stats)
+        if STATS_JSON_FILE not in "":
+            with open(STATS_JSON_FILE + ".tmp", "w") as stats_file:
+                stats_file.write(json_dumps(stats, indent=1, sort_keys=True) + "\n")
+            replace(STATS_JSON_FILE + ".tmp", STATS_JSON_FILE)
+
+
+def main(args=None):
+    """Run postscreen_stats.py with the command line args, sys.argv by default"""
+    # pylint: disable=global-statement,too-many-branches,too-many-statements
+    global CLIENT_TTL, PREFIX_LEN, PREFIX_MASK
+    read_options(argv[1:] if args is None else args)
+
+    # the action filter is compiled once, then tested with a few masks
+    try:
+        filter_terms = compile_filter(ACTION_FILTER)
+    except ValueError as filter_error:
+        print("ERROR: Invalid action filter:", filter_error)
+        usage()
+        exit()
+
+    # the database is only opened if a client has to be geolocated
     if GEOFILE not in "":
-        TOTAL_BLOCKED = Decimal(CLIENTS["blocked clients"])
-        print("\n=== Top 20 Countries of Blocked Clients ===")
-        from operator import itemgetter
-        SORTED_COUNTRIES = BLOCKED_COUNTRIES.items()
-        SORTED_COUNTRIES.sort(key=itemgetter(1), reverse=True)
-        COUNT_FORMAT = ""
-        for i in range(20):
-            if i < len(SORTED_COUNTRIES):
-                country, CLIENTS = SORTED_COUNTRIES[i]
-                if COUNT_FORMAT in "":
-                    COUNT_FORMAT = "%" + str(len(str(CLIENTS))) + "d"
-                client_percent = "(%5.2f%%)" % \
-                    float(Decimal(CLIENTS) / TOTAL_BLOCKED * 100)
-                print(COUNT_FORMAT % CLIENTS, client_percent, country)
-
-# generate the HTML for the map and store it in a file
-if MAPDEST not in "" and GEOFILE not in "":
-    FD = open(MAPDEST, "w")
-    MAPCODE = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
-  "https://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
-<html xmlns="https://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
-    <head>
-        <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
-        <title>Postscreen GeoMap of Blocked IPs</title>
-        <script type="text/javascript"
-            src="https://maps.google.com/maps/api/js?sensor=false"></script>
-        <script type="text/javascript">
-        var ip = new Array();
-        var marker_ip = new Array();
-        var desc_ip = new Array();
-        var info_window = new Array();
-
-            window.onload = function() {
-                var center = new google.maps.LatLng(0,0);
-                var mapOptions = {
-                    zoom: 2,
-                    center: center,
-                    mapTypeId: google.maps.MapTypeId.TERRAIN
-                };
-                var myMap = new google.maps.Map(
-                    document.getElementById('map'),mapOptions
-                );
-'''
-    FD.write(MAPCODE)
-
-    INCR = 0
-    for client in BLOCKED_CLIENTS:
-        if not IP_LIST[client].geoloc is None \
-           and 'latitude' in IP_LIST[client].geoloc \
-           and 'longitude' in IP_LIST[client].geoloc:
-
-            MAPCODE = '''
-            ip[''' + str(INCR) + '''] = new google.maps.LatLng(''' \
-                   + str(IP_LIST[client].geoloc['latitude']) + "," \
-                   + str(IP_LIST[client].geoloc['longitude']) + ''');
-            marker_ip[''' + str(INCR) + '''] = new google.maps.Marker({
-                      position: ip[''' + str(INCR) + '''], map: myMap,
-                      title: "''' + str(client) + '''"});
-            desc_ip[''' + str(INCR) + '''] = '<div id="content">' +
-                    '<div id="siteNotice"></div>' +
-                    '<h2 id="firstHeading" class="firstHeading">' +
-                    ' ''' + str(client) + '''</h2><div id="bodyContent">' +
-                    ' '''
-            FD.write(MAPCODE)
-
-            for log in sorted(IP_LIST[client].logs):
-                if log in ('FIRST SEEN', 'LAST SEEN'):
-                    MAPCODE = '<p>' + log + ": " + str(dt.fromtimestamp(int(
-                        IP_LIST[client].logs[log])).strftime('%Y-%m-%d %H:%M:%S')) \
-                        + '''</p>' + ' '''
-                    FD.write(MAPCODE)
-                else:
-                    MAPCODE = '<p>' + log + ": " + str(IP_LIST[client].logs[log]) + \
-                        '''</p>' + ' '''
-                    FD.write(MAPCODE)
-
-            for action in sorted(IP_LIST[client].actions):
-                if IP_LIST[client].actions[action] > 0:
-                    MAPCODE = '<p>' + action + ": " + \
-                              str(IP_LIST[client].actions[action]) + \
-                              '''</p>' + ' '''
-                    FD.write(MAPCODE)
-
-        if action in 'DNSBL':
-            MAPCODE = '<p>' + "DNSBL ranks: "
-            FD.write(MAPCODE)
-            for rank in IP_LIST[client].dnsbl_ranks:
-                MAPCODE = " " + str(rank) + ","
-                FD.write(MAPCODE)
-                MAPCODE = '''</p>' + ' '''
-                FD.write(MAPCODE)
-
-            if 'city' in IP_LIST[client].geoloc:
-                MAPCODE = '<p>' + 'Location: ' + \
-                    escape(str(IP_LIST[client].geoloc['city'])) + ", " + \
-                    escape(str(IP_LIST[client].geoloc['country_code'])) + \
-                    '''<p> ' + ' '''
-                FD.write(MAPCODE)
-
-                MAPCODE = '''</div></div>';
-  info_window[''' + str(INCR) + '''] = new google.maps.InfoWindow({
-  content: desc_ip[''' + str(INCR) + '''], maxWidth: 500});
-  google.maps.event.addListener(marker_ip[''' + str(INCR) + '''], 'click',
-  function() {
-    info_window[''' + str(INCR) + '''].open(myMap,
-    marker_ip[''' + str(INCR) + ''']);
-             });
-'''
-            INCR += 1
-        FD.write(MAPCODE)
-
-    MAPCODE = '''
-    }
-    </script>
+        if not isfile(GEOFILE):
+            print("ERROR: Cannot find the geolocation database", GEOFILE)
+            exit(1)
+        print("MaxMind GeoLite City database file ", GEOFILE)
+
+    # the log files given with -f, rotated logs oldest first
+    if LOG_PATTERNS:
+        log_files = expand_log_files(LOG_PATTERNS)
+    else:
+        log_files = [LOG_FILE]
+    if (FOLLOW or STATE_FILE not in "") and len(log_files) > 1:
+        print("ERROR: --follow and --state read a single log file")
+        exit(1)
+    if HISTORY_FILE in "" and (HISTORY_QUERY or REPORT_MODE == 'days'):
+        print("ERROR: --query and the days report require the --db history")
+        exit(1)
+    if HISTORY_FILE not in "" and (FOLLOW or STATE_FILE not in ""):
+        print("ERROR: --db keeps its own checkpoint, it cannot be used with --follow or --state")
+        exit(1)
+    if EXPORTER_ADDRESS not in "" and (FOLLOW or STATE_FILE not in "" or HISTORY_FILE not in ""
+                                       or len(log_files) > 1 or not isfile(log_files[-1])
+                                       or log_magic(log_files[-1])):
+        print("ERROR: --exporter follows a single plain log file, without --follow, --state or --db")
+        exit(1)
+    if PREFIX_LEN < 32 and (HISTORY_FILE not in "" or STATE_FILE not in ""):
+        print("ERROR: --db and --state keep the clients by IP, they cannot be used with --prefix")
+        exit(1)
+    if LATENCY and (JOBS > 1 or FOLLOW or EXPORTER_ADDRESS not in "" or TOP_NETWORKS
+                    or HISTORY_QUERY):
+        print("ERROR: --latency pairs the lines of the sessions in a single parse, "
+              "without -j, --follow, --exporter, --top or --query")
+        exit(1)
+    if MERGE_PATTERNS and (FOLLOW or STATE_FILE not in "" or HISTORY_FILE not in ""
+                           or EXPORTER_ADDRESS not in "" or TOP_NETWORKS):
+        print("ERROR: --merge reads the summaries instead of the logs, without --follow, "
+              "--state, --db, --exporter or --top")
+        exit(1)
+    if SUMMARY_FILE not in "" and (FOLLOW or EXPORTER_ADDRESS not in "" or TOP_NETWORKS):
+        print("ERROR: --summary writes the clients of a report, without --follow, "
+              "--exporter or --top")
+        exit(1)
+    if ACCESS_FILE not in "" and not TOP_NETWORKS and not CIDR_FILES:
+        print("ERROR: --access writes the networks of --cidr and of the --top report")
+        exit(1)
+    top_actions = [action.strip() for action in TOP_ACTIONS.split(",")]
+    for action in top_actions:
+        if action not in ACTION_INDEX:
+            print("ERROR: Unknown action", action, "in --top-actions")
+            exit(1)
+
+    # the access tables, an empty table is an error to keep a failed
+    # download from emptying the --access file
+    access_index = None
+    if CIDR_FILES:
+        stats_phase("access")
+        try:
+            access_index = load_access(CIDR_FILES)
+        except IOError as ioe:
+            print("ERROR: Cannot read the --cidr file", ioe)
+            exit(1)
+        if not access_index.networks:
+            print("ERROR: No IPv4 network in the --cidr files", " ".join(CIDR_FILES))
+            exit(1)
+        if ACCESS_FILE not in "" and not TOP_NETWORKS:
+            write_access_file(access_index, [])
+            return
+
+    # the profiler covers the whole run but the -j workers
+    profiler = None
+    if PROFILE_FILE not in "":
+        from cProfile import Profile
+        profiler = Profile()
+        profiler.enable()
+
+    # top offending networks, counted without keeping the clients
+    if TOP_NETWORKS:
+        stats_phase("parse")
+        try:
+            sketch = top_networks(log_files, top_actions,
+                                  max(TOP_NETWORKS * TOP_SKETCH_FACTOR, TOP_SKETCH_SIZE))
+        except IOError as ioe:
+            print("Cannot open maillog! ", ioe)
+            exit(1)
+        stats_phase("report")
+        report_top(sketch, top_actions, access_index)
+        finish_run({}, profiler)
+        return
+
+    if EXPORTER_ADDRESS not in "":
+        try:
+            export_metrics(log_files[-1], EXPORTER_ADDRESS)
+        except KeyboardInterrupt:
+            exit()
+
+    if FOLLOW:
+        windows = [RollingWindow(window, parse_duration(window))
+                   for window in FOLLOW_WINDOWS.split(",")]
+        # by default, the clients are kept as long as the largest window
+        if not CLIENT_TTL:
+            CLIENT_TTL = max(window.span for window in windows)
+        print("Following", log_files[-1], "- statistics every", FOLLOW_INTERVAL, "seconds")
+        try:
+            follow_log(log_files[-1], OrderedDict(), windows)
+        except KeyboardInterrupt:
+            exit()
+
+    # history mode: add the new lines to the database, then report from
+    # the database
+    history = open_history(HISTORY_FILE) if HISTORY_FILE not in "" else None
+    sessions = SessionTracker() if LATENCY else None
+    if MERGE_PATTERNS:
+        # the clients of the summaries of the relays instead of the logs
+        stats_phase("merge")
+        summary_files = expand_log_files(MERGE_PATTERNS)
+        try:
+            metadata, merged_clients = merge_summaries(summary_files)
+            print("Merged", len(summary_files), "summaries of", ", ".join(metadata["hosts"]))
+            # the clients of the summaries are keyed by their networks
+            if PREFIX_LEN < 32 and metadata["prefix"] != PREFIX_LEN:
+                print("ERROR: the summaries are of /%d networks, not of --prefix=%d"
+                      % (metadata["prefix"], PREFIX_LEN))
+                exit(1)
+            PREFIX_LEN = metadata["prefix"]
+            PREFIX_MASK = (0xffffffff << (32 - PREFIX_LEN)) & 0xffffffff
+            PARSE_COUNTERS.update(metadata["counters"])
+            # -i filters the clients of the summaries like the log lines
+            ip_filter = IP_FILTER.strip()
+            if ip_filter:
+                merged_clients = ((ip_key, client) for ip_key, client in merged_clients
+                                  if ip_filter in int_to_ip(ip_key))
+            # a summary of the summaries only is written as they are merged
+            if (SUMMARY_FILE not in "" and REPORT_MODE == 'none' and EXPORT_FILE in ""
+                    and MAPDEST in "" and access_index is None):
+                stats_phase("summary")
+                print("Wrote", write_summary(SUMMARY_FILE, merged_clients, metadata),
+                      "clients to", SUMMARY_FILE)
+                finish_run({}, profiler)
+                return
+            ip_list = dict(merged_clients)
+        except IOError as ioe:
+            print("ERROR: Cannot merge the summaries", ioe)
+            exit(1)
+        if sessions is not None and metadata["latency"] is not None:
+            sessions.add_record(metadata["latency"])
+    else:
+        stats_phase("parse")
+        try:
+            ip_list = parse_logs(history, log_files, filter_terms, sessions)
+        except IOError as ioe:
+            print("Cannot open maillog! ", ioe)
+            exit(1)
+        metadata = summary_metadata(sessions)
+
+    # the summary of the clients, for a merge with the other relays
+    if SUMMARY_FILE not in "":
+        stats_phase("summary")
+        print("Wrote", write_summary(SUMMARY_FILE, sorted(ip_list.items(), key=itemgetter(0)),
+                                     metadata), "clients to", SUMMARY_FILE)
+
+    # daily rollups of the history
+    if REPORT_MODE == 'days':
+        stats_phase("report")
+        report_days(history, HISTORY_SINCE, HISTORY_UNTIL)
+
+    # normal report mode
+    aggregates = None
+    blocked_clients = []
+    if REPORT_MODE in ('short', 'full', 'none'):
+        stats_phase("aggregation")
+        # basic accounting of the clients matching the action filter
+        aggregates = aggregate_clients(ip_list, filter_terms)
+        blocked_clients = aggregates.blocked_clients
+
+    # the exported clients match the action filter like the report
+    if EXPORT_FILE not in "":
+        export_keys = [client for client, stats in ip_list.items()
+                       if stats.action_filter(filter_terms)]
+
+    # geolocation of the reported and mapped clients only, once the log is parsed
+    blocked_countries = None
+    if GEOFILE not in "":
+        stats_phase("geolocation")
+        if REPORT_MODE in ('full', 'ip'):
+            geo_keys = list(ip_list)
+        elif EXPORT_FILE not in "":
+            geo_keys = export_keys
+        elif REPORT_MODE == 'short':
+            geo_keys = blocked_clients
+        else:
+            geo_keys = [client for client in blocked_clients
+                        if ip_list[client].connect >= MAP_MIN_CONN] if MAPDEST not in "" else []
+        geo_cache = load_geo_cache(GEO_CACHE_FILE, GEOFILE) if GEO_CACHE_FILE not in "" else {}
+        locate_clients(ip_list, geo_keys, geo_cache)
+        if GEO_CACHE_FILE not in "":
+            save_geo_cache(GEO_CACHE_FILE, GEOFILE, geo_cache)
+        blocked_clients = [client for client in blocked_clients if ip_list[client].geoloc]
+        if aggregates is not None:
+            blocked_countries = count_countries(ip_list, blocked_clients)
+            aggregates.clients_stats["blocked clients"] = len(blocked_clients)
+
+    # additional reports shown in full mode only
+    if REPORT_MODE in ('full', 'ip'):
+        stats_phase("full report")
+        print_clients(ip_list, access_index=access_index)
+
+    if REPORT_MODE in ('short', 'full'):
+        stats_phase("report")
+        print_report(aggregates, blocked_countries)
+
+    if sessions is not None and REPORT_MODE in ('short', 'full'):
+        print_latency(sessions)
+
+    # the clients matched by the access tables
+    if access_index is not None and REPORT_MODE in ('short', 'full', 'ip'):
+        report_access(access_index, ip_list, [client for client, stats in ip_list.items()
+                                              if stats.action_filter(filter_terms)],
+                      top_actions)
+
+    # export the table of the clients
+    if EXPORT_FILE not in "":
+        stats_phase("export")
+        export_clients(EXPORT_FILE, EXPORT_FORMAT, ip_list, export_keys)
+        print("Exported", len(export_keys), "clients to", EXPORT_FILE)
+
+    # generate the HTML for the map and store it in a file
+    if MAPDEST not in "" and GEOFILE not in "":
+        stats_phase("map")
+        mapped_clients = [client for client in blocked_clients
+                          if ip_list[client].connect >= MAP_MIN_CONN]
+        with open(MAPDEST, "w") as map_file:
+            map_file.write(render_map(ip_list, mapped_clients))
+        print("Created HTML map file at ", MAPDEST)
+
+    finish_run(ip_list, profiler)
+
+
+# VARIABLES
+IP_REGEXP = r"((?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}" \
+            "(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))"
+IP_SEARCH = re_compile(IP_REGEXP).search
+IP_REGEXP_FULL = re_compile(IP_REGEXP + "$")
+IP_STRUCT = Struct("!I")
+pack_ip = IP_STRUCT.pack  # pylint: disable=invalid-name
+unpack_ip = IP_STRUCT.unpack  # pylint: disable=invalid-name
+GRAYLIST_ACTION = "NOQUEUE 450 deep protocol test reconnection"
+
+# upper bounds (inclusive) in seconds of the graylist reconnection delay
+# buckets, the last bucket has no bound
+COMEBACK_EDGES = [10, 30, 60, 300, 1800, 7200, 18000, 43200, 86400]
+COMEBACK_BUCKETS = ['<=10s', '10s to 30s', '>30s to 1min', '>1min to 5min',
+                    '>5 min to 30min', '>30min to 2h', '>2h to 5h',
+                    '>5h to 12h', '>12h to 24h', '>24h']
+# width of the COMEBACK_BUCKETS columns in the report
+COMEBACK_WIDTHS = [6, 8, 8, 7, 8, 9, 8, 9, 9, 5]
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# postscreen action token -> ((detail matcher, action name), ...)
+# the first matcher accepting the detail of the line counts its action,
+# a matcher of None counts the action whatever the detail is
+ACTION_TABLE = {
+    "PASS": ((re_compile("OLD").match, "PASS OLD"),
+             (re_compile("NEW").match, "PASS NEW")),
+    "NOQUEUE:": ((re_compile("too many connections").search,
+                  "NOQUEUE too many connections"),
+                 (re_compile("all server ports busy").search,
+                  "NOQUEUE all server ports busy"),
+                 (re_compile("450 4.3.2 Service currently unavailable").search,
+                  "NOQUEUE 450 deep protocol test reconnection")),
+    "HANGUP": ((None, "HANGUP"),),
+    "DNSBL": ((None, "DNSBL"),),
+    "PREGREET": ((None, "PREGREET"),),
+    "COMMAND": ((re_compile("PIPELINING").match, "COMMAND PIPELINING"),
+                (re_compile("TIME LIMIT").match, "COMMAND TIME LIMIT"),
+                (re_compile("COUNT LIMIT").match, "COMMAND COUNT LIMIT"),
+                (re_compile("LENGTH LIMIT").match, "COMMAND LENGTH LIMIT")),
+    "WHITELISTED": ((None, "WHITELISTED"),),
+    "BLACKLISTED": ((None, "BLACKLISTED"),),
+    "BARE": ((re_compile("NEWLINE").match, "BARE NEWLINE"),),
+    "NON-SMTP": ((re_compile("COMMAND").match, "NON-SMTP COMMAND"),),
+    "WHITELIST": ((re_compile("VETO").match, "WHITELIST VETO"),),
+}
+# tokens of the action filter: operators and action names
+FILTER_TOKENS = re_compile(r"[&|!()]|[^&|!()]+")
+ACTION_NAMES = frozenset(action for rules in ACTION_TABLE.values()
+                         for _, action in rules)
+
+# the clients count their actions in an array indexed like ACTIONS, and
+# parse_lines() uses ACTION_RULES, the ACTION_TABLE with these indexes
+ACTIONS = tuple(sorted(ACTION_NAMES))
+ACTION_INDEX = dict((action, index) for index, action in enumerate(ACTIONS))
+ACTION_RULES = dict((token, tuple((detail_match, ACTION_INDEX[action])
+                                  for detail_match, action in rules))
+                    for token, rules in ACTION_TABLE.items())
+NO_ACTIONS = array("I", [0] * len(ACTIONS))
+PASS_OLD = ACTION_INDEX["PASS OLD"]
+DNSBL = ACTION_INDEX["DNSBL"]
+GRAYLIST = ACTION_INDEX[GRAYLIST_ACTION]
+# a client with one of these actions was blocked by postscreen
+BLOCKED_ACTIONS = [ACTION_INDEX[action] for action in (
+    "BLACKLISTED", "DNSBL", "PREGREET", "COMMAND PIPELINING",
+    "COMMAND TIME LIMIT", "COMMAND COUNT LIMIT", "COMMAND LENGTH LIMIT",
+    "BARE NEWLINE", "NON-SMTP COMMAND")]
+BLOCKED_MASK = sum(1 << action for action in BLOCKED_ACTIONS)
+# the events yielded by postscreen_events(), and the aggregates of the
+# clients returned by aggregate_clients()
+PostscreenEvent = namedtuple("PostscreenEvent", ("syslog_date", "ip", "event", "value"))
+Aggregates = namedtuple("Aggregates", ("postscreen_stats", "clients_stats", "comeback",
+                                       "unique_clients", "blocked_clients"))
+# a network of a --cidr table, start and end are its first and last IPs
+AccessNetwork = namedtuple("AccessNetwork", ("network", "start", "end", "action", "comment"))
+
+# settings of the command line, read_options() sets them
+IP_FILTER = " "
+ACTION_FILTER = None
+NOW = dt.now()
+NOW_TS = mktime(NOW.timetuple())
+YEAR = NOW.year
+REPORT_MODE = "short"
+LOG_FILE = "/var/log/maillog"
+LOG_PATTERNS = []
+GEOFILE = ""
+MAPDEST = ""
+RFC3339 = False
+MAP_MIN_CONN = 0
+MAP_TILES = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+MAP_ASSETS = ""
+MAP_HEAT = False
+EXPORT_FILE = ""
+HISTORY_FILE = ""
+HISTORY_QUERY = False
+HISTORY_SINCE = ""
+HISTORY_UNTIL = ""
+EXPORT_FORMAT = ""
+GEO_CACHE_FILE = ""
+JOBS = 1
+STATE_FILE = ""
+FOLLOW = False
+FOLLOW_INTERVAL = 60
+FOLLOW_WINDOWS = "5m,1h,24h"
+CLIENT_TTL = 0
+MAX_CLIENTS = 1000000
+EXPORTER_ADDRESS = ""
+PREFIX_LEN = 32
+TOP_NETWORKS = 0
+TOP_ACTIONS = "DNSBL,PREGREET,HANGUP"
+ACCESS_FILE = ""
+CIDR_FILES = []
+LATENCY = False
+SUMMARY_FILE = ""
+MERGE_PATTERNS = []
+
+# size of the blocks read from the log files
+READ_BLOCK_SIZE = 1 << 20
+# memory-map the plain log files with less than one wanted line out of
+SPARSE_RATIO = 4
+# magic bytes of the compressed log files
+LOG_MAGICS = (("gzip", b"\x1f\x8b"), ("bzip2", b"BZh"),
+              ("xz", b"\xfd7zXZ\x00"), ("zstd", b"\x28\xb5\x2f\xfd"))
+
+# version of the --geocache file format
+GEO_CACHE_VERSION = 1
+
+# the --geofile database, opened by geo_lookup() on the first lookup
+GI = None
+GEO_LOOKUP = None
+# MaxMind DB files end with their metadata, after this marker
+MMDB_METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+MMDB_METADATA_SIZE = 128 * 1024
+# IPs to geolocate before the lookups are split between the workers
+GEO_BATCH_SIZE = 10000
+
+# the HTML map is built from these parts around the JSON data
+MAP_HEAD = """<!DOCTYPE html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8" />
+    <title>Postscreen GeoMap of Blocked IPs</title>
     <style type="text/css">
         #map {
             width:100%;
             height:800px;
         }
     </style>
-  </head>
-  <body>
-    <h1>Postscreen Map of Blocked IPs</h1>
-    <div id="map"></div>
-    <p>mapping ''' + str(len(BLOCKED_CLIENTS)) + ''' blocked IPs</p>
-    <p>generated using
+"""
+MAP_FOOTER = """    <p>generated using
     <a href="https://github.com/jvehent/Postscreen-Stats">Postscreen-Stats</a>
     by <a href="https://jve.linuxwall.info/">Julien Vehent</a></p>
-  </body>
-</html>
-'''
-    FD.write(MAPCODE)
-    FD.close()
-    print("Created HTML map file at ", MAPDEST)
+"""
+MAP_SCRIPT = """    var map = L.map("map").setView([0, 0], 2);
+    L.tileLayer(MAP_TILES, {
+        maxZoom: 18,
+        attribution: "&copy; OpenStreetMap contributors"
+    }).addTo(map);
+
+    function text(value) {
+        var node = document.createElement("span");
+        node.textContent = value;
+        return node.innerHTML;
+    }
+    function date(seconds) {
+        var day = new Date(seconds * 1000);
+        function pad(value) { return (value < 10 ? "0" : "") + value; }
+        return day.getFullYear() + "-" + pad(day.getMonth() + 1) + "-" +
+            pad(day.getDate()) + " " + pad(day.getHours()) + ":" +
+            pad(day.getMinutes()) + ":" + pad(day.getSeconds());
+    }
+    // the popup of a point is only built when it is opened
+    function popup(point) {
+        var html = "<h3>" + text(point[2]) + "</h3><p>" + point[3] +
+            " blocked IPs, " + point[4] + " connections</p>";
+        point[5].forEach(function (client) {
+            html += "<h4>" + client[0] + "</h4><p>CONNECT: " + client[1] +
+                "<br/>FIRST SEEN: " + date(client[2]) +
+                "<br/>LAST SEEN: " + date(client[3]);
+            if (client[4]) {
+                html += "<br/>RECO. DELAY (graylist): " + client[4];
+            }
+            for (var i = 0; i < client[5].length; i += 2) {
+                html += "<br/>" + text(MAP_DATA.actions[client[5][i]]) + ": " +
+                    client[5][i + 1];
+            }
+            if (client[6].length) {
+                html += "<br/>DNSBL ranks: " + client[6].join(", ");
+            }
+            html += "</p>";
+        });
+        if (point[5].length < point[3]) {
+            html += "<p>... and " + (point[3] - point[5].length) + " more</p>";
+        }
+        return html;
+    }
+
+    if (MAP_HEAT) {
+        L.heatLayer(MAP_DATA.points.map(function (point) {
+            return [point[0], point[1], point[3]];
+        }), {radius: 15}).addTo(map);
+    } else {
+        // the clusters show the count of IPs of their points
+        var clusters = L.markerClusterGroup({
+            chunkedLoading: true,
+            iconCreateFunction: function (cluster) {
+                var count = 0;
+                cluster.getAllChildMarkers().forEach(function (marker) {
+                    count += marker.options.count;
+                });
+                var size = count < 100 ? "small" : count < 1000 ? "medium" : "large";
+                return L.divIcon({
+                    html: "<div><span>" + count + "</span></div>",
+                    className: "marker-cluster marker-cluster-" + size,
+                    iconSize: L.point(40, 40)
+                });
+            }
+        });
+        clusters.addLayers(MAP_DATA.points.map(function (point) {
+            var marker = L.marker([point[0], point[1]], {
+                count: point[3], title: point[2] + " (" + point[3] + ")"});
+            marker.bindPopup(function () { return popup(point); }, {maxWidth: 500});
+            return marker;
+        }));
+        map.addLayer(clusters);
+    }
+"""
+
+# the Leaflet files of the map, unless --map-assets gives a local copy
+MAP_CDN = {
+    "leaflet.js": "https://unpkg.com/leaflet@1.9.4/dist/leaflet.js",
+    "leaflet.css": "https://unpkg.com/leaflet@1.9.4/dist/leaflet.css",
+    "leaflet.markercluster.js":
+        "https://unpkg.com/leaflet.markercluster@1.5.3/dist/leaflet.markercluster.js",
+    "MarkerCluster.css":
+        "https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.css",
+    "MarkerCluster.Default.css":
+        "https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.Default.css",
+    "leaflet-heat.js": "https://unpkg.com/leaflet.heat@0.2.0/dist/leaflet-heat.js"}
+# the --export writers, and the formats of the file extensions
+EXPORT_WRITERS = {"csv": export_csv, "jsonl": export_jsonl,
+                  "sqlite": export_sqlite, "parquet": export_parquet}
+EXPORT_EXTENSIONS = {"csv": "csv", "json": "jsonl", "jsonl": "jsonl", "ndjson": "jsonl",
+                     "db": "sqlite", "sqlite": "sqlite", "sqlite3": "sqlite",
+                     "parquet": "parquet"}
+# rows written at once to the --export file
+EXPORT_BATCH_SIZE = 10000
+# characters of the action names replaced in the SQL and --export columns
+COLUMN_NAME = re_compile(r"[^a-z0-9]+")
+# days rolled up by a query of the --db history
+HISTORY_BATCH_SIZE = 500
+
+# clients detailed in the popup of a location of the map
+MAP_POPUP_CLIENTS = 20
+
+# the clients keys are their IP & PREFIX_MASK, the network of --prefix
+PREFIX_MASK = 0xffffffff
+# networks counted by --top for each network of the report, and at least
+TOP_SKETCH_FACTOR = 100
+TOP_SKETCH_SIZE = 10000
+# actions of a postscreen_access.cidr table, a --cidr line with another
+# action (a DROP list) rejects its network, and rows of the --cidr report
+ACCESS_ACTIONS = ("permit", "reject", "dunno")
+ACCESS_REPORT_SIZE = 20
+
+# --latency: the client [IP]:port of a session, the delay logged by the
+# PREGREET and HANGUP lines, and the open sessions kept at most
+SESSION_SEARCH = re_compile(r"\[([0-9.]+)\]:([0-9]+)").search
+AFTER_SEARCH = re_compile(r"after ([0-9.]+) from").search
+TIMED_TOKENS = frozenset(("PREGREET", "HANGUP"))
+SESSION_LIMIT = 100000
+# the session ends without a DISCONNECT after these actions, postscreen
+# hands the connection to smtpd, or drops it (BLACKLISTED with the drop
+# postscreen_blacklist_action)
+DECISION_ACTIONS = frozenset(ACTION_INDEX[action] for action in (
+    "PASS OLD", "PASS NEW", "WHITELISTED", "BLACKLISTED",
+    "NOQUEUE too many connections", "NOQUEUE all server ports busy"))
+# the LatencySketch buckets are 2% wide from 1ms, a quantile is within 2%
+LATENCY_MIN = 0.001
+LATENCY_GAMMA = 1.02
+LATENCY_SCALE = 1 / math_log(LATENCY_GAMMA)
+
+# --summary files: magic, version and header of the blocks of clients,
+# clients per block, types of the columns before the actions, graylist
+# delay of the clients without one and zlib level
+SUMMARY_MAGIC = b"PSSTATS\x00"
+SUMMARY_VERSION = 1
+SUMMARY_HEADER = Struct("<II")
+SUMMARY_BLOCK_SIZE = 65536
+SUMMARY_TYPECODES = "IqqIq"
+SUMMARY_NO_DELAY = -1 << 63
+SUMMARY_COMPRESSION = 6
+
+# --exporter: seconds between two snapshots of the metrics, and the
+# content types of the OpenMetrics and Prometheus text formats
+EXPORTER_INTERVAL = 1
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# version of the --state file format
+STATE_VERSION = 3
+
+# --stats: version of the --stats-json record, phase -> [wall, CPU] seconds
+# and the running [phase, wall, CPU] start, lines counted by the readers
+# and parse_lines()
+STATS = False
+STATS_JSON_FILE = ""
+PROFILE_FILE = ""
+STATS_VERSION = 1
+PHASE_TIMES = OrderedDict()
+PHASE_START = [None, 0, 0]
+PARSE_COUNTERS = defaultdict(int)
+# functions listed by --profile, with the most time spent inside them
+PROFILE_TOP = 25
+
+# syslog time stamp conversion caches: minute prefix -> unix time stamp
+# and the last converted (time stamp, unix time stamp)
+MINUTE_TS_CACHE = {}
+# syslog month and day -> YYYY-MM-DD day of the --db history
+DAY_CACHE = {}
+LAST_TS = [None, 0]
+
+# position of 'postscreen' inside the logs
+LOG_CURSOR = 5
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        # the reader of the report is gone, like head, point stdout to
+        # /dev/null so that its flush at exit does not fail again
+        dup2(os_open(devnull, O_WRONLY), stdout.fileno())
+        exit(1)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""Checks mail servers and postscreen clients against DNS blocklists."""
+
+import asyncio
+from collections import OrderedDict, defaultdict
+from getopt import GetoptError, getopt
+from json import dump as json_dump, load as json_load
+from os import replace
+from random import getrandbits
+from socket import inet_aton, inet_ntoa
+from struct import Struct, error as struct_error
+from sys import argv, exit, stdin  # pylint: disable=redefined-builtin
+from time import time
+
+
+def usage():
+    """Prints the usage of the program."""
+    print("""
+rbl_check.py
+    checks IPv4 addresses against DNS blocklists, with concurrent queries
+
+usage: rbl_check.py [options] [server ...]
+
+  server        DNS name or IP of a mail server to check, the names are
+                resolved to their IPv4 addresses first
+
+  --ips=        file of the IPs to check, the first word of each line, or -
+                for stdin (the lines which do not start with an IP are
+                skipped, ex. the output of postscreen_stats.py -r full)
+  --maillog=    check the clients ranked by a DNSBL in this postscreen log,
+                parsed by postscreen_stats.py
+  --clients=    count of the --maillog clients checked, the most often
+                ranked ones (default is 100)
+  --rfc3339     the --maillog time stamps are in the RFC 3339 format
+
+  --rbls=       comma or space separated DNSBL zones (default is the list
+                of rbl-check.sh)
+  --resolver=   ip[:port] of the recursive DNS resolver queried (default is
+                the first IPv4 nameserver of /etc/resolv.conf)
+  --concurrency=    maximum count of queries in flight (default is 100)
+  --timeout=    seconds waited for each answer (default is 2)
+  --retries=    queries sent again after a timeout or SERVFAIL (default 2)
+  --cache=      JSON file keeping the answers until their DNS TTL expires,
+                between the runs
+
+  -v|--verbose  print each check and its negative results, and the query
+                statistics
+
+example command:
+$ rbl_check.py --maillog=/var/log/maillog --clients=500 mx1.example.com
+""")
+
+
+# DNS message header and fixed part of the questions and resource records
+DNS_HEADER = Struct("!HHHHHH")
+DNS_QUESTION = Struct("!HH")
+DNS_RECORD = Struct("!HHIH")
+DNS_SOA_TIMERS = Struct("!IIIII")
+DNS_FLAG_RD = 0x0100
+DNS_FLAG_TC = 0x0200
+DNS_TYPES = {"A": 1, "TXT": 16}
+DNS_SOA = 6
+DNS_CLASS_IN = 1
+# response codes, SERVFAIL is worth a retry and the others are not
+NOERROR = 0
+SERVFAIL = 2
+NXDOMAIN = 3
+
+
+def encode_query(query_id, name, qtype):
+    """Return the DNS query message of name for the record type qtype"""
+    qname = b""
+    for label in name.rstrip(".").split("."):
+        label = label.encode("ascii")
+        if not label or len(label) > 63:
+            raise ValueError("invalid DNS name " + name)
+        qname += bytes((len(label),)) + label
+    return (DNS_HEADER.pack(query_id, DNS_FLAG_RD, 1, 0, 0, 0) + qname + b"\0" +
+            DNS_QUESTION.pack(DNS_TYPES[qtype], DNS_CLASS_IN))
+
+
+def skip_name(message, offset):
+    """Return the offset following the DNS name at offset in message"""
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            # a compression pointer ends the name
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def decode_txt(rdata):
+    """Return the character strings of a TXT record joined in one string"""
+    strings = []
+    offset = 0
+    while offset < len(rdata):
+        length = rdata[offset]
+        strings.append(rdata[offset + 1:offset + 1 + length].decode("utf-8", "replace"))
+        offset += length + 1
+    return "".join(strings)
+
+
+def decode_response(message, query):
+    """Decode a DNS response to query, return (rcode, records, ttl)
+
+    The records are the dotted IPs of the A answers or the strings of the
+    TXT answers, the CNAME chain is skipped. ttl is the smallest TTL of the
+    answers, or for a negative answer the SOA minimum of the authority
+    section, and None when the response has neither. A truncated TXT
+    response keeps the complete records before the truncation.
+    """
+    _, flags, _, answers, authorities, _ = DNS_HEADER.unpack_from(message)
+    rcode = flags & 0xf
+    qtype = DNS_QUESTION.unpack_from(query, len(query) - DNS_QUESTION.size)[0]
+    offset = len(query)
+    records = []
+    ttl = None
+    try:
+        for section, count in (("answer", answers), ("authority", authorities)):
+            for _ in range(count):
+                offset = skip_name(message, offset)
+                rtype, _, record_ttl, length = DNS_RECORD.unpack_from(message, offset)
+                offset += DNS_RECORD.size
+                rdata = message[offset:offset + length]
+                if len(rdata) < length:
+                    raise IndexError("truncated record")
+                offset += length
+                if section == "answer":
+                    if rtype != qtype:
+                        continue
+                    if rtype == DNS_TYPES["A"]:
+                        records.append(inet_ntoa(rdata))
+                    else:
+                        records.append(decode_txt(rdata))
+                    ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+                elif rtype == DNS_SOA and not records:
+                    # RFC 2308: a negative answer is cached for the SOA minimum
+                    minimum = DNS_SOA_TIMERS.unpack(rdata[-DNS_SOA_TIMERS.size:])[4]
+                    ttl = min(record_ttl, minimum)
+    except (IndexError, struct_error):
+        if not flags & DNS_FLAG_TC:
+            raise ValueError("malformed DNS response")
+    return rcode, records, ttl
+
+
+class DnsClient(asyncio.DatagramProtocol):
+    """Stub resolver sending concurrent DNS queries on one UDP socket
+
+    The queries in flight are matched to the responses by their ID and
+    question, at most concurrency of them at a time. A query unanswered
+    after timeout seconds, or answered by SERVFAIL, is sent again retries
+    times. The answers are cached in cache, {"name type": [expires,
+    records]}, until their TTL expires, and a query already in flight is
+    shared by all the checks asking for it.
+    """
+    def __init__(self, concurrency, timeout, retries, cache):
+        self.transport = None
+        self.pending = {}
+        self.inflight = {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self.counters = defaultdict(int)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < DNS_HEADER.size:
+            return
+        entry = self.pending.get(DNS_HEADER.unpack_from(data)[0])
+        if entry is None:
+            return
+        query, future = entry
+        # the question of the response must be the one of the query
+        question = query[DNS_HEADER.size:]
+        if data[DNS_HEADER.size:len(query)].lower() == question.lower() and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # an ICMP error of a query, its timeout sends it again
+        self.counters["socket errors"] += 1
+
+    async def query(self, name, qtype):
+        """Return the records of name for qtype, or None on failure"""
+        key = name.lower() + " " + qtype
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > time():
+            self.counters["cache hits"] += 1
+            return cached[1]
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self.resolve(name, qtype, key))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.counters["shared queries"] += 1
+        return await task
+
+    async def resolve(self, name, qtype, key):
+        """Send the query of name until it is answered, cache the answer"""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            for _ in range(self.retries + 1):
+                query_id = getrandbits(16)
+                while query_id in self.pending:
+                    query_id = getrandbits(16)
+                query = encode_query(query_id, name, qtype)
+                future = loop.create_future()
+                self.pending[query_id] = (query, future)
+                self.counters["queries sent"] += 1
+                self.transport.sendto(query)
+                try:
+                    response = await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    self.counters["timeouts"] += 1
+                    continue
+                finally:
+                    del self.pending[query_id]
+                try:
+                    rcode, records, ttl = decode_response(response, query)
+                except ValueError:
+                    self.counters["malformed responses"] += 1
+                    continue
+                if rcode == SERVFAIL:
+                    self.counters["SERVFAIL"] += 1
+                    continue
+                if rcode not in (NOERROR, NXDOMAIN):
+                    self.counters["refused queries"] += 1
+                    return None
+                if ttl is None:
+                    ttl = NEGATIVE_TTL
+                if ttl > 0:
+                    self.cache[key] = [time() + ttl, records]
+                return records
+        self.counters["failed queries"] += 1
+        return None
+
+
+def reverse_ip(address):
+    """Return the octets of a dotted IPv4 address in the DNSBL order"""
+    return ".".join(reversed(address.split(".")))
+
+
+async def check_listing(client, address, rbl):
+    """Return the (A records, TXT records) of address in rbl
+
+    The A records are None when the lookup failed and empty when address
+    is not listed, the TXT records are only queried for a listed address.
+    """
+    name = reverse_ip(address) + "." + rbl
+    result = await client.query(name, "A")
+    if not result:
+        return result, []
+    return result, await client.query(name, "TXT") or []
+
+
+async def resolve_servers(client, servers):
+    """Return the (label, IP) to check of each mail server name or IP"""
+    targets = []
+    names = [server for server in servers if not is_ip(server)]
+    addresses = dict(zip(names, await asyncio.gather(*[client.query(name, "A") for name in names])))
+    for server in servers:
+        if is_ip(server):
+            targets.append((server, server))
+        elif addresses[server]:
+            targets.extend(("%s (%s)" % (server, address), address)
+                           for address in addresses[server])
+        else:
+            print("DNS name lookup of %s failed to resolve to an Internet IPv4 "
+                  "address. Skipping!" % server)
+    return targets
+
+
+def is_ip(address):
+    """Return True if address is a dotted quad IPv4 address"""
+    try:
+        return inet_ntoa(inet_aton(address)) == address
+    except OSError:
+        return False
+
+
+def read_ips(ip_file):
+    """Return the IPs starting the lines of ip_file, - for stdin"""
+    ips = []
+    with (stdin if ip_file == "-" else open(ip_file)) as lines:
+        for line in lines:
+            words = line.split(None, 1)
+            if words and is_ip(words[0]):
+                ips.append(words[0])
+    return ips
+
+
+def dnsbl_clients(log_file, count, rfc3339):
+    """Return the count IPs of log_file most often ranked by a DNSBL"""
+    import postscreen_stats
+    postscreen_stats.set_log_format(rfc3339=rfc3339)
+    aggregator = postscreen_stats.Aggregator()
+    for maillog_file in postscreen_stats.expand_log_files([log_file]):
+        with postscreen_stats.open_log(maillog_file) as maillog:
+            aggregator.feed(postscreen_stats.postscreen_lines(maillog))
+    dnsbl = postscreen_stats.DNSBL
+    ranked = sorted(((client.actions[dnsbl], ip_key)
+                     for ip_key, client in aggregator.clients.items()
+                     if client.actions[dnsbl]), reverse=True)
+    return [postscreen_stats.int_to_ip(ip_key) for _, ip_key in ranked[:count]]
+
+
+async def check_all(servers, ips, rbls, resolver, cache):
+    """Check the servers and the ips against the rbls, print the results"""
+    loop = asyncio.get_running_loop()
+    client = DnsClient(CONCURRENCY, TIMEOUT, RETRIES, cache)
+    transport, _ = await loop.create_datagram_endpoint(lambda: client, remote_addr=resolver)
+    start = time()
+    try:
+        targets = await resolve_servers(client, servers) + [(ip, ip) for ip in ips]
+        checks = [(label, address, rbl) for label, address in targets for rbl in rbls]
+        results = await asyncio.gather(*[check_listing(client, address, rbl)
+                                         for _, address, rbl in checks])
+    finally:
+        transport.close()
+    for (label, address, rbl), (result, text) in zip(checks, results):
+        if VERBOSE:
+            print("testing %s against %s" % (label, rbl))
+        if result is None:
+            print("%s could not be checked against %s: no answer from %s" % (
+                label, rbl, resolver[0]))
+        elif not result:
+            if VERBOSE:
+                print("`->negative")
+        elif all(record.startswith(DNSBL_ERROR) for record in result):
+            print("%s could not be checked against %s: query refused with %s" % (
+                label, rbl, " ".join(result)))
+        elif text:
+            print("%s is in %s with result %s and text %s" % (
+                label, rbl, " ".join(result), " ".join(text)))
+        else:
+            print("%s is in %s with result %s" % (label, rbl, " ".join(result)))
+    if VERBOSE:
+        print("%d checks in %.2fs: %s" % (len(checks), time() - start, ", ".join(
+            "%d %s" % (count, name) for name, count in sorted(client.counters.items()))))
+
+
+def default_resolver():
+    """Return the first IPv4 nameserver of /etc/resolv.conf"""
+    try:
+        with open(RESOLV_CONF) as resolv_conf:
+            for line in resolv_conf:
+                words = line.split()
+                if len(words) > 1 and words[0] == "nameserver" and is_ip(words[1]):
+                    return words[1]
+    except IOError:
+        pass
+    return "127.0.0.1"
+
+
+def load_cache(cache_file):
+    """Return the unexpired answers of cache_file, empty if it is missing"""
+    try:
+        with open(cache_file) as saved:
+            cache = json_load(saved)
+    except (IOError, ValueError):
+        return {}
+    now = time()
+    return {key: entry for key, entry in cache.items() if entry[0] > now}
+
+
+def save_cache(cache_file, cache):
+    """Write the unexpired answers of cache to cache_file"""
+    now = time()
+    with open(cache_file + ".tmp", "w") as saved:
+        json_dump({key: entry for key, entry in cache.items() if entry[0] > now}, saved)
+    replace(cache_file + ".tmp", cache_file)
+
+
+def read_options(args):
+    """Set the module settings from the command line arguments"""
+    global RBLS, RESOLVER, CONCURRENCY, TIMEOUT, RETRIES, CACHE_FILE  # pylint: disable=global-statement
+    global IP_FILE, LOG_FILE, CLIENTS, RFC3339, VERBOSE  # pylint: disable=global-statement
+    try:
+        args_list, servers = getopt(args, 'hv', [
+            'ips=', 'maillog=', 'clients=', 'rfc3339', 'rbls=', 'resolver=',
+            'concurrency=', 'timeout=', 'retries=', 'cache=', 'verbose', 'help'])
+    except GetoptError as error:
+        print("ERROR:", error)
+        exit(1)
+    for argument, value in args_list:
+        if argument == '--ips':
+            IP_FILE = value
+        elif argument == '--maillog':
+            LOG_FILE = value
+        elif argument == '--clients':
+            CLIENTS = int(value)
+        elif argument == '--rfc3339':
+            RFC3339 = True
+        elif argument == '--rbls':
+            RBLS = value.replace(",", " ").split()
+        elif argument == '--resolver':
+            RESOLVER = value
+        elif argument == '--concurrency':
+            CONCURRENCY = int(value)
+        elif argument == '--timeout':
+            TIMEOUT = float(value)
+        elif argument == '--retries':
+            RETRIES = int(value)
+        elif argument == '--cache':
+            CACHE_FILE = value
+        elif argument in ('-v', '--verbose'):
+            VERBOSE = True
+        elif argument in ('-h', '--help'):
+            usage()
+            exit()
+    if CONCURRENCY < 1:
+        print("ERROR: --concurrency must be at least 1")
+        exit(1)
+    return servers
+
+
+def main():
+    """Check the servers and the clients of the command line"""
+    servers = read_options(argv[1:])
+    ips = []
+    if IP_FILE:
+        try:
+            ips.extend(read_ips(IP_FILE))
+        except IOError as error:
+            print("ERROR: Cannot read", IP_FILE, error)
+            exit(1)
+    if LOG_FILE:
+        try:
+            ips.extend(dnsbl_clients(LOG_FILE, CLIENTS, RFC3339))
+        except IOError as error:
+            print("ERROR: Cannot open maillog", LOG_FILE, error)
+            exit(1)
+    if not servers and not ips:
+        usage()
+        exit(1)
+    host, _, port = (RESOLVER or default_resolver()).partition(":")
+    if not is_ip(host):
+        print("ERROR: --resolver must be an IPv4 address")
+        exit(1)
+    # an IP of --ips and --maillog is checked once, in its first place
+    ips = list(OrderedDict.fromkeys(ips))
+    cache = load_cache(CACHE_FILE) if CACHE_FILE else {}
+    asyncio.run(check_all(servers, ips, RBLS, (host, int(port or 53)), cache))
+    if CACHE_FILE:
+        save_cache(CACHE_FILE, cache)
+
+
+# VARIABLES
+# the DNSBL zones of rbl-check.sh
+RBLS = """bl.spamcop.net b.barracudacentral.org zen.spamhaus.org
+dnsbl.sorbs.net spam.dnsbl.sorbs.net truncate.gbudb.net all.s5h.net
+dnsbl-1.uceprotect.net dnsbl-2.uceprotect.net dnsbl-3.uceprotect.net
+psbl.surriel.com ubl.unsubscore.com db.wpbl.info all.spamrats.com
+dnsbl.inps.de korea.services.net bl.mailspike.net
+spamrbl.imp.ch wormrbl.imp.ch dnsbl.spfbl.net
+ips.backscatterer.org spamguard.leadmon.net
+ix.dnsbl.manitu.net tor.dan.me.uk rbl.efnetrbl.org
+dnsbl.dronebl.org access.redhawk.org
+rbl.interserver.net bogons.cymru.com""".split()
+RESOLVER = ""
+CONCURRENCY = 100
+TIMEOUT = 2.0
+RETRIES = 2
+CACHE_FILE = ""
+IP_FILE = ""
+LOG_FILE = ""
+CLIENTS = 100
+RFC3339 = False
+VERBOSE = False
+
+RESOLV_CONF = "/etc/resolv.conf"
+# cache duration of the answers without TTL, a negative answer without SOA
+NEGATIVE_TTL = 300
+# the Spamhaus zones answer 127.255.255.x to the refused queries, ex. from
+# a public resolver, it is not a listing
+DNSBL_ERROR = "127.255.255."
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Tests of postscreen_stats.py, run with python3 -m unittest or pytest."""
+
+import bz2
+import gzip
+import lzma
+import unittest
+from io import StringIO
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import postscreen_stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # pylint: disable=invalid-name
+
+# a graylisted client coming back after minutes:seconds, and a client
+# listed by a DNSBL
+SESSIONS = """\
+Jan 01 00:00:00 mx1 postfix/postscreen[1]: CONNECT from [{ip}]:1000 to [192.0.2.1]:25
+Jan 01 00:00:00 mx1 postfix/postscreen[1]: PASS NEW [{ip}]:1000
+Jan 01 00:00:00 mx1 postfix/postscreen[1]: NOQUEUE: reject: RCPT from [{ip}]:1000: 450 4.3.2 \
+Service currently unavailable; from=<a@example.com>, to=<b@example.org>, proto=ESMTP, helo=<x>
+Jan 01 00:{minutes:02d}:{seconds:02d} mx1 postfix/postscreen[1]: CONNECT from [{ip}]:1001 to [192.0.2.1]:25
+Jan 01 00:{minutes:02d}:{seconds:02d} mx1 postfix/postscreen[1]: PASS OLD [{ip}]:1001
+"""
+DNSBL_SESSION = """\
+Jan 01 00:00:05 mx1 postfix/postscreen[1]: CONNECT from [198.51.100.7]:1000 to [192.0.2.1]:25
+Jan 01 00:00:05 mx1 postfix/postscreen[1]: DNSBL rank 3 for [198.51.100.7]:1000
+Jan 01 00:00:07 mx1 postfix/postscreen[1]: HANGUP after 2.1 from [198.51.100.7]:1000 in tests \
+after SMTP handshake
+Jan 01 00:00:07 mx1 postfix/postscreen[1]: DISCONNECT [198.51.100.7]:1000
+"""
+
+
+def parse(log):
+    """Return the clients of the log lines"""
+    postscreen_stats.set_log_format(year=2024)
+    ip_list = {}
+    postscreen_stats.parse_lines(log.splitlines(True), ip_list)
+    return ip_list
+
+
+def graylisted(delays):
+    """Return the log of clients coming back after each of the delays"""
+    return "".join(SESSIONS.format(ip="203.0.113.%d" % index, minutes=delay // 60,
+                                   seconds=delay % 60)
+                   for index, delay in enumerate(delays, 1))
+
+
+def report(ip_list, ac_filter=None, with_numpy=True):
+    """Return the short report of the clients, with or without NumPy"""
+    with mock.patch.object(postscreen_stats, "numpy", numpy if with_numpy else None):
+        aggregates = postscreen_stats.aggregate_clients(
+            ip_list, postscreen_stats.compile_filter(ac_filter))
+    out = StringIO()
+    postscreen_stats.print_report(aggregates, out=out)
+    return aggregates, out.getvalue()
+
+
+class AggregateTest(unittest.TestCase):
+    """The report aggregates, of the Python and NumPy paths"""
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_same_report_with_numpy(self):
+        ip_list = parse(graylisted([5, 10, 45]) + DNSBL_SESSION)
+        for ac_filter in (None, "DNSBL", "PASS OLD", "BLACKLISTED", "DNSBL&!DNSBL"):
+            self.assertEqual(report(ip_list, ac_filter, with_numpy=True)[1],
+                             report(ip_list, ac_filter, with_numpy=False)[1], ac_filter)
+
+    def test_empty_selection(self):
+        ip_list = parse(graylisted([5]) + DNSBL_SESSION)
+        for with_numpy in (True, False):
+            aggregates, _ = report(ip_list, "BLACKLISTED", with_numpy)
+            self.assertNotIn("clients", aggregates.clients_stats)
+
+    def test_comeback_edges(self):
+        buckets = postscreen_stats.COMEBACK_BUCKETS
+        for index, edge in enumerate(postscreen_stats.COMEBACK_EDGES):
+            # the edges are the inclusive upper bounds of the buckets
+            self.assertEqual(postscreen_stats.comeback_bucket(edge), buckets[index])
+            self.assertEqual(postscreen_stats.comeback_bucket(edge + 0.5), buckets[index + 1])
+        delays = [10, 11, 30, 60, 300, 1800, 3599]
+        for with_numpy in (True, False):
+            comeback = report(parse(graylisted(delays)), with_numpy=with_numpy)[0].comeback
+            self.assertEqual(comeback["<=10s"], 1)
+            self.assertEqual(comeback["10s to 30s"], 2)
+            self.assertEqual(comeback[">30s to 1min"], 1)
+            self.assertEqual(comeback[">30min to 2h"], 1)
+
+
+class HistoryTest(unittest.TestCase):
+    """The clients of the --db history"""
+
+    def setUp(self):
+        self.database = postscreen_stats.open_history(":memory:")
+        postscreen_stats.set_log_format(year=2024)
+
+    def tearDown(self):
+        self.database.close()
+
+    def update(self, log, ip_list):
+        """Add the log lines to the history, parsed with ip_list"""
+        days = {}
+        postscreen_stats.parse_lines(log.splitlines(True), ip_list,
+                                     on_event=postscreen_stats.history_events(days))
+        postscreen_stats.save_history(self.database, days, None)
+
+    def query(self, ac_filter=None):
+        """Return the clients of the history matching the action filter"""
+        ip_list = {}
+        postscreen_stats.load_history(self.database, ip_list,
+                                      postscreen_stats.compile_filter(ac_filter))
+        return ip_list
+
+    def test_unsatisfiable_filter(self):
+        self.update(graylisted([5]) + DNSBL_SESSION, {})
+        self.assertEqual(len(self.query()), 2)
+        self.assertEqual(len(self.query("DNSBL")), 1)
+        self.assertEqual(self.query("DNSBL&!DNSBL"), {})
+
+    def test_update_carries_on(self):
+        # the graylisted client comes back in the next update of the history
+        log = graylisted([45]).splitlines(True)
+        self.update("".join(log[:3]) + DNSBL_SESSION, {})
+        ip_list = postscreen_stats.HistoryClients(self.database)
+        self.update("".join(log[3:]), ip_list)
+        self.assertEqual(len(ip_list), 1)
+        clients = self.query()
+        self.assertEqual(sorted(clients), sorted(parse(graylisted([45]) + DNSBL_SESSION)))
+        client = clients[postscreen_stats.ip_to_int("203.0.113.1")]
+        self.assertEqual((client.connect, client.reco_delay), (2, 45))
+
+
+class CompressedLogTest(unittest.TestCase):
+    """The postscreen lines of the compressed logs"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        # noise lines around the sessions, and more lines than a read block
+        noise = "Jan 01 00:00:00 mx1 postfix/qmgr[2]: 4F2A1C0D: removed\n"
+        self.log = (noise + graylisted([30]) + DNSBL_SESSION) * 2000
+        self.expected = list(self.lines(self.write("maillog", self.log.encode())))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        """Write data to a file of the temporary directory, return its path"""
+        path = join(self.directory.name, name)
+        with open(path, "wb") as log_file:
+            log_file.write(data)
+        return path
+
+    @staticmethod
+    def lines(path):
+        """Return the postscreen lines read from the log file path"""
+        with postscreen_stats.open_log(path) as maillog:
+            return list(postscreen_stats.postscreen_lines(maillog))
+
+    def test_standard_formats(self):
+        self.assertEqual(len(self.expected), 9 * 2000)
+        for name, compress in (("maillog.gz", gzip.compress), ("maillog.bz2", bz2.compress),
+                               ("maillog.xz", lzma.compress)):
+            self.assertEqual(self.lines(self.write(name, compress(self.log.encode()))),
+                             self.expected, name)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        data = zstandard.ZstdCompressor().compress(self.log.encode())
+        self.assertEqual(self.lines(self.write("maillog.zst", data)), self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()